@@ -0,0 +1,259 @@
+import struct
+from panda3d.core import *
+
+__all__ = ['JointTable', 'make_skinned_geometry', 'get_joint_transforms']
+
+# one matrix is 16 floats, 4 rgba32 texels of the buffer texture
+_MATRIX = struct.Struct('16f')
+
+
+def _matrix_bytes(mat):
+    """
+    Returns the bytes of a 4x4 matrix, each row of a panda matrix
+    becomes one column of a glsl mat4
+    """
+    try:
+        data = memoryview(mat).tobytes()
+        if len(data) == _MATRIX.size:
+            return data
+    except TypeError:
+        pass
+    return _MATRIX.pack(*[mat.get_cell(row, col) for row in range(4) for col in range(4)])
+
+
+class JointTable(object):
+    """
+    Joint matrices of all the actors drawn with the actor_buffer shader,
+    packed in one buffer texture (joint_table shader input).
+    Each actor (or each instance of a crowd) gets a block of matrices:
+    the root matrix that places the instance followed by its joint matrices,
+    the shader finds the block using the joint_offset and joint_stride inputs.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.used = 0
+        # (offset, size) of the blocks of removed actors, see _alloc()
+        self.free = []
+        self.actors = []
+        self.tex = Texture('joint_table')
+        self.tex.setup_buffer_texture(self.size*4, Texture.T_float,
+                                      Texture.F_rgba32, GeomEnums.UH_dynamic)
+        self.identity = _matrix_bytes(Mat4.ident_mat())
+
+    def _grow(self, size):
+        while self.size < size:
+            self.size *= 2
+        old_data = memoryview(self.tex.get_ram_image()).tobytes()
+        self.tex.setup_buffer_texture(self.size*4, Texture.T_float,
+                                      Texture.F_rgba32, GeomEnums.UH_dynamic)
+        memoryview(self.tex.modify_ram_image())[:len(old_data)] = old_data
+
+    def add(self, actors, transforms):
+        """
+        Reserves a block of matrices for the actors,
+        actors - list of Actors, the first one is the one that gets drawn,
+                 all the others are instances of it
+        transforms - for each actor a list of VertexTransforms
+                     in the order used by the joint_index column
+        Returns the offset of the block
+        """
+        stride = len(transforms[0])+1
+        offset = self._alloc(stride*len(actors))
+        # the root matrix of an instance places its geometry relative to
+        # the geometry of the first actor, the one that is drawn
+        geoms = [actor.find('**/+GeomNode') for actor in actors]
+        self.actors.append({'actors': actors,
+                            'geoms': geoms,
+                            'transforms': transforms,
+                            'offset': offset,
+                            'stride': stride,
+                            'size': stride*len(actors)})
+        return offset
+
+    def _alloc(self, size):
+        """
+        Returns the offset of a block of size matrices, reusing the
+        blocks of removed actors if one is big enough
+        """
+        for i, (offset, free_size) in enumerate(self.free):
+            if free_size >= size:
+                if free_size == size:
+                    del self.free[i]
+                else:
+                    self.free[i] = (offset+size, free_size-size)
+                return offset
+        offset = self.used
+        self.used += size
+        if self.used > self.size:
+            self._grow(self.used)
+        return offset
+
+    def _release(self, entry):
+        """
+        Puts the block of an entry on the free list, merging it with
+        the free blocks next to it
+        """
+        self.actors.remove(entry)
+        offset, size = entry['offset'], entry['size']
+        blocks = []
+        for free_offset, free_size in self.free:
+            if free_offset+free_size == offset:
+                offset, size = free_offset, size+free_size
+            elif offset+size == free_offset:
+                size += free_size
+            else:
+                blocks.append((free_offset, free_size))
+        if offset+size == self.used:
+            # the last block, just shrink the used part
+            self.used = offset
+        else:
+            blocks.append((offset, size))
+        self.free = sorted(blocks)
+
+    def remove(self, actor):
+        """
+        Frees the block of an actor, the block is reused by actors added later
+        """
+        for entry in self.actors[:]:
+            if entry['actors'][0] == actor:
+                self._release(entry)
+
+    def _in_view(self, node, lens_bounds):
+        if node.is_hidden():
+            return False
+        bounds = node.get_bounds()
+        bounds.xform(node.get_mat(base.cam))
+        return lens_bounds.contains(bounds) != BoundingVolume.IF_no_intersection
+
+    def update(self):
+        """
+        Writes the matrices of all the actors that are in view to the table,
+        returns True if any matrix changed
+        """
+        if not self.actors:
+            return False
+        lens_bounds = base.cam.node().get_lens().make_bounds()
+        old_data = memoryview(self.tex.get_ram_image())
+        writes = []
+        mat = Mat4()
+        for entry in self.actors[:]:
+            actors = entry['actors']
+            if actors[0].is_empty():
+                self._release(entry)
+                continue
+            if len(actors) == 1 and not self._in_view(actors[0], lens_bounds):
+                continue
+            start = entry['offset']*_MATRIX.size
+            block = []
+            for instance, actor in enumerate(actors):
+                # animate now, not in cull, so the matrices are not a frame late
+                # (instances are not drawn, cull would never animate them)
+                actor.update()
+                if instance == 0:
+                    block.append(self.identity)
+                else:
+                    block.append(_matrix_bytes(entry['geoms'][instance].get_mat(entry['geoms'][0])))
+                for transform in entry['transforms'][instance]:
+                    transform.get_matrix(mat)
+                    block.append(_matrix_bytes(mat))
+            block = b''.join(block)
+            if old_data[start:start+len(block)].tobytes() != block:
+                writes.append((start, block))
+        if not writes:
+            # nothing animated, the texture is not uploaded again
+            return False
+        data = memoryview(self.tex.modify_ram_image())
+        for start, block in writes:
+            data[start:start+len(block)] = block
+        return True
+
+
+def _get_joint_name(transform):
+    try:
+        return transform.get_joint().get_name()
+    except AttributeError:
+        return str(transform)
+
+
+def get_joint_transforms(actor, joint_names):
+    """
+    Returns the VertexTransforms of an actor in the order of joint_names
+    """
+    transforms = {}
+    for geom_np in actor.find_all_matches('**/+GeomNode'):
+        geom_node = geom_np.node()
+        for i in range(geom_node.get_num_geoms()):
+            blend_table = geom_node.get_geom(i).get_vertex_data().get_transform_blend_table()
+            if blend_table is None:
+                continue
+            for blend_id in range(blend_table.get_num_blends()):
+                blend = blend_table.get_blend(blend_id)
+                for j in range(blend.get_num_transforms()):
+                    transform = blend.get_transform(j)
+                    transforms[_get_joint_name(transform)] = transform
+    return [transforms[name] for name in joint_names]
+
+
+def make_skinned_geometry(actor):
+    """
+    Replaces the animated geometry of an actor with a copy that has no
+    animation, but has joint_index and joint_weight columns for the
+    actor_buffer shader. Panda will not animate the copy on the cpu,
+    the original geometry is hidden, but the joints still get updated.
+    Returns a list of the new nodes and a list of joint names in the
+    order used by joint_index
+    """
+    joint_array = GeomVertexArrayFormat()
+    joint_array.add_column(InternalName.make('joint_index'), 4,
+                           Geom.NT_uint16, Geom.C_index)
+    joint_array.add_column(InternalName.make('joint_weight'), 4,
+                           Geom.NT_float32, Geom.C_other)
+    joint_names = []
+    joint_ids = {}
+    nodes = []
+    for geom_np in actor.find_all_matches('**/+GeomNode'):
+        geom_node = geom_np.node()
+        new_node = GeomNode(geom_node.get_name()+'_skinned')
+        for i in range(geom_node.get_num_geoms()):
+            geom = geom_node.get_geom(i)
+            vdata = geom.get_vertex_data()
+            blend_table = vdata.get_transform_blend_table()
+            if blend_table is None:
+                new_node.add_geom(geom, geom_node.get_geom_state(i))
+                continue
+            new_format = GeomVertexFormat(vdata.get_format())
+            new_format.set_animation(GeomVertexAnimationSpec())
+            new_format.add_array(joint_array)
+            new_vdata = vdata.convert_to(GeomVertexFormat.register_format(new_format))
+            new_vdata.set_transform_blend_table(None)
+            blend_reader = GeomVertexReader(vdata, 'transform_blend')
+            index_writer = GeomVertexWriter(new_vdata, 'joint_index')
+            weight_writer = GeomVertexWriter(new_vdata, 'joint_weight')
+            while not blend_reader.is_at_end():
+                blend = blend_table.get_blend(blend_reader.get_data1i())
+                index = [0, 0, 0, 0]
+                weight = [0.0, 0.0, 0.0, 0.0]
+                # only the 4 strongest joints are used
+                joints = [(blend.get_weight(j), blend.get_transform(j))
+                          for j in range(blend.get_num_transforms())]
+                joints.sort(key=lambda joint: -joint[0])
+                total = sum(joint[0] for joint in joints[:4]) or 1.0
+                for j, (joint_weight, transform) in enumerate(joints[:4]):
+                    name = _get_joint_name(transform)
+                    if name not in joint_ids:
+                        joint_ids[name] = len(joint_names)
+                        joint_names.append(name)
+                    index[j] = joint_ids[name]
+                    weight[j] = joint_weight/total
+                index_writer.set_data4i(*index)
+                weight_writer.set_data4f(*weight)
+            new_geom = geom.make_copy()
+            new_geom.set_vertex_data(new_vdata)
+            new_node.add_geom(new_geom, geom_node.get_geom_state(i))
+        new_np = geom_np.get_parent().attach_new_node(new_node)
+        new_np.set_state(geom_np.get_state())
+        new_np.set_transform(geom_np.get_transform())
+        geom_np.hide()
+        nodes.append(new_np)
+    return nodes, joint_names
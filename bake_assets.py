@@ -0,0 +1,167 @@
+'''
+Offline asset baker. Converts egg models to bam files with the fixups of the
+WrappedLoader (sRGB textures, texture shader inputs, transparency) already
+applied, and writes a manifest. The WrappedLoader loads the models listed
+in the manifest (config variable baked-asset-manifest, by default
+baked/manifest.json) from the bam files and skips the fixups.
+Models are converted in a process pool, unchanged models are skipped.
+Paths in the manifest are relative to the directory the baker is run
+from, run it from the same directory as the game.
+
+usage: python bake_assets.py [-o out_dir] [-j processes] [--srgb | --no-srgb] [--force] [dirs]
+'''
+import os
+import json
+import time
+import argparse
+import multiprocessing
+
+_VERSION = 1
+_EXTENSIONS = ('.egg.pz', '.egg')
+
+
+def _strip_extension(path):
+    for extension in _EXTENSIONS:
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+
+def find_models(dirs):
+    """
+    Returns the paths of all the egg files in dirs
+    """
+    models = []
+    for top in dirs:
+        for root, sub_dirs, files in os.walk(top):
+            sub_dirs.sort()
+            for name in sorted(files):
+                if name.endswith(_EXTENSIONS):
+                    models.append(os.path.normpath(os.path.join(root, name)))
+    return models
+
+
+def _init_worker(srgb):
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData('', 'framebuffer-srgb {0}'.format(int(srgb)))
+    # the workers never open a window
+    loadPrcFileData('', 'window-type none')
+
+
+def _bake_model(task):
+    """
+    Loads one egg file, applies the fixups and writes it as bam,
+    task is (source path, bam path, sRGB)
+    Returns (source path, error or None, seconds)
+    """
+    source, bam_path, srgb = task
+    start = time.time()
+    from panda3d.core import Loader, NodePath, Filename, TexturePool
+    from wrapped_loader import WrappedLoader, default_texture_shader_inputs
+    node = Loader.get_global_ptr().load_sync(Filename.from_os_specific(source))
+    if node is None:
+        return source, 'could not load', time.time() - start
+    model = NodePath(node)
+    fixer = WrappedLoader(None)
+    fixer.use_srgb = srgb
+    fixer.texture_shader_inputs = default_texture_shader_inputs(TexturePool.load_texture)
+    fixer.applyFixups(model)
+    out_dir = os.path.dirname(bam_path)
+    if out_dir and not os.path.isdir(out_dir):
+        try:
+            os.makedirs(out_dir)
+        except OSError:
+            # made by an other worker
+            pass
+    if not model.write_bam_file(Filename.from_os_specific(bam_path)):
+        return source, 'could not write ' + bam_path, time.time() - start
+    return source, None, time.time() - start
+
+
+def bake(dirs, out_dir='baked', processes=None, srgb=False, force=False):
+    """
+    Bakes all the egg files in dirs to out_dir and writes
+    out_dir/manifest.json, returns the manifest
+    """
+    from panda3d.core import PandaSystem
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    manifest = {'version': _VERSION,
+                'panda_version': PandaSystem.get_version_string(),
+                'srgb': srgb,
+                'models': {}}
+    old_models = {}
+    if not force and os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                old = json.load(f)
+            if all(old.get(key) == manifest[key] for key in ('version', 'panda_version', 'srgb')):
+                old_models = old.get('models', {})
+        except (IOError, ValueError) as err:
+            print('Old manifest not used', manifest_path, err)
+
+    tasks = []
+    entries = {}
+    for source in find_models(dirs):
+        key = _strip_extension(source).replace(os.sep, '/')
+        bam_path = os.path.join(out_dir, _strip_extension(source) + '.bam')
+        entry = {'source': os.path.relpath(source, out_dir).replace(os.sep, '/'),
+                 'bam': os.path.relpath(bam_path, out_dir).replace(os.sep, '/'),
+                 'source_mtime': os.path.getmtime(source)}
+        entries[key] = (source, entry)
+        if old_models.get(key) == entry and os.path.isfile(bam_path):
+            manifest['models'][key] = entry
+        else:
+            tasks.append((source, bam_path, srgb))
+    print('{0} models, {1} to bake'.format(len(entries), len(tasks)))
+
+    start = time.time()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(tasks)))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (srgb,))
+        try:
+            results = list(pool.imap_unordered(_bake_model, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(srgb)
+        results = [_bake_model(task) for task in tasks]
+
+    by_source = {source: (key, entry) for key, (source, entry) in entries.items()}
+    for source, error, seconds in sorted(results):
+        if error is not None:
+            print('    {0}: {1}'.format(source, error))
+            continue
+        key, entry = by_source[source]
+        manifest['models'][key] = entry
+        print('    {0} {1:.2f}s'.format(source, seconds))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    print('Baked in {0:.2f}s, manifest: {1}'.format(time.time() - start, manifest_path))
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bake egg models to bam for the deferred renderer')
+    parser.add_argument('dirs', nargs='*', default=['models', 'sample_assets'])
+    parser.add_argument('-o', '--out', default='baked', help='output directory')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='worker processes, default one per cpu')
+    parser.add_argument('--srgb', dest='srgb', action='store_true', default=None,
+                        help='bake sRGB textures (framebuffer-srgb 1)')
+    parser.add_argument('--no-srgb', dest='srgb', action='store_false')
+    parser.add_argument('--force', action='store_true', help='bake unchanged models again')
+    args = parser.parse_args()
+    srgb = args.srgb
+    if srgb is None:
+        from panda3d.core import ConfigVariableBool
+        srgb = ConfigVariableBool('framebuffer-srgb').getValue()
+    bake(args.dirs, args.out, args.processes, srgb, args.force)
+
+
+if __name__ == '__main__':
+    main()
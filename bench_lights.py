@@ -0,0 +1,70 @@
+'''
+Benchmark for creating and removing lights.
+Creates and removes batches of SphereLights and ConeLights:
+ cold - the light pool is empty, each light makes a new light volume
+ warm - the lights reuse the light volumes of removed lights
+A frame is rendered after each batch, so the cost of the first frame
+with the new lights is included.
+
+usage: python bench_lights.py [lights per batch] [batches]
+'''
+import sys
+import time
+
+
+def time_batch(make_light, count):
+    start = time.time()
+    lights = [make_light(i) for i in range(count)]
+    created = time.time()
+    base.graphicsEngine.render_frame()
+    rendered = time.time()
+    for light in lights:
+        light.remove()
+    removed = time.time()
+    base.graphicsEngine.render_frame()
+    return created-start, rendered-created, removed-rendered
+
+
+def run(count, batches):
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData('', 'sync-video 0')
+    loadPrcFileData('', 'win-size 1280 720')
+    loadPrcFileData('', 'framebuffer-srgb 0')
+    loadPrcFileData('', 'textures-power-2 None')
+    from direct.showbase import ShowBase
+    from deferred_render import DeferredRenderer
+    from lights import SphereLight, ConeLight
+    from options import Options
+
+    base = ShowBase.ShowBase()
+    base.disableMouse()
+    DeferredRenderer(**Options('presets/medium.ini').get())
+    base.cam.set_pos(0, -40, 10)
+    base.cam.look_at(0, 0, 0)
+
+    def make_sphere(i):
+        return SphereLight(color=(1.0, 0.8, 0.6), pos=(i % 20-10, i//20, 1), radius=3.0, shadow_size=0)
+
+    def make_cone(i):
+        return ConeLight(color=(0.6, 0.8, 1.0), pos=(i % 20-10, i//20, 3), look_at=(i % 20-10, i//20, 0),
+                         radius=5.0, fov=50.0, shadow_size=0)
+
+    # compile the shaders
+    for i in range(10):
+        base.graphicsEngine.render_frame()
+    print('{0} lights per batch, {1} batches, microseconds per light:'.format(count, batches))
+    print('    {0:12} {1:>10} {2:>10} {3:>10}'.format('', 'create', 'frame', 'remove'))
+    for name, make_light in (('SphereLight', make_sphere), ('ConeLight', make_cone)):
+        results = {}
+        # the first batch fills the light pool
+        results['cold'] = [time_batch(make_light, count)]
+        results['warm'] = [time_batch(make_light, count) for i in range(batches)]
+        for pool in ('cold', 'warm'):
+            times = results[pool]
+            average = [1000000.0*sum(t[i] for t in times)/(len(times)*count) for i in range(3)]
+            print('    {0:12} {1:10.1f} {2:10.1f} {3:10.1f}  {4}'.format(name, average[0], average[1], average[2], pool))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,63 @@
+'''
+Benchmark for loading models, egg files with the WrappedLoader fixups
+against the bam files baked by bake_assets.py (run it first).
+Each setup runs in its own process, so nothing is cached by the
+model pool or the texture pool of the other setup.
+
+usage: python bench_loading.py [loads] [manifest]
+'''
+import sys
+import time
+import subprocess
+
+MODELS = ('sample_assets/plane.egg', 'models/sphere.egg', 'models/cone.egg')
+
+
+def run(setup_name, loads, manifest):
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData('', 'window-type none')
+    loadPrcFileData('', 'framebuffer-srgb 0')
+    loadPrcFileData('', 'baked-asset-manifest ' + (manifest if setup_name == 'baked' else ''))
+    from direct.showbase import ShowBase
+    from wrapped_loader import WrappedLoader, default_texture_shader_inputs
+
+    base = ShowBase.ShowBase()
+    wrapped_loader = WrappedLoader(base.loader)
+    wrapped_loader.texture_shader_inputs = default_texture_shader_inputs(base.loader.load_texture)
+    if setup_name == 'baked' and not wrapped_loader.baked_models:
+        print('{0} no baked models in {1}'.format(setup_name, manifest))
+        return
+    for model_path in MODELS:
+        start = time.time()
+        for i in range(loads):
+            wrapped_loader.loadModel(model_path, noCache=True)
+        elapsed = time.time() - start
+        print('{0} {1} {2:.3f}'.format(setup_name, model_path, 1000.0*elapsed/loads))
+
+
+def main(loads, manifest):
+    results = {}
+    for setup_name in ('egg', 'baked'):
+        out = subprocess.check_output([sys.executable, __file__, '--run', setup_name, str(loads), manifest])
+        for line in out.decode().split('\n'):
+            words = line.split()
+            if len(words) == 3 and words[0] == setup_name:
+                results[setup_name, words[1]] = float(words[2])
+            elif words and words[0] == setup_name:
+                print(line)
+    print('Loading benchmark, {0} loads, ms per load:'.format(loads))
+    print('    {0:25} {1:>10} {2:>10}'.format('model', 'egg', 'baked'))
+    for model_path in MODELS:
+        egg = results.get(('egg', model_path))
+        baked = results.get(('baked', model_path))
+        if egg is None or baked is None:
+            continue
+        print('    {0:25} {1:10.3f} {2:10.3f}  {3:.1f}x'.format(model_path, egg, baked, egg/max(baked, 0.001)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--run':
+        run(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+             sys.argv[2] if len(sys.argv) > 2 else 'baked/manifest.json')
@@ -0,0 +1,84 @@
+'''
+Benchmark for the parallax occlusion mapping in the geometry pass.
+Renders a large textured floor seen at a low angle with:
+ off  - DISABLE_POM
+ full - POM on every pixel
+ lod  - POM faded out with distance (POM_FADE_START, POM_FADE_END)
+Each setup runs in its own process (there can only be one DeferredRenderer).
+
+usage: python bench_pom.py [frames]
+'''
+import sys
+import time
+import subprocess
+
+SETUPS = {'off': {'DISABLE_POM': 1},
+          'full': {},
+          'lod': {'POM_FADE_START': 5.0, 'POM_FADE_END': 20.0}}
+
+
+def run(setup_name, frames):
+    from panda3d.core import loadPrcFileData, Vec3
+    loadPrcFileData('', 'sync-video 0')
+    loadPrcFileData('', 'win-size 1280 720')
+    loadPrcFileData('', 'framebuffer-srgb 0')
+    loadPrcFileData('', 'textures-power-2 None')
+    from direct.showbase import ShowBase
+    from deferred_render import DeferredRenderer
+    from options import Options
+
+    base = ShowBase.ShowBase()
+    base.disableMouse()
+    options = Options('presets/full.ini').get()
+    setup = options['shading_setup']
+    if 'DISABLE_POM' in setup:
+        del setup['DISABLE_POM']
+    setup.update(SETUPS[setup_name])
+    DeferredRenderer(**options)
+    deferred_renderer.set_near_far(1.0, 200.0)
+
+    tile = loader.load_model('sample_assets/plane.egg')
+    tile.set_scale(0.1)
+    bounds = tile.get_tight_bounds()
+    size = (bounds[1] - bounds[0]).x
+    for x in range(-4, 5):
+        for y in range(0, 20):
+            copy = tile.copy_to(deferred_render)
+            copy.set_pos(x*size, y*size, -0.5)
+    base.cam.set_pos(0, -2, 1.5)
+    base.cam.look_at(Vec3(0, 10, 0))
+
+    # warm up, compile shaders
+    for i in range(30):
+        base.graphicsEngine.render_frame()
+    start = time.time()
+    for i in range(frames):
+        base.graphicsEngine.render_frame()
+    base.graphicsEngine.sync_frame()
+    elapsed = time.time() - start
+    print('{0} {1:.3f}'.format(setup_name, 1000.0*elapsed/frames))
+
+
+def main(frames):
+    results = {}
+    for setup_name in ('off', 'full', 'lod'):
+        out = subprocess.check_output([sys.executable, __file__, '--run', setup_name, str(frames)])
+        for line in out.decode().split('\n'):
+            words = line.split()
+            if len(words) == 2 and words[0] == setup_name:
+                results[setup_name] = float(words[1])
+    print('POM benchmark, {0} frames, ms per frame:'.format(frames))
+    for setup_name, ms in sorted(results.items(), key=lambda item: item[1]):
+        print('    {0:5} {1:8.3f} ms'.format(setup_name, ms))
+    if 'full' in results and 'lod' in results and 'off' in results:
+        pom_cost = results['full'] - results['off']
+        if pom_cost > 0.0:
+            saved = 100.0*(results['full'] - results['lod'])/pom_cost
+            print('POM LOD saves {0:.1f}% of the POM cost'.format(saved))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--run':
+        run(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
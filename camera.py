@@ -66,7 +66,20 @@ class CameraControler (DirectObject):
         self.zoom+=amount*self.zoom_speed
         self.zoom=min(max(self.zoom, -6.0*self.zoom_speed), 6.0*self.zoom_speed)
 
+    def is_idle(self):
+        """
+        True if no keys are pressed and the zoom and rotation inertia have settled
+        """
+        if any(self.key_map.values()):
+            return False
+        return self.zoom == 0.0 and self.last_delta[0] == 0 and self.last_delta[1] == 0
+
     def update(self, task):
+        if self.is_idle():
+            # nothing to move, only keep track of the mouse
+            if base.mouseWatcherNode.has_mouse():
+                self.last_mouse_pos = Vec2(base.mouseWatcherNode.get_mouse())
+            return task.again
         dt = globalClock.getDt()
         if self.key_map['forward']:
             self.node.set_y(self.node,-self.move_speed*dt)
@@ -77,31 +90,36 @@ class CameraControler (DirectObject):
         elif self.key_map['right']:
             self.node.set_x(self.node,-self.move_speed*dt)
 
-        if base.mouseWatcherNode.has_mouse():
-            if self.zoom != 0.0:
-                distance=base.camera.get_distance(self.node)
-                if (distance > self.limits[0] and self.zoom >0.0) or (distance < self.limits[1] and self.zoom < 0.0):
-                    zoom_speed=self.zoom*dt
-                    base.camera.set_y(base.camera, zoom_speed)
-                    zoom_speed*=4.0
-                    if self.zoom > 0.1:
-                        self.zoom-=zoom_speed
-                    elif self.zoom < -0.1:
-                        self.zoom-=zoom_speed
-                    else:
-                        self.zoom=0.0
+        if self.zoom != 0.0:
+            distance=base.camera.get_distance(self.node)
+            if (distance > self.limits[0] and self.zoom >0.0) or (distance < self.limits[1] and self.zoom < 0.0):
+                zoom_speed=self.zoom*dt
+                base.camera.set_y(base.camera, zoom_speed)
+                zoom_speed*=4.0
+                if self.zoom > 0.1:
+                    self.zoom-=zoom_speed
+                elif self.zoom < -0.1:
+                    self.zoom-=zoom_speed
+                else:
+                    self.zoom=0.0
+            else:
+                # at the limit, the zoom can't go any further
+                self.zoom=0.0
+
+        has_mouse = base.mouseWatcherNode.has_mouse()
+        if has_mouse:
             m_pos=base.mouseWatcherNode.get_mouse()
             delta = m_pos- self.last_mouse_pos
             self.last_mouse_pos = Vec2(m_pos)
-            if not self.key_map['rotate']:
-                delta=self.last_delta*(0.999-dt)
-                if abs(delta[0])<0.003:
-                    delta[0]=0
-                if abs(delta[1])<0.003:
-                    delta[1]=0
-            self.last_delta=delta
-                #print(delta)
-            p=self.gimbal.get_p()- delta[1]*self.speed*dt
-            self.gimbal.set_p(min(max(p, self.max_p[0]), self.max_p[1]))
-            self.node.set_h(self.node.get_h()- delta[0]*self.speed*dt)
+        if not self.key_map['rotate'] or not has_mouse:
+            # the rotation inertia settles, also with the mouse outside the window
+            delta=self.last_delta*(0.999-dt)
+            if abs(delta[0])<0.003:
+                delta[0]=0
+            if abs(delta[1])<0.003:
+                delta[1]=0
+        self.last_delta=delta
+        p=self.gimbal.get_p()- delta[1]*self.speed*dt
+        self.gimbal.set_p(min(max(p, self.max_p[0]), self.max_p[1]))
+        self.node.set_h(self.node.get_h()- delta[0]*self.speed*dt)
         return task.again
@@ -0,0 +1,51 @@
+'''
+Check for CameraControler.is_idle(), needed by the render on demand mode.
+The camera is spun and zoomed into its limit, then the mouse leaves the
+window. The rotation and zoom inertia have to settle anyway, update()
+is driven with a fixed frame time until is_idle() is True.
+Prints the number of frames it took, no idle after the limit is a failure.
+
+usage: python check_camera_idle.py [max frames]
+'''
+import sys
+
+
+class _MouseOutside(object):
+    """
+    Stands in for base.mouseWatcherNode with the mouse outside the window
+    """
+    def has_mouse(self):
+        return False
+
+
+def run(max_frames):
+    from panda3d.core import loadPrcFileData, ClockObject
+    loadPrcFileData('', 'window-type offscreen')
+    loadPrcFileData('', 'audio-library-name null')
+    from direct.showbase import ShowBase
+    from camera import CameraControler
+
+    base = ShowBase.ShowBase()
+    base.disableMouse()
+    globalClock.set_mode(ClockObject.M_non_real_time)
+    globalClock.set_frame_rate(60)
+    camera_controler = CameraControler()
+    # spinning, zooming in at the near limit
+    camera_controler.last_delta.set(0.05, -0.02)
+    camera_controler.zoom = 6.0
+    base.camera.set_y(base.camera, base.camera.get_distance(camera_controler.node)-camera_controler.limits[0])
+    base.mouseWatcherNode = _MouseOutside()
+
+    for frame in range(max_frames):
+        base.taskMgr.step()
+        if camera_controler.is_idle():
+            print('idle after {0} frames'.format(frame+1))
+            return True
+    print('FAILED: not idle after {0} frames, zoom {1}, last delta {2}'.format(
+        max_frames, camera_controler.zoom, camera_controler.last_delta))
+    return False
+
+
+if __name__ == '__main__':
+    if not run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000):
+        sys.exit(1)
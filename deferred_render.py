@@ -1,9 +1,14 @@
 import sys
+import re
 import math
+import struct
 from direct.showbase.DirectObject import DirectObject
 from panda3d.core import *
 
-from wrapped_loader import WrappedLoader
+from wrapped_loader import WrappedLoader, default_texture_shader_inputs
+from stage_fusion import FusionError, fuse_fragment_shaders, same_shader_text
+from actors import JointTable, make_skinned_geometry, get_joint_transforms
+from ibl import get_ibl
 
 if sys.version_info >= (3, 0):
     import builtins
@@ -38,26 +43,67 @@ class DeferredRenderer(DirectObject):
         # last known window size, needed to test on window events if the window
         # size changed
         self.last_window_size = (base.win.get_x_size(), base.win.get_y_size())
+        # size factor of each buffer (by name), see _resize_buffers()
+        self.buffer_sizes = {}
 
         self.shadow_size=shadows
         self.attached_lights={}
+        # light volumes using the stencil pass, see _add_stencil_pass()
+        self.stencil_lights=[]
+        self.stencil_light_count=0
+        # fixed bin slots of removed stencil lights, see _add_stencil_pass()
+        self.stencil_free_slots=[]
+        # buffers waiting to be removed, see remove_buffer()
+        self.buffer_removal=[]
+        # point lights casting shadows, see set_point_light_shadow()
+        self.point_shadow_lights=[]
+        # shadow map faces rendered and skipped in the last frame
+        self.shadow_face_stats={'rendered': 0, 'skipped': 0}
+        # light pool, see add_point_light(), add_cone_light(), release_light()
+        self.light_prototypes={}
+        self.light_states={}
+        self.light_pool={}
+        # last shader input values set with set_node_input(), by node key
+        self.node_inputs={}
+        # applied and skipped set_node_input() calls, this frame and the last one
+        self.input_stats={'applied': 0, 'skipped': 0}
+        self.last_input_stats={'applied': 0, 'skipped': 0}
+        # joint matrices of actors skinned with the actor_buffer shader
+        self.joint_table=None
+        # one row (roughness, metallic, glow, alpha) for each material from
+        # set_material(), row 0 is unused - it means 'use tex_material'
+        self.materials = {}
+        self.material_tex = Texture('material_table')
+        self.material_tex.setup_2d_texture(256, 1, Texture.T_float, Texture.F_rgba32)
+        self.material_tex.set_magfilter(SamplerState.FT_nearest)
+        self.material_tex.set_minfilter(SamplerState.FT_nearest)
+        self.material_tex.set_ram_image(bytes(bytearray(256*16)))
+        # static scene content, see flatten_static()
+        self.static_nodes=[]
+        self.static_groups=[]
         self.modelMask = scene_mask
         self.lightMask = light_mask
 
         # install a wrapped version of the loader in the builtins
         builtins.loader = WrappedLoader(builtins.loader)
-        loader.texture_shader_inputs = [{'input_name': 'tex_diffuse',
-                                         'stage_modes': (TextureStage.M_modulate, TextureStage.M_modulate_glow, TextureStage.M_modulate_gloss),
-                                         'default_texture': loader.load_texture('tex/def_diffuse.png')},
-                                        {'input_name': 'tex_normal',
-                                         'stage_modes': (TextureStage.M_normal, TextureStage.M_normal_height, TextureStage.M_normal_gloss),
-                                         'default_texture': loader.load_texture('tex/def_normal.png')},
-                                        {'input_name': 'tex_material',  # Shine Height Alpha Glow
-                                         # something different
-                                         'stage_modes': (TextureStage.M_selector,),
-                                         'default_texture': loader.load_texture('tex/def_material.png')}]
+        loader.texture_shader_inputs = default_texture_shader_inputs(loader.load_texture)
+        # defines added to the defines of all filter stages
+        self.filter_defines = {}
         # set up the deferred rendering buffers
-        self.shading_setup = shading_setup
+        # (a copy, defines are added to it and the caller might reuse the dict)
+        self.shading_setup = dict(shading_setup)
+        # how point lights render shadows: 'cube' (6 faces), 'culled' (cube
+        # faces that can't be seen or have no casters are skipped) or
+        # 'paraboloid' (2 faces, see set_point_light_shadow())
+        self.point_shadow_mode = self.shading_setup.get('POINT_SHADOW_MODE', 'cube')
+        if self.point_shadow_mode not in ('cube', 'culled', 'paraboloid'):
+            raise RuntimeError('Unknown POINT_SHADOW_MODE: {}'.format(self.point_shadow_mode))
+        if self.point_shadow_mode == 'paraboloid':
+            self.shading_setup['PARABOLOID_SHADOW'] = 1
+        # size the buffers are made for, see _get_render_size()
+        self.render_size = self._get_render_size(self.last_window_size)
+        if 'COMPACT_GBUFFER' in self.shading_setup:
+            self.filter_defines['COMPACT_GBUFFER'] = self.shading_setup['COMPACT_GBUFFER']
         self._setup_g_buffer(self.shading_setup)
 
         # post process
@@ -66,16 +112,32 @@ class DeferredRenderer(DirectObject):
         self.filter_tex = {}
         self.filter_cam = {}
 
-
-        self.cube_tex=loader.load_cube_map('tex/cube/skybox_#.png')
-        tex_format=self.cube_tex.get_format()
-        if tex_format == Texture.F_rgb:
-            tex_format = Texture.F_srgb
-        elif tex_format == Texture.F_rgba:
-            tex_format = Texture.F_srgb_alpha
-        self.cube_tex.set_format(tex_format)
-        self.cube_tex.set_magfilter(SamplerState.FT_linear_mipmap_linear )
-        self.cube_tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+        # buffers rendered after the geometry buffer and before the lights
+        self.prepass_buff = []
+        # hierarchical min/max depth pyramid
+        self.hiz_tex = []
+        if 'HIZ_LEVELS' in self.shading_setup:
+            self._setup_depth_pyramid(self.shading_setup['HIZ_LEVELS'])
+        # view space position reconstructed from depth
+        self.view_pos_tex = None
+        if 'VIEW_POS_PREPASS' in self.shading_setup:
+            self._setup_view_pos_prepass()
+        # depth downsampled to the size of the forward buffer
+        self.forward_depth_tex = None
+        if 'FORWARD_UPSAMPLE' in self.shading_setup:
+            self._setup_forward_depth()
+        # weighted blended order independent transparency in the forward pass
+        self.forward_resolve_tex = None
+        if 'FORWARD_OIT' in self.shading_setup:
+            self._setup_forward_oit()
+
+        # prefiltered cube maps (by path), see set_cubemap()
+        self.ibl_cache = {}
+        self.cube_tex = self._load_cubemap('tex/cube/skybox_#.png')
+        ibl_sh = None
+        if 'IBL_PREFILTERED' in self.shading_setup:
+            self.filter_defines['IBL_PREFILTERED'] = 1
+            self.cube_tex, ibl_sh, ibl_max_lod = self._get_ibl('tex/cube/skybox_#.png', self.cube_tex)
 
         self.common_inputs = {'render': render,
                               'camera': base.cam,
@@ -86,8 +148,43 @@ class DeferredRenderer(DirectObject):
                               'forward_tex': self.plain_tex,
                               'forward_aux_tex': self.plain_aux,
                               'cube_tex': self.cube_tex}
-
+        if ibl_sh is not None:
+            self.common_inputs['ibl_sh'] = ibl_sh
+            self.common_inputs['ibl_max_lod'] = float(ibl_max_lod)
+            self.common_inputs['ibl_diffuse'] = float(self.shading_setup.get('IBL_DIFFUSE', 1.0))
+        for level, tex in enumerate(self.hiz_tex):
+            self.common_inputs['hiz_{0}'.format(level)] = tex
+        if self.hiz_tex:
+            self.common_inputs['hiz_tex'] = self.hiz_tex[0]
+        if self.view_pos_tex:
+            self.common_inputs['view_pos_tex'] = self.view_pos_tex
+        if self.forward_depth_tex:
+            self.common_inputs['forward_depth_tex'] = self.forward_depth_tex
+        if self.forward_resolve_tex:
+            self.common_inputs['forward_tex'] = self.forward_resolve_tex
+        # inputs that are not filter stage textures
+        self.base_inputs = set(self.common_inputs)
+        # DISABLE_* blocks of filter shaders, see _get_disable_define()
+        self.disable_blocks = {}
+
+        # names of filter stages fused into other stages, see _fuse_filter_stages()
+        self.fused_stages = {}
+        # filter stages not rendered every frame, see add_filter()
+        self.filter_schedule = {}
+        self.refresh_all_filters = False
+        # render on demand, see set_render_on_demand()
+        self.render_on_demand = False
+        self.idle = False
+        self.idle_frames = 0
+        self.idle_checks = []
+        self.idle_buffers = []
+        self.idle_clock_mode = None
+        self.scene_changed = True
+        self.last_scene_state = None
+        self.joint_table_changed = False
         self.filter_stages = filter_setup
+        if 'FUSE_FILTERS' in self.shading_setup:
+            self.filter_stages = self._fuse_filter_stages(filter_setup)
 
         for stage in self.filter_stages:
             self.add_filter(**stage)
@@ -109,12 +206,18 @@ class DeferredRenderer(DirectObject):
         self.filter_quad[last_stage] = self.lightbuffer.get_texture_card()
         self.reload_filter(last_stage)
         self.filter_quad[last_stage].reparent_to(render2d)
+        # the last stage renders to the window, every frame
+        self.filter_schedule.pop(last_stage, None)
 
         # listen to window events so that buffers can be resized with the
         # window
         self.accept("window-event", self._on_window_event)
         # update task
         taskMgr.add(self._update, '_update_tsk', sort=-150)
+        # late, after the lights and the camera have moved
+        taskMgr.add(self._update_point_shadows, 'point_shadow_tsk', sort=47)
+        if 'RENDER_ON_DEMAND' in self.shading_setup:
+            self.set_render_on_demand(True)
 
     def save_screenshot(self, name='screen', extension='png'):
         if 'name' in self.filter_stages[-1]:
@@ -127,28 +230,229 @@ class DeferredRenderer(DirectObject):
         tex.write(name+'.'+extension)
         print('Screen saved to:', name+'.'+extension)
 
-    def set_cubemap(self, cubemap):
-        self.cube_tex=loader.load_cube_map(cubemap)
-        tex_format=self.cube_tex.get_format()
+    def set_cubemap(self, cubemap, prefilter=None):
+        """
+        Sets the environment cube map, cubemap is a path with a '#' for
+        the face number (eg. 'tex/cube/skybox_#.png').
+        If prefilter is True (default: IBL_PREFILTERED in the shading setup)
+        the mip levels of the cube map are GGX prefiltered for rougher and
+        rougher surfaces and the irradiance is stored as spherical harmonics
+        (see ibl.py). Prefiltered cube maps are cached on disk (IBL_CACHE)
+        and in memory, so only the first use of a cube map is slow.
+        """
+        if prefilter is None:
+            prefilter = 'IBL_PREFILTERED' in self.filter_defines
+        inputs = {}
+        if prefilter:
+            self.cube_tex, inputs['ibl_sh'], ibl_max_lod = self._get_ibl(cubemap, None)
+            inputs['ibl_max_lod'] = float(ibl_max_lod)
+            inputs['ibl_diffuse'] = self.common_inputs.get('ibl_diffuse', 1.0)
+        else:
+            self.cube_tex = self._load_cubemap(cubemap)
+            for name in ('ibl_sh', 'ibl_max_lod', 'ibl_diffuse'):
+                self.common_inputs.pop(name, None)
+        inputs['cube_tex'] = self.cube_tex
+        self.common_inputs.update(inputs)
+        if prefilter != ('IBL_PREFILTERED' in self.filter_defines):
+            # the filter shaders need another define
+            if prefilter:
+                self.filter_defines['IBL_PREFILTERED'] = 1
+            else:
+                del self.filter_defines['IBL_PREFILTERED']
+            for stage_name in list(self.filter_quad):
+                self.reload_filter(stage_name)
+        else:
+            for quad in self.filter_quad.values():
+                for name, value in inputs.items():
+                    quad.set_shader_input(name, value)
+        self.mark_changed()
+
+    def _load_cubemap(self, cubemap):
+        """
+        Loads a cube map with a srgb format and hardware mipmaps
+        """
+        cube_tex=loader.load_cube_map(cubemap)
+        tex_format=cube_tex.get_format()
         if tex_format == Texture.F_rgb:
             tex_format = Texture.F_srgb
         elif tex_format == Texture.F_rgba:
             tex_format = Texture.F_srgb_alpha
-        self.cube_tex.set_format(tex_format)
-        self.cube_tex.set_magfilter(SamplerState.FT_linear_mipmap_linear )
-        self.cube_tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
-        self.common_inputs['cube_tex']= self.cube_tex
-        for quad in self.filter_quad.values():
-            quad.set_shader_input('cube_tex', self.cube_tex)
+        cube_tex.set_format(tex_format)
+        cube_tex.set_magfilter(SamplerState.FT_linear_mipmap_linear )
+        cube_tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+        return cube_tex
+
+    def _get_ibl(self, cubemap, cube_tex=None):
+        """
+        Returns the prefiltered cube map, irradiance spherical harmonics
+        and the max mip level for a cube map path, see ibl.get_ibl()
+        """
+        if cubemap not in self.ibl_cache:
+            if cube_tex is None:
+                cube_tex = self._load_cubemap(cubemap)
+            self.ibl_cache[cubemap] = get_ibl(cube_tex,
+                                              cache_dir=self.shading_setup.get('IBL_CACHE', 'cache/ibl'),
+                                              size=self.shading_setup.get('IBL_SIZE', 128),
+                                              levels=self.shading_setup.get('IBL_LEVELS', 6),
+                                              processes=self.shading_setup.get('IBL_PROCESSES', None))
+        return self.ibl_cache[cubemap]
 
 
     def set_material(self, node, roughness, metallic, glow, alpha=1.0):
-        image = PNMImage(x_size=32, y_size=32, num_channels=4)
-        image.fill(roughness, glow, metallic)
-        image.alpha_fill(alpha)
-        tex=Texture()
-        tex.load(image)
-        node.set_shader_input('tex_material',tex, 1)
+        """
+        Sets the material of a node, materials with the same values share
+        one row of the material table, the node only gets the index of the row
+        """
+        node.set_shader_input('material_index', self._get_material_index(
+            roughness, metallic, glow, alpha), 1)
+
+    def _get_material_index(self, roughness, metallic, glow, alpha):
+        """
+        Returns the index of a material in the material table,
+        adds the material if it's not there yet
+        """
+        material = (float(roughness), float(metallic), float(glow), float(alpha))
+        if material not in self.materials:
+            self.materials[material] = len(self.materials)+1
+            self._write_material_table()
+        return self.materials[material]
+
+    def _write_material_table(self):
+        """
+        Writes all the materials to the material table texture,
+        the texture grows if there are too many materials
+        """
+        size = self.material_tex.get_x_size()
+        if len(self.materials) >= size:
+            while len(self.materials) >= size:
+                size *= 2
+            self.material_tex.setup_2d_texture(size, 1, Texture.T_float, Texture.F_rgba32)
+        data = bytearray(size*16)
+        for (roughness, metallic, glow, alpha), index in self.materials.items():
+            # the ram image is in bgra order
+            struct.pack_into('4f', data, index*16, metallic, glow, roughness, alpha)
+        self.material_tex.set_ram_image(bytes(data))
+
+    def add_static(self, node):
+        """
+        Marks a node (and all its children) as static scene content,
+        call flatten_static() after adding all the static nodes
+        """
+        self.static_nodes.append(node)
+
+    def _get_texture_key(self, tex):
+        """
+        Returns a key that is the same for textures with the same content
+        """
+        if tex is None:
+            return None
+        key = (tex.get_name(), str(tex.get_fullpath()))
+        # generated textures (eg. from set_material) have no name,
+        # but they are small enough to compare the pixels
+        if tex.get_x_size()*tex.get_y_size() <= 32*32 and tex.has_ram_image():
+            key += (memoryview(tex.get_ram_image()).tobytes(),)
+        return key
+
+    def _get_static_group_key(self, node):
+        """
+        Returns the key used to group static nodes - the textures and material
+        index of the node and its shader with the other shader inputs,
+        and the render state without the texture inputs and material index
+        """
+        net_state = node.get_net_state()
+        textures = []
+        attrib = net_state.get_attrib(ShaderAttrib.get_class_type())
+        for texture_input in loader.texture_shader_inputs:
+            tex = None
+            if attrib is not None:
+                shader_input = attrib.get_shader_input(texture_input['input_name'])
+                if shader_input is not None:
+                    tex = shader_input.get_texture()
+                attrib = attrib.clear_shader_input(texture_input['input_name'])
+            textures.append(tex)
+        material_index = 0
+        if attrib is not None:
+            shader_input = attrib.get_shader_input('material_index')
+            if shader_input is not None:
+                material_index = int(shader_input.get_vector()[0])
+            attrib = attrib.clear_shader_input('material_index')
+            # what is left are the shader and the other inputs (eg. joint_table),
+            # attribs are unique so the same inputs give the same attrib
+            state = net_state.set_attrib(attrib)
+        else:
+            state = net_state
+        key = tuple(self._get_texture_key(tex) for tex in textures)+(material_index, attrib)
+        return key, textures, material_index, state
+
+    def flatten_static(self):
+        """
+        Groups the geometry of all the nodes added with add_static() by
+        their textures, copies each group under one node with the textures
+        set once for the whole group and flattens the groups.
+        Nodes with a shader other than the geometry shader (eg. skinned
+        actors) are copied with their full state but not flattened.
+        The original nodes are stashed (see clear_static()).
+        Prints and returns the number of Geoms (draw calls) before and after.
+        """
+        groups = {}
+        geoms_before = 0
+        unbatched = self.geometry_root.attach_new_node('static_unbatched')
+        geometry_shader = self.geometry_root.get_shader()
+        for node in self.static_nodes:
+            for geom_np in node.find_all_matches('**/+GeomNode'):
+                if geom_np.is_hidden():
+                    continue
+                geoms_before += geom_np.node().get_num_geoms()
+                net_shader = geom_np.get_net_state().get_attrib(ShaderAttrib.get_class_type())
+                if net_shader is not None and net_shader.get_shader() != geometry_shader:
+                    # flattening would move the vertices a custom shader
+                    # (eg. actor_buffer) expects in model space
+                    copy = unbatched.attach_new_node(geom_np.node().make_copy())
+                    copy.set_state(geom_np.get_net_state())
+                    copy.set_transform(geom_np.get_transform(self.geometry_root))
+                    continue
+                key, textures, material_index, state = self._get_static_group_key(geom_np)
+                if key not in groups:
+                    group = self.geometry_root.attach_new_node('static_group')
+                    for texture_input, tex in zip(loader.texture_shader_inputs, textures):
+                        if tex is None:
+                            tex = texture_input['default_texture']
+                        group.set_shader_input(texture_input['input_name'], tex)
+                    group.set_shader_input('material_index', material_index)
+                    groups[key] = group
+                # copy just the GeomNode, child GeomNodes get their own copy
+                copy = groups[key].attach_new_node(geom_np.node().make_copy())
+                # the texture inputs are set on the group, the rest of the
+                # inherited state (with the shader and its other inputs)
+                # is kept on the copy
+                copy.set_state(state)
+                copy.set_transform(geom_np.get_transform(self.geometry_root))
+        geoms_after = 0
+        for group in groups.values():
+            group.flatten_strong()
+            for geom_np in group.find_all_matches('**/+GeomNode'):
+                geoms_after += geom_np.node().get_num_geoms()
+            self.static_groups.append(group)
+        for geom_np in unbatched.find_all_matches('**/+GeomNode'):
+            geoms_after += geom_np.node().get_num_geoms()
+        self.static_groups.append(unbatched)
+        for node in self.static_nodes:
+            node.stash()
+        print('Static geometry: {0} Geoms before, {1} Geoms after, {2} groups, {3} not batched'.format(
+            geoms_before, geoms_after, len(groups), unbatched.get_num_children()))
+        return geoms_before, geoms_after
+
+    def clear_static(self):
+        """
+        Removes the flattened static groups and unstashes the original nodes
+        """
+        for group in self.static_groups:
+            group.remove_node()
+        self.static_groups = []
+        for node in self.static_nodes:
+            if not node.is_empty():
+                node.unstash()
+        self.static_nodes = []
 
     def set_near_far(self, near, far):
         base.cam.node().get_lens().set_near_far(near, far)
@@ -168,8 +472,8 @@ class DeferredRenderer(DirectObject):
 
         # remove buffers
         for buff in self.filter_buff.values():
-            buff.clear_render_textures()
-            base.win.get_gsg().get_engine().remove_window(buff)
+            self.remove_buffer(buff)
+            del self.buffer_sizes[buff.get_name()]
         # remove quads, but keep the last one (detach it)
         # the last one should also be self.lightbuffer.get_texture_card()
         # so we don't need to keep a reference to it
@@ -178,6 +482,7 @@ class DeferredRenderer(DirectObject):
         else:
             last_stage = self.filter_stages[-1]['shader']
         for name, quad in self.filter_quad.items():
+            self.forget_node_inputs(quad)
             if name != last_stage:
                 quad.remove_node()
             else:
@@ -189,7 +494,17 @@ class DeferredRenderer(DirectObject):
         self.filter_quad = {}
         self.filter_tex = {}
         self.filter_cam = {}
+        self.fused_stages = {}
+        self.filter_schedule = {}
         self.filter_stages = filter_setup
+        if shading_setup is None:
+            shading_setup = self.shading_setup
+        else:
+            shading_setup = dict(shading_setup)
+            if self.point_shadow_mode == 'paraboloid':
+                shading_setup['PARABOLOID_SHADOW'] = 1
+        if 'FUSE_FILTERS' in shading_setup:
+            self.filter_stages = self._fuse_filter_stages(filter_setup)
         for stage in self.filter_stages:
             self.add_filter(**stage)
         for name, tex in self.filter_tex.items():
@@ -209,6 +524,8 @@ class DeferredRenderer(DirectObject):
         self.filter_quad[last_stage] = self.lightbuffer.get_texture_card()
         self.reload_filter(last_stage)
         self.filter_quad[last_stage].reparent_to(render2d)
+        # the last stage renders to the window, every frame
+        self.filter_schedule.pop(last_stage, None)
 
         # reapply the directional lights
         self.set_filter_define(
@@ -226,18 +543,19 @@ class DeferredRenderer(DirectObject):
                 self.v.format('forward'), self.f.format('forward'), shading_setup))
             self.shading_setup=shading_setup
 
-        size=1
-        if 'FORWARD_SIZE' in self.shading_setup:
-            size= self.shading_setup['FORWARD_SIZE']
-        window_size = (base.win.get_x_size(), base.win.get_y_size())
-        self.plain_buff.set_size(int(window_size[0]*size), int(window_size[1]*size))
+        self._set_forward_size(self.render_size)
 
 
     def reload_filter(self, stage_name):
         """
         Reloads the shader and inputs of a given filter stage
         """
+        self.mark_changed()
+        stage_name = self.fused_stages.get(stage_name, stage_name)
         id = self._get_filter_stage_index(stage_name)
+        if 'levels' in self.filter_stages[id]:
+            self._reload_pyramid_filter(stage_name)
+            return
         shader = self.filter_stages[id]['shader']
         inputs = {}
         if 'inputs' in self.filter_stages[id]:
@@ -245,8 +563,15 @@ class DeferredRenderer(DirectObject):
         define = None
         if 'define' in self.filter_stages[id]:
             define = self.filter_stages[id]['define']
-        self.filter_quad[stage_name].set_shader(loader.load_shader_GLSL(
-            self.v.format(shader), self.f.format(shader), define))
+        translate_tex_name = self.filter_stages[id].get('translate_tex_name', None)
+        self.forget_node_inputs(self.filter_quad[stage_name])
+        if 'fuse' in self.filter_stages[id]:
+            self.filter_quad[stage_name].set_shader(self._load_fused_shader(
+                self.filter_stages[id]['fuse'], define, inputs, translate_tex_name))
+        else:
+            self.filter_quad[stage_name].set_shader(loader.load_shader_GLSL(
+                self.v.format(shader), self.f.format(shader),
+                self._get_stage_define(define, (shader,), inputs, translate_tex_name)))
         for name, value in inputs.items():
             if isinstance(value, str):
                 value = loader.load_texture(value)
@@ -269,6 +594,7 @@ class DeferredRenderer(DirectObject):
         """
         Returns the current value of a shader pre-processor define for a given filter stage
         """
+        stage_name = self.fused_stages.get(stage_name, stage_name)
         if stage_name in self.filter_quad:
             id = self._get_filter_stage_index(stage_name)
             if 'define' in self.filter_stages[id]:
@@ -281,6 +607,7 @@ class DeferredRenderer(DirectObject):
         Sets a define value for the shader pre-processor for a given filter stage,
         The shader for that filter stage gets reloaded, so no need to call reload_filter()
         """
+        stage_name = self.fused_stages.get(stage_name, stage_name)
         if stage_name in self.filter_quad:
             id = self._get_filter_stage_index(stage_name)
             if 'define' in self.filter_stages[id]:
@@ -294,6 +621,76 @@ class DeferredRenderer(DirectObject):
             # reload the shader
             self.reload_filter(stage_name)
 
+    def _get_stage_define(self, define, shaders=(), inputs=None, translate_tex_name=None):
+        """
+        Returns the defines for a filter stage shader,
+        the renderer wide self.filter_defines are added to the stage defines,
+        if shaders are given DISABLE_* defines are added for the parts of
+        these shaders that read textures no stage provides
+        """
+        disable_define = {}
+        for shader in shaders:
+            disable_define.update(self._get_disable_define(shader, inputs, translate_tex_name))
+        if not self.filter_defines and not disable_define:
+            return define
+        stage_define = dict(self.filter_defines)
+        stage_define.update(disable_define)
+        if define:
+            stage_define.update(define)
+        return stage_define
+
+    def _get_disable_define(self, shader, inputs=None, translate_tex_name=None):
+        """
+        Returns a dict of DISABLE_* defines for a filter shader.
+        A '#ifndef DISABLE_*' block that declares a sampler is disabled if
+        the sampler is not a common input, a stage input, a translated texture
+        name or the name of one of the filter stages
+        """
+        if shader not in self.disable_blocks:
+            blocks = {}
+            stack = []
+            for line in loader.read_shader_text(self.f.format(shader)).split('\n'):
+                line = line.strip()
+                if line.startswith('#if'):
+                    words = line.split()
+                    if words[0] == '#ifndef' and words[1].startswith('DISABLE_'):
+                        stack.append(words[1])
+                    else:
+                        stack.append(None)
+                elif line.startswith('#endif') and stack:
+                    stack.pop()
+                elif line.startswith('uniform sampler') and stack and stack[-1]:
+                    blocks.setdefault(stack[-1], []).append(line.rstrip(';').split()[-1])
+            self.disable_blocks[shader] = blocks
+        available = set(self.base_inputs)
+        for stage in self.filter_stages:
+            available.add(self._get_stage_name(stage))
+        if inputs:
+            available.update(inputs)
+        if translate_tex_name:
+            available.update(translate_tex_name.values())
+        define = {}
+        for name, samplers in self.disable_blocks[shader].items():
+            for sampler in samplers:
+                if sampler not in available:
+                    define[name] = 1
+        return define
+
+    def get_hiz_texture(self, level=0, extract=False):
+        """
+        Returns the texture of a level of the hierarchical depth pyramid
+        (min depth in the red channel, max depth in the green channel).
+        With extract=True the texture is copied back to ram so it can be
+        read on the cpu (eg. with Texture.peek()) - this stalls the gpu,
+        so only do it for the small, high levels
+        """
+        if level >= len(self.hiz_tex):
+            return None
+        tex = self.hiz_tex[level]
+        if extract:
+            base.graphicsEngine.extract_texture_data(tex, base.win.get_gsg())
+        return tex
+
     def _get_filter_stage_index(self, name):
         """
         Returns the index of a filter stage
@@ -310,6 +707,7 @@ class DeferredRenderer(DirectObject):
         """
         Returns the shader input from a given stage
         """
+        stage_name = self.fused_stages.get(stage_name, stage_name)
         if stage_name in self.filter_quad:
             id = self._get_filter_stage_index(stage_name)
             return self.filter_quad[stage_name].get_shader_input(str(name))
@@ -321,6 +719,7 @@ class DeferredRenderer(DirectObject):
         modify_using - should be an operator, like operator.add if you want to
                        change the value of an input based on the current value
         """
+        stage_name = self.fused_stages.get(stage_name, stage_name)
         if stage_name in self.filter_quad:
             id = self._get_filter_stage_index(stage_name)
             if name is None:
@@ -341,27 +740,117 @@ class DeferredRenderer(DirectObject):
                     tex.set_wrap_u(Texture.WMClamp)
                     tex.set_wrap_v(Texture.WMClamp)
                 value=tex
-            self.filter_quad[stage_name].set_shader_input(str(name), value)
+            self.set_node_input(self.filter_quad[stage_name], str(name), value)
             # print(stage_name, name, value)
 
+    def set_node_input(self, node, name, value):
+        """
+        Sets a shader input on a node, unless this function already
+        set the same value on that node. Use this for inputs that might get
+        set to the same value every frame, see get_input_stats()
+        """
+        value_key = self._get_input_key(value)
+        node_inputs = self.node_inputs.setdefault(node.get_key(), {})
+        if name in node_inputs and node_inputs[name] == value_key:
+            self.input_stats['skipped'] += 1
+            return
+        node.set_shader_input(name, value)
+        node_inputs[name] = value_key
+        self.input_stats['applied'] += 1
+
+    def _get_input_key(self, value):
+        """
+        Returns a copy of a shader input value that can be compared
+        with ==, vectors, matrices and arrays become tuples
+        """
+        if isinstance(value, (int, float, str)):
+            return value
+        try:
+            return tuple(self._get_input_key(item) for item in value)
+        except TypeError:
+            # textures, nodes
+            return value
+
+    def forget_node_inputs(self, node):
+        """
+        Forgets the values set with set_node_input() for a node,
+        call it after setting inputs on the node some other way
+        """
+        self.node_inputs.pop(node.get_key(), None)
+
+    def get_input_stats(self):
+        """
+        Returns a dict with the number of set_node_input() calls
+        that were applied and that were skipped in the last frame
+        """
+        return dict(self.last_input_stats)
+
     def _get_win_depth_bits(self):
         fbprops=base.win.get_fb_properties()
         return fbprops.get_depth_bits()
 
+    def gbuffer_report(self):
+        """
+        Prints and returns the size (in bytes per pixel) of the geometry buffer
+        targets for the default and compact (COMPACT_GBUFFER 10 or 8) layouts.
+        Every light and fullscreen filter that reads the geometry buffer reads
+        up to this much memory per pixel
+        """
+        depth_bits = self._get_win_depth_bits()
+        # 24 bit depth is stored in 32 bits
+        depth_bytes = 2 if depth_bits == 16 else 4
+        layouts = [('default', {'depth': depth_bytes, 'albedo': 4, 'normal': 8}),
+                   ('rgb10a2', {'depth': depth_bytes, 'albedo': 4, 'normal': 4}),
+                   ('rgba8', {'depth': depth_bytes, 'albedo': 4, 'normal': 4})]
+        current = {10: 'rgb10a2', 8: 'rgba8'}.get(self.shading_setup.get('COMPACT_GBUFFER'), 'default')
+        num_pixels = base.win.get_x_size() * base.win.get_y_size()
+        default_size = sum(layouts[0][1].values())
+        report = {}
+        print('G-buffer layout at {0}x{1}:'.format(base.win.get_x_size(), base.win.get_y_size()))
+        for name, targets in layouts:
+            size = sum(targets.values())
+            report[name] = size
+            print('{0:>8}{1} depth {2} + albedo {3} + normal {4} = {5} bytes/pixel, {6:.2f} MB per fullscreen read ({7:.0f}% of default)'.format(
+                name, '*' if name == current else ' ',
+                targets['depth'], targets['albedo'], targets['normal'], size,
+                size * num_pixels / (1024.0 * 1024.0), 100.0 * size / default_size))
+        return report
+
     def _setup_g_buffer(self, define=None):
         """
         Creates all the needed buffers, nodes and attributes for a geometry buffer
         """
         depth_bits=self._get_win_depth_bits()
-        self.modelbuffer = self._make_FBO(name="model buffer", auxrgba=1, depth_bits=depth_bits)
-        self.lightbuffer = self._make_FBO(name="light buffer", auxrgba=0, depth_bits=depth_bits)
+        # the compact layout packs the normal buffer into 32 bits
+        # and uses a 24 bit depth buffer when the window allows it
+        compact = 0
+        if 'COMPACT_GBUFFER' in define:
+            compact = define['COMPACT_GBUFFER']
+            if depth_bits > 24:
+                depth_bits = 24
+        # stencil light volumes need a depth-stencil buffer shared
+        # by the model buffer and the light buffer
+        stencil = 'STENCIL_LIGHTS' in define
+        stencil_bits = 0
+        if stencil:
+            depth_bits = 24
+            stencil_bits = 8
+        self.modelbuffer = self._make_FBO(name="model buffer", auxrgba=1,
+                                          depth_bits=depth_bits, aux_float=not compact,
+                                          stencil_bits=stencil_bits)
+        self.lightbuffer = self._make_FBO(name="light buffer", auxrgba=0,
+                                          depth_bits=depth_bits, stencil_bits=stencil_bits)
+        self._add_buffer_size(self.modelbuffer, 1.0)
+        self._add_buffer_size(self.lightbuffer, 1.0)
 
         # Create four render textures: depth, normal, albedo, and final.
         # attach them to the various bitplanes of the offscreen buffers.
         self.depth = Texture()
         self.depth.set_wrap_u(Texture.WM_clamp)
         self.depth.set_wrap_v(Texture.WM_clamp)
-        if depth_bits==32:
+        if stencil:
+            self.depth.set_format(Texture.F_depth_stencil)
+        elif depth_bits==32:
             self.depth.set_format(Texture.F_depth_component32)
         elif depth_bits==24:
             self.depth.set_format(Texture.F_depth_component24)
@@ -369,28 +858,47 @@ class DeferredRenderer(DirectObject):
             self.depth.set_format(Texture.F_depth_component16)
         else:
             self.depth.set_format(Texture.F_depth_component)
-        self.depth.set_component_type(Texture.T_float)
+        if not compact and not stencil:
+            self.depth.set_component_type(Texture.T_float)
         self.albedo = Texture()
         self.albedo.set_wrap_u(Texture.WM_clamp)
         self.albedo.set_wrap_v(Texture.WM_clamp)
         self.normal = Texture()
-        self.normal.set_format(Texture.F_rgba16)
-        self.normal.set_component_type(Texture.T_float)
+        if compact == 8:
+            self.normal.set_format(Texture.F_rgba8)
+            self.normal_bitplane = GraphicsOutput.RTP_aux_rgba_0
+        elif compact:
+            self.normal.set_format(Texture.F_rgb10_a2)
+            self.normal_bitplane = GraphicsOutput.RTP_aux_rgba_0
+        else:
+            self.normal.set_format(Texture.F_rgba16)
+            self.normal.set_component_type(Texture.T_float)
+            self.normal_bitplane = GraphicsOutput.RTP_aux_hrgba_0
         #self.normal.set_magfilter(SamplerState.FT_linear)
         #self.normal.set_minfilter(SamplerState.FT_linear_mipmap_linear)
         self.lit_tex = Texture()
         self.lit_tex.set_wrap_u(Texture.WM_clamp)
         self.lit_tex.set_wrap_v(Texture.WM_clamp)
 
-        self.modelbuffer.add_render_texture(tex=self.depth,
-                                          mode=GraphicsOutput.RTMBindOrCopy,
-                                          bitplane=GraphicsOutput.RTPDepth)
+        if stencil:
+            # the light buffer only tests against the scene depth,
+            # it never writes to it
+            self.modelbuffer.add_render_texture(tex=self.depth,
+                                              mode=GraphicsOutput.RTMBindOrCopy,
+                                              bitplane=GraphicsOutput.RTPDepthStencil)
+            self.lightbuffer.add_render_texture(tex=self.depth,
+                                              mode=GraphicsOutput.RTMBindOrCopy,
+                                              bitplane=GraphicsOutput.RTPDepthStencil)
+        else:
+            self.modelbuffer.add_render_texture(tex=self.depth,
+                                              mode=GraphicsOutput.RTMBindOrCopy,
+                                              bitplane=GraphicsOutput.RTPDepth)
         self.modelbuffer.add_render_texture(tex=self.albedo,
                                           mode=GraphicsOutput.RTMBindOrCopy,
                                           bitplane=GraphicsOutput.RTPColor)
         self.modelbuffer.add_render_texture(tex=self.normal,
                                           mode=GraphicsOutput.RTMBindOrCopy,
-                                          bitplane=GraphicsOutput.RTP_aux_hrgba_0)
+                                          bitplane=self.normal_bitplane)
         self.lightbuffer.add_render_texture(tex=self.lit_tex,
                                           mode=GraphicsOutput.RTMBindOrCopy,
                                           bitplane=GraphicsOutput.RTPColor)
@@ -441,7 +949,12 @@ class DeferredRenderer(DirectObject):
         self.lightbuffer.set_clear_color_active(1)
         self.lightbuffer.set_clear_color((0, 0, 0, 0))
         self.modelbuffer.set_clear_color((0, 0, 0, 0))
-        self.modelbuffer.set_clear_active(GraphicsOutput.RTP_aux_hrgba_0, True)
+        self.modelbuffer.set_clear_active(self.normal_bitplane, True)
+        if stencil:
+            self.modelbuffer.set_clear_stencil_active(1)
+            self.modelbuffer.set_clear_stencil(0)
+            self.lightbuffer.set_clear_depth_active(0)
+            self.lightbuffer.set_clear_stencil_active(0)
 
         render.set_state(RenderState.make_empty())
 
@@ -470,6 +983,12 @@ class DeferredRenderer(DirectObject):
         self.geometry_root.set_shader(loader.load_shader_GLSL(
             self.v.format('geometry'), self.f.format('geometry'), define))
         self.geometry_root.hide(BitMask32.bit(self.lightMask))
+        try:
+            self.geometry_root.set_shader_inputs(material_table=self.material_tex,
+                                                 material_index=0)
+        except AttributeError:
+            self.geometry_root.set_shader_input('material_table', self.material_tex)
+            self.geometry_root.set_shader_input('material_index', 0)
         # self.geometry_root.hide(BitMask32(self.plainMask))
 
         self.plain_root, self.plain_tex, self.plain_cam, self.plain_buff, self.plain_aux = self._make_forward_stage(define)
@@ -487,11 +1006,156 @@ class DeferredRenderer(DirectObject):
         builtins.deferred_render = self.geometry_root
         builtins.forward_render = self.plain_root
 
+    def _setup_depth_pyramid(self, levels):
+        """
+        Creates buffers for a hierarchical min/max depth pyramid,
+        each level is half the size of the previous one, level 0 is
+        half the size of the depth buffer. The pyramid is rendered once
+        per frame after the geometry buffer, before the light buffer
+        """
+        self.filter_defines['HIZ_LEVELS'] = int(levels)
+        source = self.depth
+        for level in range(int(levels)):
+            # sort 1 is the same as the model buffer, buffers with the same
+            # sort render in the order they were created
+            quad, tex, buff, cam = self._make_filter_stage(sort=1,
+                                                           size=0.5**(level+1),
+                                                           clear_color=None,
+                                                           name='hiz_{0}'.format(level),
+                                                           rgba_bits=(32, 32, 0, 0),
+                                                           float_color=True)
+            tex.set_magfilter(SamplerState.FT_nearest)
+            tex.set_minfilter(SamplerState.FT_nearest)
+            if level == 0:
+                define = {'FROM_DEPTH': 1}
+            else:
+                define = None
+            quad.set_shader(loader.load_shader_GLSL(self.v.format(
+                'depth_pyramid'), self.f.format('depth_pyramid'), define))
+            quad.set_shader_input('input_tex', source)
+            source = tex
+            self.hiz_tex.append(tex)
+            self.prepass_buff.append(buff)
+            self._add_buffer_size(buff, 0.5**(level+1))
+
+    def _setup_view_pos_prepass(self):
+        """
+        Creates a buffer that holds the view space position of each pixel,
+        reconstructed once per frame from the depth buffer after the
+        geometry buffer is rendered. Shaders compiled with the VIEW_POS_PREPASS
+        define read it (view_pos_tex) instead of reconstructing the position
+        from depth on their own
+        """
+        self.filter_defines['VIEW_POS_PREPASS'] = 1
+        quad, tex, buff, cam = self._make_filter_stage(sort=1,
+                                                       size=1.0,
+                                                       clear_color=None,
+                                                       name='view_pos',
+                                                       rgba_bits=(32, 32, 32, 0),
+                                                       float_color=True)
+        tex.set_magfilter(SamplerState.FT_nearest)
+        tex.set_minfilter(SamplerState.FT_nearest)
+        quad.set_shader(loader.load_shader_GLSL(self.v.format(
+            'view_pos'), self.f.format('view_pos')))
+        quad.set_shader_input('depth_tex', self.depth)
+        quad.set_shader_input('camera', base.cam)
+        self.light_root.set_shader_input('view_pos_tex', tex)
+        self.view_pos_tex = tex
+        self._add_buffer_size(buff, 1.0)
+        self.prepass_buff.append(buff)
+
+    def _setup_forward_depth(self):
+        """
+        Creates a buffer with the depth downsampled to the size of the
+        forward buffer (FORWARD_SIZE), min depth in red, max depth in green.
+        The forward pass tests against the max depth, the compose stage
+        uses it for depth aware upsampling of the forward buffer
+        (FORWARD_UPSAMPLE define)
+        """
+        size = 1.0
+        if 'FORWARD_SIZE' in self.shading_setup:
+            size = self.shading_setup['FORWARD_SIZE']
+        self.filter_defines['FORWARD_UPSAMPLE'] = 1
+        quad, tex, buff, cam = self._make_filter_stage(sort=1,
+                                                       size=size,
+                                                       clear_color=None,
+                                                       name='forward_depth',
+                                                       rgba_bits=(32, 32, 0, 0),
+                                                       float_color=True)
+        tex.set_magfilter(SamplerState.FT_nearest)
+        tex.set_minfilter(SamplerState.FT_nearest)
+        quad.set_shader(loader.load_shader_GLSL(self.v.format('depth_pyramid'),
+                                                self.f.format('depth_pyramid'),
+                                                {'FROM_DEPTH': 1,
+                                                 'FOOTPRINT': max(int(round(1.0/size)), 1)}))
+        quad.set_shader_input('input_tex', self.depth)
+        self.plain_root.set_shader_input('depth_tex', tex)
+        self.forward_depth_tex = tex
+        # resized with the forward buffer, the sizes must match
+        self.forward_depth_buff = buff
+
+    def _setup_forward_oit(self):
+        """
+        Sets up weighted blended order independent transparency
+        (McGuire and Bavoil 2013) for the forward pass.
+        The forward buffer accumulates color*alpha*weight in rgb and the
+        product of (1-alpha) in alpha, the aux target accumulates alpha*weight.
+        Everything is additive, so forward_render is drawn unsorted.
+        A resolve stage turns that into a premultiplied color for the
+        compose stage (forward_tex)
+        """
+        self.filter_defines['FORWARD_OIT'] = 1
+        self.plain_root.set_bin('unsorted', 0, 1)
+        self.plain_root.set_depth_write(False, 1)
+        self.plain_root.set_transparency(TransparencyAttrib.M_none, 1)
+        self.plain_root.set_attrib(ColorBlendAttrib.make(ColorBlendAttrib.M_add,
+                                                         ColorBlendAttrib.O_one,
+                                                         ColorBlendAttrib.O_one,
+                                                         ColorBlendAttrib.M_add,
+                                                         ColorBlendAttrib.O_zero,
+                                                         ColorBlendAttrib.O_one_minus_incoming_alpha), 1)
+        size = 1.0
+        if 'FORWARD_SIZE' in self.shading_setup:
+            size = self.shading_setup['FORWARD_SIZE']
+        # sort 2 - after the forward buffer, before the filter stages that read it
+        quad, tex, buff, cam = self._make_filter_stage(sort=2,
+                                                       size=size,
+                                                       clear_color=None,
+                                                       name='forward_resolve',
+                                                       rgba_bits=(16, 16, 16, 16),
+                                                       float_color=True)
+        quad.set_shader(loader.load_shader_GLSL(self.v.format('forward_resolve'),
+                                                self.f.format('forward_resolve')))
+        try:
+            quad.set_shader_inputs(accum_tex=self.plain_tex,
+                                   reveal_tex=self.plain_aux)
+        except AttributeError:
+            quad.set_shader_input('accum_tex', self.plain_tex)
+            quad.set_shader_input('reveal_tex', self.plain_aux)
+        self.forward_resolve_tex = tex
+        self.forward_resolve_buff = buff
+
+    def _set_forward_size(self, window_size):
+        """
+        Resizes the forward buffer and the buffers that must match its size
+        """
+        size = 1
+        if 'FORWARD_SIZE' in self.shading_setup:
+            size = self.shading_setup['FORWARD_SIZE']
+        buff_size = (int(window_size[0]*size), int(window_size[1]*size))
+        self.plain_buff.set_size(*buff_size)
+        if self.forward_depth_tex:
+            self.forward_depth_buff.set_size(*buff_size)
+        if self.forward_resolve_tex:
+            self.forward_resolve_buff.set_size(*buff_size)
+
     def _on_window_event(self, window):
         """
         Function called when something hapens to the main window
         Currently it's only function is to resize all the buffers to fit
-        the new size of the window if the size of the window changed
+        the new size of the window if the size of the window changed.
+        The lens is updated at once, but the buffers are only resized
+        once the window stops changing for RESIZE_DELAY seconds (0.25 default)
         """
         if window is not None:
             window_size = (base.win.get_x_size(), base.win.get_y_size())
@@ -501,48 +1165,102 @@ class DeferredRenderer(DirectObject):
                 self.modelcam.node().set_lens(lens)
                 self.lightcam.node().set_lens(lens)
                 self.plain_cam.node().set_lens(lens)
-
-                self.modelbuffer.set_size(window_size[0], window_size[1])
-                self.lightbuffer.set_size(window_size[0], window_size[1])
-                #fix here!
-                size=1
-                if 'FORWARD_SIZE' in self.shading_setup:
-                    size= self.shading_setup['FORWARD_SIZE']
-                self.plain_buff.set_size(int(window_size[0]*size), int(window_size[1]*size))
-                for buff in self.filter_buff.values():
-                    old_size = buff.get_fb_size()
-                    x_factor = float(old_size[0]) / \
-                        float(self.last_window_size[0])
-                    y_factor = float(old_size[1]) / \
-                        float(self.last_window_size[1])
-                    buff.set_size(
-                        int(window_size[0] * x_factor), int(window_size[1] * y_factor))
                 self.last_window_size = window_size
 
+                delay = 0.25
+                if 'RESIZE_DELAY' in self.shading_setup:
+                    delay = self.shading_setup['RESIZE_DELAY']
+                taskMgr.remove('deferred_resize_tsk')
+                taskMgr.doMethodLater(delay, self._resize_buffers, 'deferred_resize_tsk')
+
+    def _get_render_size(self, window_size):
+        """
+        Returns the size the buffers are made for, the window size
+        rounded up to a multiple of RESIZE_ROUND pixels or to a power of two
+        if RESIZE_ROUND is 'pow2'. The last filter stage scales the
+        image to the window, so small resizes don't reallocate the buffers.
+        """
+        if 'RESIZE_ROUND' not in self.shading_setup:
+            return window_size
+        step = self.shading_setup['RESIZE_ROUND']
+        size = []
+        for value in window_size:
+            if step == 'pow2':
+                size.append(2**int(math.ceil(math.log(max(value, 1), 2))))
+            else:
+                size.append(int(math.ceil(value/float(step)))*int(step))
+        return tuple(size)
+
+    def _add_buffer_size(self, buff, size):
+        """
+        Remembers the size factor of a buffer, it's resized to that
+        fraction of the render size
+        """
+        self.buffer_sizes[buff.get_name()] = (buff, size)
+
+    def _resize_buffers(self, task=None):
+        """
+        Resizes the buffers for the current window size, buffers are sized
+        from their size factor, not from their last size and only buffers
+        that need a new size get one
+        """
+        render_size = self._get_render_size(self.last_window_size)
+        if render_size == self.render_size:
+            return
+        self.render_size = render_size
+        for buff, size in self.buffer_sizes.values():
+            buff_size = (max(int(render_size[0]*size), 1), max(int(render_size[1]*size), 1))
+            if tuple(buff.get_fb_size()) != buff_size:
+                buff.set_size(*buff_size)
+        self._set_forward_size(render_size)
+        # the new textures are empty until every stage rendered once
+        if self.filter_schedule:
+            self.refresh_filters()
+
     def add_filter(self, shader, inputs={},
                    name=None, size=1.0,
                    clear_color=(0, 0, 0, 0), translate_tex_name=None,
-                   define=None):
+                   define=None, levels=None, fuse=None,
+                   update_every=1, phase=None):
         """
         Creates and adds filter stage to the filter stage dicts:
         the created buffer is put in self.filter_buff[name]
         the created fullscreen quad is put in self.filter_quad[name]
         the created fullscreen texture is put in self.filter_tex[name]
         the created camera is put in self.filter_cam[name]
+        If levels is set, the stage is a mip-chain pyramid (see _add_pyramid_filter)
+        If fuse is set, the stage runs the shaders of several fused stages (see _fuse_filter_stages)
+        If update_every is more than 1, the stage is only rendered every
+        update_every frames, on frames where frame_number % update_every == phase,
+        if phase is None (or 'auto') a phase is picked to spread the cost of
+        all such stages evenly across frames (see _update_filter_schedule)
         """
         #print(inputs)
         if name is None:
             name = shader
-        index = len(self.filter_buff)
-        quad, tex, buff, cam = self._make_filter_stage(
-            sort=index, size=size, clear_color=clear_color, name=name)
-        self.filter_buff[name] = buff
-        self.filter_quad[name] = quad
-        self.filter_tex[name] = tex
-        self.filter_cam[name] = cam
-
-        quad.set_shader(loader.load_shader_GLSL(self.v.format(
-            shader), self.f.format(shader), define))
+        if update_every and int(update_every) > 1:
+            old_buffers = set(self.filter_buff)
+            self.add_filter(shader=shader, inputs=inputs, name=name, size=size,
+                            clear_color=clear_color, translate_tex_name=translate_tex_name,
+                            define=define, levels=levels, fuse=fuse)
+            self._add_filter_schedule(name, [buff_name for buff_name in self.filter_buff
+                                             if buff_name not in old_buffers],
+                                      int(update_every), phase, size)
+            return
+        if levels:
+            self._add_pyramid_filter(shader=shader, inputs=inputs, name=name,
+                                     size=size, clear_color=clear_color,
+                                     translate_tex_name=translate_tex_name,
+                                     define=define, levels=levels)
+            return
+        quad, tex = self._add_filter_buffer(name=name, size=size, clear_color=clear_color)
+
+        if fuse:
+            quad.set_shader(self._load_fused_shader(fuse, define, inputs, translate_tex_name))
+        else:
+            quad.set_shader(loader.load_shader_GLSL(self.v.format(
+                shader), self.f.format(shader),
+                self._get_stage_define(define, (shader,), inputs, translate_tex_name)))
         for name, value in inputs.items():
             if isinstance(value, str):
                 value = loader.load_texture(value, sRgb=loader.use_srgb)
@@ -559,7 +1277,460 @@ class DeferredRenderer(DirectObject):
                 value = self.filter_tex[old_name]
                 quad.set_shader_input(str(new_name), value)
 
-    def _make_filter_stage(self, sort=0, size=1.0, clear_color=None, name=None):
+    def _add_filter_schedule(self, name, buffer_names, update_every, phase, size):
+        """
+        Adds the buffers of a filter stage to the update schedule
+        """
+        if phase is None or phase == 'auto':
+            # the cost of a stage is about its area in pixels
+            phase = self._get_auto_phase(update_every, size*size)
+        self.filter_schedule[name] = {'buffers': buffer_names,
+                                      'update_every': update_every,
+                                      'phase': int(phase) % update_every,
+                                      'cost': size*size}
+
+    def _get_auto_phase(self, update_every, cost):
+        """
+        Returns the phase for a new scheduled stage that keeps the
+        most expensive frame as cheap as possible
+        """
+        period = update_every
+        for item in self.filter_schedule.values():
+            # least common multiple
+            a, b = period, item['update_every']
+            while b:
+                a, b = b, a % b
+            period = period * item['update_every'] // a
+        frame_cost = [0.0]*period
+        for item in self.filter_schedule.values():
+            for frame in range(item['phase'], period, item['update_every']):
+                frame_cost[frame] += item['cost']
+        best_phase = 0
+        best_cost = None
+        for phase in range(update_every):
+            cost_with = max(frame_cost[frame]+cost for frame in range(phase, period, update_every))
+            if best_cost is None or cost_with < best_cost:
+                best_phase = phase
+                best_cost = cost_with
+        return best_phase
+
+    def _update_filter_schedule(self):
+        """
+        Turns scheduled filter stage buffers on and off for this frame
+        """
+        frame = globalClock.get_frame_count()
+        for item in self.filter_schedule.values():
+            active = self.refresh_all_filters or frame % item['update_every'] == item['phase']
+            for buff_name in item['buffers']:
+                self.filter_buff[buff_name].set_active(active)
+        self.refresh_all_filters = False
+
+    def set_render_on_demand(self, enable=True):
+        """
+        When enabled, the offscreen buffers (g-buffer, lights, forward,
+        filters, shadows) stop rendering once nothing changed for a few
+        frames, the window keeps showing the last image and the frame rate
+        is limited to IDLE_FRAME_RATE (30 default).
+        Changes are found by comparing the camera, lens and window size,
+        from the bounds of deferred_render, forward_render and the lights
+        going stale (anything moved, shown, hidden, added or removed under
+        them), from set_node_input() and from the joint table.
+        Use mark_changed() for anything else (eg. set_color(), changing a
+        texture image) and add_idle_check() for things like camera controlers.
+        """
+        self.render_on_demand = enable
+        taskMgr.remove('_idle_tsk')
+        if enable:
+            self.mark_changed()
+            # after the tasks that move things, before rendering
+            taskMgr.add(self._update_idle, '_idle_tsk', sort=48)
+        elif self.idle:
+            self._wake()
+
+    def mark_changed(self):
+        """
+        Tells the render on demand mode that the next frame needs rendering
+        """
+        self.scene_changed = True
+
+    def add_idle_check(self, check):
+        """
+        Adds a function that returns False while something that the
+        render on demand mode can't see is changing (eg. CameraControler.is_idle)
+        """
+        self.idle_checks.append(check)
+
+    def is_idle(self):
+        """
+        True if the render on demand mode stopped rendering
+        """
+        return self.idle
+
+    def _get_scene_state(self):
+        """
+        Returns the camera state to compare with the last frame
+        """
+        return (base.cam.get_net_transform(),
+                tuple(base.cam.node().get_lens().get_projection_mat()),
+                self.last_window_size)
+
+    def _is_scene_graph_changed(self):
+        """
+        True if anything under the roots moved, was shown, hidden, added
+        or removed since the last call. Panda marks the bounds of all
+        the parents of a changed node stale, so only the roots are checked
+        """
+        changed = False
+        for root in (self.geometry_root, self.plain_root, self.light_root):
+            if root.node().is_bounds_stale():
+                changed = True
+                # recomputes the bounds and clears the flag
+                root.node().get_bounds()
+        return changed
+
+    def _update_idle(self, task):
+        scene_state = self._get_scene_state()
+        changed = (self._is_scene_graph_changed()
+                   or self.scene_changed
+                   or scene_state != self.last_scene_state
+                   or self.input_stats['applied'] > 0
+                   or self.joint_table_changed)
+        for check in self.idle_checks:
+            if not check():
+                changed = True
+        self.last_scene_state = scene_state
+        self.scene_changed = False
+        if changed:
+            self.idle_frames = 0
+            if self.idle:
+                self._wake()
+        else:
+            self.idle_frames += 1
+            # stages with update_every need a few frames to catch up
+            wait = 2
+            for item in self.filter_schedule.values():
+                wait = max(wait, item['update_every']+1)
+            if not self.idle and self.idle_frames > wait:
+                self._go_idle()
+        return task.again
+
+    def _get_own_buffers(self):
+        """
+        Returns all the offscreen buffers of the renderer and of the lights
+        """
+        buffers = [self.modelbuffer, self.lightbuffer, self.plain_buff]
+        for name in ('forward_depth_buff', 'forward_resolve_buff'):
+            if getattr(self, name, None) is not None:
+                buffers.append(getattr(self, name))
+        buffers += self.prepass_buff
+        buffers += list(self.filter_buff.values())
+        for p3d_light in render.find_all_matches('**/+LightLensNode'):
+            buff = self.get_light_shadow_buffer(p3d_light)
+            if buff:
+                buffers.append(buff)
+            if p3d_light.has_python_tag('shadow_prefilter'):
+                buffers.append(p3d_light.get_python_tag('shadow_prefilter'))
+        return buffers
+
+    def _go_idle(self):
+        """
+        Stops the offscreen buffers of the renderer, the window still
+        shows the last image
+        """
+        self.idle = True
+        self.idle_buffers = []
+        for buff in self._get_own_buffers():
+            if buff.is_active():
+                buff.set_active(False)
+                self.idle_buffers.append(buff)
+        rate = 30
+        if 'IDLE_FRAME_RATE' in self.shading_setup:
+            rate = self.shading_setup['IDLE_FRAME_RATE']
+        self.idle_clock_mode = globalClock.get_mode()
+        globalClock.set_mode(ClockObject.M_limited)
+        globalClock.set_frame_rate(rate)
+
+    def _wake(self):
+        """
+        Starts the buffers stopped by _go_idle()
+        """
+        self.idle = False
+        for window in self.idle_buffers:
+            window.set_active(True)
+        self.idle_buffers = []
+        if self.idle_clock_mode is not None:
+            globalClock.set_mode(self.idle_clock_mode)
+            self.idle_clock_mode = None
+        if self.filter_schedule:
+            # stages that are not rendered every frame still hold the old image
+            self.refresh_filters()
+            self._update_filter_schedule()
+
+    def refresh_filters(self):
+        """
+        Makes all the filter stages that are not rendered every frame
+        render in the next frame (eg. after a camera cut)
+        """
+        self.refresh_all_filters = True
+        for item in self.filter_schedule.values():
+            for buff_name in item['buffers']:
+                self.filter_buff[buff_name].set_active(True)
+
+    def _fuse_filter_stages(self, filter_setup):
+        """
+        Returns a copy of the filter_setup where consecutive stages that can be
+        run as one shader are fused into one stage.
+        A stage can be fused with the stage before it if it only reads the
+        output of that stage at the current pixel (texture(input_tex, uv)),
+        both stages have the same size and nothing else reads the output
+        of the first stage. The fused stage takes the name of the last stage,
+        names of the other stages are kept as aliases in self.fused_stages
+        """
+        stages = []
+        for stage in filter_setup:
+            if stages:
+                fused = self._try_fuse_stages(stages[-1], stage, filter_setup)
+                if fused:
+                    stages[-1] = fused
+                    continue
+            stages.append(stage)
+        return stages
+
+    def _get_stage_name(self, stage):
+        if 'name' in stage:
+            return stage['name']
+        return stage['shader']
+
+    def _try_fuse_stages(self, first, second, filter_setup):
+        """
+        Returns a stage dict with 'second' fused into 'first',
+        or None if they can't be fused. The decision is printed
+        """
+        first_name = self._get_stage_name(first)
+        second_name = self._get_stage_name(second)
+        try:
+            for stage in (first, second):
+                if 'levels' in stage:
+                    raise FusionError(self._get_stage_name(stage)+' is a pyramid stage')
+            if first.get('size', 1.0) != second.get('size', 1.0):
+                raise FusionError('the stages have different sizes')
+            if first.get('update_every', 1) != second.get('update_every', 1):
+                raise FusionError('the stages are updated at different rates')
+            # how does the second stage read the first one?
+            translate = dict(second.get('translate_tex_name', {}))
+            link = translate.pop(first_name, first_name)
+            # the output of the first stage can't be used anywhere else
+            for stage in filter_setup:
+                if stage is second or stage is first:
+                    continue
+                if first_name in stage.get('translate_tex_name', {}):
+                    raise FusionError(self._get_stage_name(stage)+' also reads '+first_name)
+                if re.search(r'sampler2D\s+'+first_name+r'\b',
+                             loader.read_shader_text(self.f.format(stage['shader']))):
+                    raise FusionError(self._get_stage_name(stage)+' also reads '+first_name)
+            # merge inputs, defines and texture names
+            inputs = dict(first.get('inputs', {}))
+            for name, value in second.get('inputs', {}).items():
+                if name in inputs and inputs[name] != value:
+                    raise FusionError('both stages set the input '+name)
+                inputs[name] = value
+            define = dict(first.get('define') or {})
+            for name, value in (second.get('define') or {}).items():
+                if name in define and define[name] != value:
+                    raise FusionError('both stages set the define '+name)
+                define[name] = value
+            # the defines of one stage can't change the code of the other
+            fuse = list(first.get('fuse', [(first['shader'], None)]))
+            for name in define:
+                for stage, shaders in ((first, [second['shader']]),
+                                       (second, [shader for shader, link in fuse])):
+                    if name in (stage.get('define') or {}):
+                        continue
+                    for shader in shaders:
+                        if re.search(r'\b'+name+r'\b', loader.read_shader_text(self.f.format(shader))):
+                            raise FusionError('the define '+name+' would change '+shader)
+            translate_tex_name = dict(first.get('translate_tex_name', {}))
+            for name, value in translate.items():
+                if value in translate_tex_name.values():
+                    raise FusionError('both stages use the texture name '+value)
+                translate_tex_name[name] = value
+            fuse.append((second['shader'], link))
+            # check if it compiles to one shader
+            self._make_fused_shader_text(fuse, define, inputs, translate_tex_name)
+        except FusionError as e:
+            print('Filter stages {0} and {1} not fused: {2}'.format(first_name, second_name, e))
+            return None
+        fused = {'name': second_name,
+                 'shader': second['shader'],
+                 'fuse': fuse,
+                 'inputs': inputs,
+                 'size': second.get('size', 1.0),
+                 'translate_tex_name': translate_tex_name}
+        if define:
+            fused['define'] = define
+        if 'clear_color' in second:
+            fused['clear_color'] = second['clear_color']
+        for key in ('update_every', 'phase'):
+            if key in second:
+                fused[key] = second[key]
+        for name, alias in list(self.fused_stages.items()):
+            if alias == first_name:
+                self.fused_stages[name] = second_name
+        self.fused_stages[first_name] = second_name
+        print('Filter stages {0} and {1} fused into {1}'.format(first_name, second_name))
+        return fused
+
+    def _make_fused_shader_text(self, fuse, define, inputs=None, translate_tex_name=None):
+        """
+        Returns the vertex and fragment shader text for a list of fused
+        (shader, link) pairs, raises FusionError if they can't be fused
+        """
+        v_shader_txt = loader.read_shader_text(self.v.format(fuse[0][0]))
+        for shader, link in fuse[1:]:
+            if not same_shader_text(v_shader_txt, loader.read_shader_text(self.v.format(shader))):
+                raise FusionError(shader+' uses a different vertex shader')
+        stages = []
+        for shader, link in fuse:
+            stages.append((shader, loader.read_shader_text(self.f.format(shader)), link))
+        stage_define = self._get_stage_define(define, [shader for shader, link in fuse],
+                                              inputs, translate_tex_name)
+        return v_shader_txt, fuse_fragment_shaders(stages, stage_define)
+
+    def _load_fused_shader(self, fuse, define, inputs=None, translate_tex_name=None):
+        """
+        Returns the shader for a fused filter stage
+        """
+        v_shader_txt, f_shader_txt = self._make_fused_shader_text(fuse, define, inputs,
+                                                                  translate_tex_name)
+        stage_define = self._get_stage_define(define, [shader for shader, link in fuse],
+                                              inputs, translate_tex_name)
+        return loader.make_shader_GLSL(v_shader_txt, f_shader_txt, stage_define,
+                                       cache_key=('fused', tuple(fuse), loader.get_define_key(stage_define)))
+
+    def _add_filter_buffer(self, name, size=1.0, clear_color=(0, 0, 0, 0),
+                           rgba_bits=(8, 8, 8, 8), float_color=False):
+        """
+        Makes a filter stage buffer and puts it in the filter stage dicts,
+        returns the fullscreen quad and the texture of the buffer
+        """
+        index = len(self.filter_buff)
+        quad, tex, buff, cam = self._make_filter_stage(
+            sort=index, size=size, clear_color=clear_color, name=name,
+            rgba_bits=rgba_bits, float_color=float_color)
+        self.filter_buff[name] = buff
+        self.filter_quad[name] = quad
+        self.filter_tex[name] = tex
+        self.filter_cam[name] = cam
+        self._add_buffer_size(buff, size)
+        return quad, tex
+
+    def _add_pyramid_filter(self, shader, inputs, name, size, clear_color,
+                            translate_tex_name, define, levels):
+        """
+        Creates a mip-chain pyramid filter stage.
+        The input is downsampled 'levels' times, each level at half the size
+        of the previous one (starting at 'size'), then the chain is upsampled
+        back to 'size' adding each level on the way up.
+        The shader is loaded once for downsampling and once with the UPSAMPLE
+        define for upsampling.
+        The top upsample level is stored in the filter stage dicts as 'name',
+        the other levels as 'name_down_#' and 'name_up_#'
+        """
+        levels = max(int(levels), 2)
+        for input_name, value in inputs.items():
+            if isinstance(value, str):
+                value = loader.load_texture(value, sRgb=loader.use_srgb)
+                inputs[input_name]=value
+        down_define = self._get_stage_define(define)
+        up_define = {'UPSAMPLE': 1}
+        if down_define:
+            up_define.update(down_define)
+        # downsample
+        down_tex = []
+        for level in range(levels):
+            level_name = '{0}_down_{1}'.format(name, level)
+            quad, tex = self._add_filter_buffer(name=level_name,
+                                                size=size/(2.0**level),
+                                                clear_color=clear_color,
+                                                rgba_bits=(16, 16, 16, 16),
+                                                float_color=True)
+            quad.set_shader(loader.load_shader_GLSL(self.v.format(
+                shader), self.f.format(shader), down_define))
+            for input_name, value in inputs.items():
+                quad.set_shader_input(input_name, value)
+            if level == 0:
+                if translate_tex_name:
+                    for old_name, new_name in translate_tex_name.items():
+                        quad.set_shader_input(str(new_name), self.filter_tex[old_name])
+            else:
+                quad.set_shader_input('input_tex', down_tex[-1])
+            down_tex.append(tex)
+        # upsample, adding the downsampled level of the same size
+        up_tex = down_tex[-1]
+        for level in reversed(range(levels-1)):
+            if level == 0:
+                level_name = name
+            else:
+                level_name = '{0}_up_{1}'.format(name, level)
+            quad, tex = self._add_filter_buffer(name=level_name,
+                                                size=size/(2.0**level),
+                                                clear_color=clear_color,
+                                                rgba_bits=(16, 16, 16, 16),
+                                                float_color=True)
+            quad.set_shader(loader.load_shader_GLSL(self.v.format(
+                shader), self.f.format(shader), up_define))
+            for input_name, value in inputs.items():
+                quad.set_shader_input(input_name, value)
+            quad.set_shader_input('input_tex', up_tex)
+            quad.set_shader_input('base_tex', down_tex[level])
+            # the sum of all the levels is averaged at the top level
+            if level == 0:
+                quad.set_shader_input('level_scale', 1.0/levels)
+            else:
+                quad.set_shader_input('level_scale', 1.0)
+            up_tex = tex
+
+    def _reload_pyramid_filter(self, stage_name):
+        """
+        Reloads the shaders and inputs of all the levels of a pyramid filter stage
+        """
+        id = self._get_filter_stage_index(stage_name)
+        stage = self.filter_stages[id]
+        shader = stage['shader']
+        inputs = {}
+        if 'inputs' in stage:
+            inputs = stage['inputs']
+        for name, value in inputs.items():
+            if isinstance(value, str):
+                value = loader.load_texture(value)
+                inputs[name]=value
+        define = self._get_stage_define(stage.get('define', None))
+        up_define = {'UPSAMPLE': 1}
+        if define:
+            up_define.update(define)
+        levels = max(int(stage['levels']), 2)
+        level_names = ['{0}_down_{1}'.format(stage_name, level) for level in range(levels)]
+        level_names += ['{0}_up_{1}'.format(stage_name, level) for level in range(1, levels-1)]
+        level_names.append(stage_name)
+        for level_name in level_names:
+            quad = self.filter_quad[level_name]
+            if level_name.startswith(stage_name+'_down_'):
+                quad.set_shader(loader.load_shader_GLSL(self.v.format(
+                    shader), self.f.format(shader), define))
+            else:
+                quad.set_shader(loader.load_shader_GLSL(self.v.format(
+                    shader), self.f.format(shader), up_define))
+            for name, value in inputs.items():
+                quad.set_shader_input(name, value)
+            for name, value in self.common_inputs.items():
+                quad.set_shader_input(name, value)
+        if 'translate_tex_name' in stage:
+            for old_name, new_name in stage['translate_tex_name'].items():
+                self.filter_quad[level_names[0]].set_shader_input(
+                    str(new_name), self.filter_tex[old_name])
+
+    def _make_filter_stage(self, sort=0, size=1.0, clear_color=None, name=None,
+                           rgba_bits=(8, 8, 8, 8), float_color=False):
         """
         Creates a buffer, quad, camera and texture needed for a filter stage
         Use add_filter() not this function
@@ -569,14 +1740,15 @@ class DeferredRenderer(DirectObject):
         tex = Texture()
         tex.set_wrap_u(Texture.WM_clamp)
         tex.set_wrap_v(Texture.WM_clamp)
-        buff_size_x = int(base.win.get_x_size() * size)
-        buff_size_y = int(base.win.get_y_size() * size)
+        buff_size_x = int(self.render_size[0] * size)
+        buff_size_y = int(self.render_size[1] * size)
         # buff=base.win.makeTextureBuffer("buff", buff_size_x, buff_size_y, tex)
         winprops = WindowProperties()
         winprops.set_size(buff_size_x, buff_size_y)
         props = FrameBufferProperties()
         props.set_rgb_color(True)
-        props.set_rgba_bits(8, 8, 8, 8)
+        props.set_rgba_bits(*rgba_bits)
+        props.set_float_color(float_color)
         props.set_depth_bits(0)
         buff = base.graphicsEngine.make_output(
             base.pipe, 'filter_stage_'+name, sort,
@@ -639,18 +1811,24 @@ class DeferredRenderer(DirectObject):
         aux_tex = Texture()
         aux_tex.set_wrap_u(Texture.WM_clamp)
         aux_tex.set_wrap_v(Texture.WM_clamp)
-        buff_size_x = int(base.win.get_x_size()*size)
-        buff_size_y = int(base.win.get_y_size()*size)
+        buff_size_x = int(self.render_size[0]*size)
+        buff_size_y = int(self.render_size[1]*size)
 
 
         winprops = WindowProperties()
         winprops.set_size(buff_size_x, buff_size_y)
         props = FrameBufferProperties()
         props.set_rgb_color(True)
-        props.set_rgba_bits(8, 8, 8, 8)
-        props.set_srgb_color(True)
-        if 'FORWARD_AUX' in define:
-            props.set_aux_rgba(1)
+        if 'FORWARD_OIT' in define:
+            # accumulation targets for weighted blended OIT
+            props.set_rgba_bits(16, 16, 16, 16)
+            props.set_float_color(True)
+            props.set_aux_float(1)
+        else:
+            props.set_rgba_bits(8, 8, 8, 8)
+            props.set_srgb_color(True)
+            if 'FORWARD_AUX' in define:
+                props.set_aux_rgba(1)
         props.set_depth_bits(0)
         buff = base.graphicsEngine.make_output(
             base.pipe, 'forward_stage', 2,
@@ -658,10 +1836,17 @@ class DeferredRenderer(DirectObject):
             GraphicsPipe.BF_resizeable,
             base.win.get_gsg(), base.win)
         buff.add_render_texture(tex=tex, mode=GraphicsOutput.RTMBindOrCopy, bitplane=GraphicsOutput.RTPColor)
-        if 'FORWARD_AUX' in define:
-            buff.add_render_texture(tex=aux_tex,mode=GraphicsOutput.RTMBindOrCopy, bitplane=GraphicsOutput.RTPAuxRgba0)
-            buff.set_clear_active(GraphicsOutput.RTPAuxRgba0, True)
-        buff.set_clear_color((0, 0, 0, 0))
+        if 'FORWARD_OIT' in define:
+            buff.add_render_texture(tex=aux_tex,mode=GraphicsOutput.RTMBindOrCopy, bitplane=GraphicsOutput.RTPAuxFloat0)
+            buff.set_clear_active(GraphicsOutput.RTPAuxFloat0, True)
+            buff.set_clear_value(GraphicsOutput.RTPAuxFloat0, (0, 0, 0, 0))
+            # alpha is the revealage, product of (1-alpha), starts at 1
+            buff.set_clear_color((0, 0, 0, 1))
+        else:
+            if 'FORWARD_AUX' in define:
+                buff.add_render_texture(tex=aux_tex,mode=GraphicsOutput.RTMBindOrCopy, bitplane=GraphicsOutput.RTPAuxRgba0)
+                buff.set_clear_active(GraphicsOutput.RTPAuxRgba0, True)
+            buff.set_clear_color((0, 0, 0, 0))
         cam = base.make_camera(win=buff)
         cam.reparent_to(root)
         lens = base.cam.node().get_lens()
@@ -677,11 +1862,12 @@ class DeferredRenderer(DirectObject):
         use the SceneLight class to set the lights!
         """
 
+        stage_name = self.fused_stages.get('final_light', 'final_light')
         try:
-            self.filter_quad['final_light'].set_shader_inputs(light_color=color, direction=direction)
+            self.filter_quad[stage_name].set_shader_inputs(light_color=color, direction=direction)
         except AttributeError:
-            self.filter_quad['final_light'].set_shader_input('light_color',color)
-            self.filter_quad['final_light'].set_shader_input('direction', direction)
+            self.filter_quad[stage_name].set_shader_input('light_color',color)
+            self.filter_quad[stage_name].set_shader_input('direction', direction)
 
 
 
@@ -747,39 +1933,27 @@ class DeferredRenderer(DirectObject):
         """
         if fov > 179.0:
             fov = 179.0
-        xy_scale = math.tan(deg2Rad(fov * 0.5))
-        model = loader.load_model("models/cone")
-        # temp=model.copyTo(self.plain_root)
-        # self.lights.append(model)
-        model.reparent_to(self.light_root)
-        model.set_scale(xy_scale, 1.0, xy_scale)
-        model.flatten_strong()
-        model.set_scale(radius)
+        shadow_size = shadow_size if shadow_size > 0.0 else 0
+        key = ('spot_light', 'models/cone', shadow_size)
+        model, p3d_light = self._get_pooled_light(key)
+        if model is None:
+            model = self._make_light_volume(key)
+            p3d_light = render.attach_new_node(Spotlight("Spotlight"))
+            if shadow_size > 0:
+                p3d_light.node().set_shadow_caster(True, shadow_size, shadow_size)
+        self.set_cone_light_shape(model, radius, fov)
         model.set_pos(pos)
         model.set_hpr(hpr)
-        # debug=self.lights[-1].copyTo(self.plain_root)
-        model.set_attrib(DepthTestAttrib.make(RenderAttrib.MLess))
-        model.set_attrib(CullFaceAttrib.make(
-            CullFaceAttrib.MCullCounterClockwise))
-        model.set_attrib(ColorBlendAttrib.make(
-            ColorBlendAttrib.MAdd, ColorBlendAttrib.OOne, ColorBlendAttrib.OOne))
-        model.set_attrib(DepthWriteAttrib.make(DepthWriteAttrib.MOff))
 
-        model.set_shader(loader.load_shader_GLSL(self.v.format(
-            'spot_light'), self.f.format('spot_light'), self.shading_setup))
         model.set_shader_input("light_radius", float(radius))
         model.set_shader_input("light_pos", Vec4(pos, 1.0))
         model.set_shader_input("light_fov", deg2Rad(fov))
-        p3d_light = render.attach_new_node(Spotlight("Spotlight"))
         p3d_light.set_pos(render, pos)
         p3d_light.set_hpr(render, hpr)
         p3d_light.node().set_exponent(exponent)
         p3d_light.node().set_color(Vec4(color, 1.0))
-        if shadow_size > 0.0:
-            p3d_light.node().set_shadow_caster(True, shadow_size, shadow_size)
+        if shadow_size > 0:
             model.set_shader_input("bias", bias)
-            model.set_shader(loader.load_shader_GLSL(self.v.format(
-            'spot_light_shadow'), self.f.format('spot_light_shadow'), self.shading_setup))
         # p3d_light.node().set_camera_mask(self.modelMask)
         model.set_shader_input("spot", p3d_light)
         #p3d_light.node().showFrustum()
@@ -793,6 +1967,14 @@ class DeferredRenderer(DirectObject):
         #p3d_light.node().showFrustum()
         return model, p3d_light
 
+    def set_cone_light_shape(self, model, radius, fov):
+        """
+        Scales a spotlight volume to match the radius and fov (in degrees),
+        the volume is a cone with a 90 deg fov and a length of 1
+        """
+        xy_scale = math.tan(deg2Rad(fov * 0.5))
+        model.set_scale(radius*xy_scale, radius, radius*xy_scale)
+
     def add_point_light(self, color, model="models/sphere", pos=(0, 0, 0), radius=1.0, shadow_size=0):
         """
         Creates a omni (point) light,
@@ -801,29 +1983,21 @@ class DeferredRenderer(DirectObject):
         #print('make light, shadow', shadow_size)
         # light geometry
         # if we got a NodePath we use it as the geom for the light
-        if not isinstance(model, NodePath):
-            model = loader.load_model(model)
-        # self.lights.append(model)
-        model.set_shader(loader.load_shader_GLSL(self.v.format(
-            'point_light'), self.f.format('point_light'), self.shading_setup))
-        model.set_attrib(DepthTestAttrib.make(RenderAttrib.MLess))
-        model.set_attrib(CullFaceAttrib.make(
-            CullFaceAttrib.MCullCounterClockwise))
-        model.set_attrib(ColorBlendAttrib.make(
-            ColorBlendAttrib.MAdd, ColorBlendAttrib.OOne, ColorBlendAttrib.OOne))
-        model.set_attrib(DepthWriteAttrib.make(DepthWriteAttrib.MOff))
+        if isinstance(model, NodePath):
+            p3d_light = None
+            model.set_shader(self._get_light_shader('point_light', shadow_size))
+            self.set_light_volume_attribs(model)
+        else:
+            key = ('point_light', model, shadow_size)
+            model, p3d_light = self._get_pooled_light(key)
+            if model is None:
+                model = self._make_light_volume(key)
 
-        p3d_light = render.attach_new_node(PointLight("PointLight"))
+        if p3d_light is None:
+            p3d_light = render.attach_new_node(PointLight("PointLight"))
         p3d_light.set_pos(render, pos)
-
         if shadow_size > 0:
-            model.set_shader(loader.load_shader_GLSL(self.v.format(
-                'point_light_shadow'), self.f.format('point_light_shadow'), self.shading_setup))
-            p3d_light.node().set_shadow_caster(True, shadow_size, shadow_size)
-            p3d_light.node().set_camera_mask(BitMask32.bit(13))
-            for i in range(6):
-                p3d_light.node().get_lens(i).set_near_far(0.1, radius)
-                p3d_light.node().get_lens(i).make_bounds()
+            self.set_point_light_shadow(model, p3d_light, shadow_size, radius)
 
         # shader inputs
         try:
@@ -843,29 +2017,707 @@ class DeferredRenderer(DirectObject):
 
         return model, p3d_light
 
-    def _make_FBO(self, name, auxrgba=0, multisample=0, srgb=False, depth_bits=32):
+    def set_point_light_shadow(self, model, p3d_light, shadow_size, radius):
+        """
+        Makes a point light cast shadows, the shadow map is a cube map or
+        two paraboloid maps if POINT_SHADOW_MODE is 'paraboloid'.
+        Use the SphereLight class, not this function!
+        """
+        if self.point_shadow_mode == 'paraboloid':
+            self._setup_paraboloid_shadow(model, p3d_light, shadow_size)
+        else:
+            p3d_light.node().set_shadow_caster(True, shadow_size, shadow_size)
+            p3d_light.node().set_camera_mask(BitMask32.bit(13))
+        self.set_point_shadow_radius(p3d_light, radius)
+        if p3d_light not in self.point_shadow_lights:
+            self.point_shadow_lights.append(p3d_light)
+
+    def set_point_shadow_radius(self, p3d_light, radius):
+        """
+        Sets the range of the shadow cameras of a point light
+        """
+        if p3d_light.has_python_tag('paraboloid_buffer'):
+            state = NodePath('paraboloid_state')
+            state.set_shader(loader.load_shader_GLSL(self.v.format('paraboloid_shadow'),
+                                                     self.f.format('paraboloid_shadow'),
+                                                     self.shading_setup), 100)
+            state.set_shader_input('near_far', Vec2(0.1, radius))
+            state.set_two_sided(True, 100)
+            for cam in p3d_light.find_all_matches('paraboloid_cam'):
+                # the lens only culls the scene, the shader does the projection
+                lens = cam.node().get_lens()
+                lens.set_film_size(radius*2.0, radius*2.0)
+                lens.set_near_far(0.1, radius)
+                cam.node().set_initial_state(state.get_state())
+        elif p3d_light.node().is_shadow_caster():
+            for i in range(6):
+                p3d_light.node().get_lens(i).set_near_far(0.1, radius)
+        self.update_shadow_prefilter_range(p3d_light)
+
+    def _setup_paraboloid_shadow(self, model, p3d_light, shadow_size):
+        """
+        Makes a dual paraboloid shadow buffer for a point light, two
+        cameras render the two halves of the space around the light
+        to the left and right half of one depth texture
+        """
+        buff = p3d_light.get_python_tag('paraboloid_buffer')
+        if buff is not None and buff.get_y_size() != shadow_size:
+            p3d_light.clear_python_tag('paraboloid_buffer')
+            p3d_light.find_all_matches('paraboloid_cam').detach()
+            self.remove_buffer(buff)
+            buff = None
+        if buff is None:
+            winprops = WindowProperties()
+            winprops.set_size(shadow_size*2, shadow_size)
+            props = FrameBufferProperties()
+            props.set_rgb_color(False)
+            props.set_depth_bits(24)
+            buff = base.graphicsEngine.make_output(
+                base.pipe, 'paraboloid_shadow', -10,
+                props, winprops,
+                GraphicsPipe.BFRefuseWindow,
+                base.win.get_gsg(), base.win)
+            if buff is None:
+                print('Failed to create a paraboloid shadow buffer')
+                return
+            tex = Texture('paraboloid_map')
+            tex.set_wrap_u(SamplerState.WM_clamp)
+            tex.set_wrap_v(SamplerState.WM_clamp)
+            tex.set_minfilter(SamplerState.FT_linear)
+            tex.set_magfilter(SamplerState.FT_linear)
+            buff.add_render_texture(tex, GraphicsOutput.RTM_bind_or_copy, GraphicsOutput.RTP_depth)
+            for i, heading in enumerate((0, 180)):
+                cam = p3d_light.attach_new_node(Camera('paraboloid_cam'))
+                cam.node().set_lens(OrthographicLens())
+                cam.node().set_camera_mask(BitMask32.bit(13))
+                cam.set_h(heading)
+                region = buff.make_display_region(i*0.5, i*0.5+0.5, 0, 1)
+                region.set_camera(cam)
+                region.set_clear_depth_active(True)
+            p3d_light.set_python_tag('paraboloid_buffer', buff)
+        model.set_shader_input('paraboloid_map', buff.get_texture())
+
+    def get_light_shadow_buffer(self, p3d_light):
+        """
+        Returns the shadow buffer of a light, or None if the light has no
+        shadows or panda did not make the buffer yet
+        """
+        if p3d_light.has_python_tag('paraboloid_buffer'):
+            return p3d_light.get_python_tag('paraboloid_buffer')
+        try:
+            return p3d_light.node().get_shadow_buffer(base.win.get_gsg())
+        except AttributeError:
+            return None
+
+    def get_shadow_face_stats(self, p3d_light=None):
+        """
+        Returns the number of shadow map faces (cube faces or paraboloid
+        halves) rendered and skipped in the last frame, for all the point
+        lights or, if p3d_light is given, the counts for one light:
+        {'last': rendered in the last frame, 'rendered': total, 'skipped': total}
+        """
+        if p3d_light is None:
+            return dict(self.shadow_face_stats)
+        info = p3d_light.get_python_tag('shadow_faces')
+        if info is None:
+            return {'last': 0, 'rendered': 0, 'skipped': 0}
+        return {'last': info['last'], 'rendered': info['rendered'], 'skipped': info['skipped']}
+
+    def _get_shadow_faces(self, p3d_light, buff):
+        """
+        Returns [display region, camera, lens, clean] for each face of a
+        shadow buffer, clean is True if the face was cleared and nothing
+        was rendered to it since
+        """
+        faces = []
+        for i in range(buff.get_num_display_regions()):
+            region = buff.get_display_region(i)
+            cam = region.get_camera()
+            if cam.is_empty():
+                continue
+            if cam == p3d_light:
+                lens = p3d_light.node().get_lens(region.get_lens_index())
+            else:
+                lens = cam.node().get_lens()
+            faces.append([region, cam, lens, False])
+        return faces
+
+    def _is_shadow_face_needed(self, face, cam_bounds, casters):
+        """
+        Returns True if a face of a shadow map needs to be rendered,
+        the face frustum must be in view and have a caster in it,
+        faces without casters are rendered once more to clear them
+        """
+        region, cam, lens, clean = face
+        bounds = lens.make_bounds()
+        bounds.xform(cam.get_mat(render))
+        points = [bounds.get_point(i) for i in range(bounds.get_num_points())]
+        box = BoundingBox(Point3(min(p.x for p in points), min(p.y for p in points), min(p.z for p in points)),
+                          Point3(max(p.x for p in points), max(p.y for p in points), max(p.z for p in points)))
+        if cam_bounds.contains(box) == BoundingVolume.IF_no_intersection:
+            return False
+        for caster in casters:
+            if bounds.contains(caster) != BoundingVolume.IF_no_intersection:
+                face[3] = False
+                return True
+        if clean:
+            return False
+        face[3] = True
+        return True
+
+    def _update_point_shadows(self, task):
+        """
+        Task, turns off the shadow map faces of point lights that are not
+        needed (POINT_SHADOW_MODE 'culled' or 'paraboloid') and counts
+        the faces rendered
+        """
+        if not self.point_shadow_lights:
+            return task.cont
+        cull = self.point_shadow_mode != 'cube'
+        if cull:
+            cam_bounds = base.cam.node().get_lens().make_bounds()
+            cam_bounds.xform(base.cam.get_mat(render))
+            casters = []
+            for node in self.geometry_root.get_children():
+                if node.is_hidden(BitMask32.bit(13)):
+                    continue
+                bounds = node.get_bounds()
+                if not bounds.is_empty():
+                    bounds.xform(node.get_mat(render))
+                    casters.append(bounds)
+        stats = {'rendered': 0, 'skipped': 0}
+        for p3d_light in self.point_shadow_lights[:]:
+            if p3d_light.is_empty():
+                self.point_shadow_lights.remove(p3d_light)
+                continue
+            # lights in the light pool and lights that lost their shadows
+            if not p3d_light.has_parent() or p3d_light.has_python_tag('remove_shadow'):
+                continue
+            buff = self.get_light_shadow_buffer(p3d_light)
+            if not buff or not buff.is_active():
+                continue
+            info = p3d_light.get_python_tag('shadow_faces')
+            if info is None or info['buffer'] != buff:
+                info = {'buffer': buff,
+                        'faces': self._get_shadow_faces(p3d_light, buff),
+                        'last': 0, 'rendered': 0, 'skipped': 0}
+                p3d_light.set_python_tag('shadow_faces', info)
+            rendered = 0
+            for face in info['faces']:
+                active = True
+                if cull:
+                    active = self._is_shadow_face_needed(face, cam_bounds, casters)
+                face[0].set_active(active)
+                rendered += int(active)
+            skipped = len(info['faces']) - rendered
+            info['last'] = rendered
+            info['rendered'] += rendered
+            info['skipped'] += skipped
+            stats['rendered'] += rendered
+            stats['skipped'] += skipped
+        self.shadow_face_stats = stats
+        return task.cont
+
+    def add_light_array(self, count):
+        """
+        Creates one light volume drawn 'count' times with instancing,
+        the position, radius and color of each instance are read from a
+        buffer texture (2 rgba32 texels per light).
+        Use the LightArray class, not this function!
+        """
+        model = self.light_root.attach_new_node('light_array')
+        self._get_light_prototype('models/sphere').instance_to(model)
+        model.set_state(self._get_light_state('point_light', 0))
+        define = dict(self.shading_setup, LIGHT_ARRAY=1)
+        model.set_shader(loader.load_shader_GLSL(self.v.format('point_light'),
+                                                 self.f.format('point_light'),
+                                                 define))
+        tex = Texture('light_array')
+        tex.setup_buffer_texture(count*2, Texture.T_float,
+                                 Texture.F_rgba32, GeomEnums.UH_dynamic)
+        model.set_shader_input('light_array', tex)
+        # the lights can be anywhere, the bounds of one volume mean nothing
+        model.node().set_bounds(OmniBoundingVolume())
+        model.node().set_final(True)
+        model.set_instance_count(count)
+        return model, tex
+
+    def _get_light_shader(self, name, shadow_size, shadow_filter=None):
+        """
+        Returns the shader for a light volume
+        """
+        define = self.shading_setup
+        if shadow_size > 0:
+            name += '_shadow'
+            define = self.get_shadow_filter_define(shadow_filter)
+        return loader.load_shader_GLSL(self.v.format(name), self.f.format(name), define)
+
+    def get_shadow_filter_define(self, shadow_filter):
+        """
+        Returns the defines for a shadowed light shader using a shadow filter
+        (see set_shadow_filter())
+        """
+        if shadow_filter is None:
+            return self.shading_setup
+        return dict(self.shading_setup, **{'PREFILTER_'+shadow_filter.upper(): 1})
+
+    def set_shadow_filter(self, model, p3d_light, shadow_filter):
+        """
+        Sets how the shadows of a light are filtered:
+            None  - PCF, many taps in the light shader (default)
+            'esm' - exponential shadow map
+            'vsm' - variance shadow map
+        With 'esm' and 'vsm' the shadow map is converted and blurred once,
+        at the size of the shadow map, in a prefilter buffer and the light
+        shader needs just one bilinear fetch.
+        Use the shadow_filter of SphereLight and ConeLight, not this function!
+        """
+        if shadow_filter not in (None, 'esm', 'vsm'):
+            raise RuntimeError('Unknown shadow filter: {}'.format(shadow_filter))
+        self._remove_shadow_prefilter(p3d_light)
+        name = 'point_light' if isinstance(p3d_light.node(), PointLight) else 'spot_light'
+        if shadow_filter is not None:
+            tex = self._make_shadow_prefilter(p3d_light, shadow_filter)
+            if tex is None:
+                shadow_filter = None
+            else:
+                model.set_shader_input('prefiltered_shadow', tex)
+        model.set_shader(self._get_light_shader(name, 1, shadow_filter))
+
+    def update_shadow_prefilter_range(self, p3d_light):
+        """
+        Updates the prefilter of a light after the near/far of its
+        shadow camera changed
+        """
+        if not p3d_light.has_python_tag('shadow_prefilter_quads'):
+            return
+        lens = p3d_light.node().get_lens()
+        for quad in p3d_light.get_python_tag('shadow_prefilter_quads'):
+            quad.set_shader_input('near_far', Vec2(lens.get_near(), lens.get_far()))
+
+    def _make_shadow_prefilter(self, p3d_light, shadow_filter):
+        """
+        Makes a buffer that turns the shadow map of a light into a blurred
+        exponential or variance shadow map, the size and kind (2d, cube map
+        or paraboloid) of the shadow map is kept.
+        Returns the prefiltered texture
+        """
+        define = {'PREFILTER_'+shadow_filter.upper(): 1}
+        if 'PREFILTER_RADIUS' in self.shading_setup:
+            define['PREFILTER_RADIUS'] = self.shading_setup['PREFILTER_RADIUS']
+        if 'ESM_EXPONENT' in self.shading_setup:
+            define['ESM_EXPONENT'] = self.shading_setup['ESM_EXPONENT']
+        cube = False
+        if p3d_light.has_python_tag('paraboloid_buffer'):
+            shadow_buff = p3d_light.get_python_tag('paraboloid_buffer')
+            size = (shadow_buff.get_x_size(), shadow_buff.get_y_size())
+            define['SHADOW_PARABOLOID'] = 1
+        else:
+            size = p3d_light.node().get_shadow_buffer_size()
+            size = (size[0], size[1])
+            if isinstance(p3d_light.node(), PointLight):
+                cube = True
+                define['SHADOW_CUBE'] = 1
+        winprops = WindowProperties()
+        winprops.set_size(*size)
+        props = FrameBufferProperties()
+        props.set_rgb_color(True)
+        if shadow_filter == 'vsm':
+            props.set_rgba_bits(32, 32, 0, 0)
+        else:
+            props.set_rgba_bits(32, 0, 0, 0)
+        props.set_float_color(True)
+        props.set_depth_bits(0)
+        buff = base.graphicsEngine.make_output(
+            base.pipe, 'shadow_prefilter', -5,
+            props, winprops,
+            GraphicsPipe.BFRefuseWindow,
+            base.win.get_gsg(), base.win)
+        if buff is None:
+            print('Failed to create a shadow prefilter buffer')
+            return None
+        tex = Texture('prefiltered_shadow')
+        if cube:
+            tex.setup_cube_map(size[0], Texture.T_float,
+                               Texture.F_rg32 if shadow_filter == 'vsm' else Texture.F_r32)
+        tex.set_wrap_u(SamplerState.WM_clamp)
+        tex.set_wrap_v(SamplerState.WM_clamp)
+        tex.set_minfilter(SamplerState.FT_linear)
+        tex.set_magfilter(SamplerState.FT_linear)
+        buff.add_render_texture(tex, GraphicsOutput.RTM_bind_or_copy, GraphicsOutput.RTP_color)
+        buff.set_clear_active(GraphicsOutput.RTPColor, False)
+        shader = loader.load_shader_GLSL(self.v.format('shadow_prefilter'),
+                                         self.f.format('shadow_prefilter'),
+                                         define)
+        quads = []
+        for face in range(6 if cube else 1):
+            # each face has its own quad and camera
+            root = NodePath('shadow_prefilter')
+            cm = CardMaker('plane')
+            cm.set_frame(-1, 1, -1, 1)
+            quad = root.attach_new_node(cm.generate())
+            quad.set_shader(shader)
+            quad.set_shader_input('face', face)
+            if 'SHADOW_PARABOLOID' in define:
+                quad.set_shader_input('shadow_map', shadow_buff.get_texture())
+            else:
+                quad.set_shader_input('shadowcaster', p3d_light)
+            cam = root.attach_new_node(Camera('prefilter_cam'))
+            lens = OrthographicLens()
+            lens.set_film_size(2, 2)
+            lens.set_near_far(-1, 1)
+            cam.node().set_lens(lens)
+            region = buff.make_display_region()
+            region.set_camera(cam)
+            if cube:
+                region.set_target_tex_page(face)
+            quads.append(quad)
+        p3d_light.set_python_tag('shadow_prefilter', buff)
+        p3d_light.set_python_tag('shadow_prefilter_quads', quads)
+        self.update_shadow_prefilter_range(p3d_light)
+        return tex
+
+    def _remove_shadow_prefilter(self, p3d_light):
+        """
+        Removes the prefilter buffer of a light, if it has one
+        """
+        if p3d_light.is_empty() or not p3d_light.has_python_tag('shadow_prefilter'):
+            return
+        self.remove_buffer(p3d_light.get_python_tag('shadow_prefilter'))
+        p3d_light.clear_python_tag('shadow_prefilter')
+        p3d_light.clear_python_tag('shadow_prefilter_quads')
+
+    def _get_light_state(self, name, shadow_size):
+        """
+        Returns the RenderState shared by all light volumes of one kind
+        """
+        key = (name, shadow_size > 0)
+        if key not in self.light_states:
+            state = RenderState.make(CullFaceAttrib.make(CullFaceAttrib.MCullCounterClockwise),
+                                     ColorBlendAttrib.make(ColorBlendAttrib.MAdd,
+                                                           ColorBlendAttrib.OOne,
+                                                           ColorBlendAttrib.OOne),
+                                     DepthWriteAttrib.make(DepthWriteAttrib.MOff),
+                                     DepthTestAttrib.make(RenderAttrib.MLess))
+            self.light_states[key] = state.set_attrib(ShaderAttrib.make(self._get_light_shader(name, shadow_size)))
+        return self.light_states[key]
+
+    def _get_light_prototype(self, model_path):
+        """
+        Returns the light volume geometry for a model, loaded and flattened once
+        """
+        if model_path not in self.light_prototypes:
+            prototype = loader.load_model(model_path)
+            prototype.clear_model_nodes()
+            prototype.flatten_strong()
+            self.light_prototypes[model_path] = prototype
+        return self.light_prototypes[model_path]
+
+    def _make_light_volume(self, key):
+        """
+        Makes a new light volume node under light_root, the geometry is an
+        instance of a prototype loaded and flattened once for each model
+        """
+        name, model_path, shadow_size = key
+        model = self.light_root.attach_new_node(name)
+        model.set_python_tag('light_pool_key', key)
+        self._get_light_prototype(model_path).instance_to(model)
+        model.set_state(self._get_light_state(name, shadow_size))
+        if 'STENCIL_LIGHTS' in self.shading_setup:
+            self._add_stencil_pass(model)
+        return model
+
+    def _get_pooled_light(self, key):
+        """
+        Returns a (model, p3d_light) from the free list of light volumes,
+        or (None, None) if there are no free lights of that kind
+        """
+        free = self.light_pool.get(key)
+        if not free:
+            return None, None
+        model, p3d_light = free.pop()
+        self.forget_node_inputs(model)
+        model.reparent_to(self.light_root)
+        model.show()
+        # LightLOD might have changed the shader
+        model.set_shader(self._get_light_shader(key[0], key[2]))
+        p3d_light.reparent_to(render)
+        self.set_shadow_buffer_active(p3d_light, True)
+        return model, p3d_light
+
+    def release_light(self, model, p3d_light):
+        """
+        Takes a light volume out of the scene and puts it on a free list,
+        add_point_light() and add_cone_light() reuse it.
+        Light volumes that were not made by the pool are removed.
+        """
+        if model.is_empty():
+            return
+        key = None
+        if model.has_python_tag('light_pool_key'):
+            key = model.get_python_tag('light_pool_key')
+        self._remove_shadow_prefilter(p3d_light)
+        if key is None:
+            self.forget_node_inputs(model)
+            model.remove_node()
+            p3d_light.detach_node()
+            self.remove_light_shadow(p3d_light, remove_node=True)
+            return
+        model.detach_node()
+        p3d_light.detach_node()
+        self.set_shadow_buffer_active(p3d_light, False)
+        self.light_pool.setdefault(key, []).append((model, p3d_light))
+
+    def remove_buffer(self, buff):
+        """
+        Removes an offscreen buffer at a safe point. The buffer stops
+        rendering now, but it's only removed 2 frames later, when the cull
+        and draw threads (threading-model Cull/Draw) are done with it
+        """
+        buff.set_active(False)
+        self.buffer_removal.append((globalClock.get_frame_count()+2, buff, None, False))
+
+    def remove_light_shadow(self, p3d_light, remove_node=False):
+        """
+        Makes a light stop casting shadows, the shadow buffer is removed
+        like with remove_buffer(). If remove_node is True the light node
+        is removed at the same time (it owns the buffer)
+        """
+        p3d_light.set_python_tag('remove_shadow', True)
+        self._remove_shadow_prefilter(p3d_light)
+        buff = self.get_light_shadow_buffer(p3d_light)
+        if buff:
+            buff.set_active(False)
+        self.buffer_removal.append((globalClock.get_frame_count()+2, buff, p3d_light, remove_node))
+
+    def restore_light_shadow(self, p3d_light):
+        """
+        Cancels remove_light_shadow() for a light that casts shadows again
+        """
+        if p3d_light.has_python_tag('remove_shadow'):
+            p3d_light.clear_python_tag('remove_shadow')
+            self.set_shadow_buffer_active(p3d_light, True)
+
+    def _remove_buffers(self):
+        """
+        Removes the buffers queued by remove_buffer() and remove_light_shadow()
+        that are no longer used by the cull and draw threads
+        """
+        frame = globalClock.get_frame_count()
+        for item in self.buffer_removal[:]:
+            due, buff, p3d_light, remove_node = item
+            if due > frame:
+                continue
+            self.buffer_removal.remove(item)
+            if p3d_light is not None:
+                if not p3d_light.has_python_tag('remove_shadow'):
+                    # shadows turned back on, see restore_light_shadow()
+                    continue
+                p3d_light.clear_python_tag('remove_shadow')
+                p3d_light.node().set_shadow_caster(False)
+                p3d_light.clear_python_tag('shadow_faces')
+                if p3d_light.has_python_tag('paraboloid_buffer'):
+                    p3d_light.clear_python_tag('paraboloid_buffer')
+                    p3d_light.find_all_matches('paraboloid_cam').detach()
+            if buff:
+                buff.clear_render_textures()
+                base.graphicsEngine.remove_window(buff)
+            if remove_node:
+                p3d_light.remove_node()
+
+    def set_shadow_buffer_active(self, p3d_light, active):
+        """
+        Turns rendering the shadow map (and its prefilter) of a light on or off
+        """
+        buff = self.get_light_shadow_buffer(p3d_light)
+        if buff:
+            buff.set_active(active)
+        if p3d_light.has_python_tag('shadow_prefilter'):
+            p3d_light.get_python_tag('shadow_prefilter').set_active(active)
+
+    def set_light_volume_attribs(self, model):
+        """
+        Sets the render attributes needed to draw a light volume,
+        with STENCIL_LIGHTS in the shading setup the volume also
+        gets a stencil pass so only pixels inside the volume are shaded
+        """
+        model.set_attrib(CullFaceAttrib.make(
+            CullFaceAttrib.MCullCounterClockwise))
+        model.set_attrib(ColorBlendAttrib.make(
+            ColorBlendAttrib.MAdd, ColorBlendAttrib.OOne, ColorBlendAttrib.OOne))
+        model.set_attrib(DepthWriteAttrib.make(DepthWriteAttrib.MOff))
+        if 'STENCIL_LIGHTS' in self.shading_setup:
+            self._add_stencil_pass(model)
+        else:
+            model.set_attrib(DepthTestAttrib.make(RenderAttrib.MLess))
+
+    def _add_stencil_pass(self, model):
+        """
+        Adds a stencil pass to a light volume.
+        The volume geometry is instanced under a 'stencil_mark' node drawn
+        just before the light (z-fail): back faces behind the scene
+        increment the stencil, front faces behind the scene decrement it,
+        so only pixels inside the volume are left non-zero.
+        The light itself is then drawn only where the stencil is not zero,
+        and it clears the stencil for the next light.
+        """
+        mark = NodePath('stencil_mark')
+        for child in model.get_children():
+            child.instance_to(mark)
+        mark.reparent_to(model)
+        mark.set_shader(loader.load_shader_GLSL(self.v.format(
+            'light_stencil'), self.f.format('light_stencil')), 1)
+        mark.set_attrib(ColorWriteAttrib.make(ColorWriteAttrib.C_off), 1)
+        mark.set_attrib(CullFaceAttrib.make(CullFaceAttrib.MCullNone), 1)
+        mark.set_attrib(DepthTestAttrib.make(RenderAttrib.MLess), 1)
+        mark.set_attrib(StencilAttrib.make_2_sided(True, True,
+                                                   StencilAttrib.SCF_always,
+                                                   StencilAttrib.SO_keep,
+                                                   StencilAttrib.SO_decrement_wrap,
+                                                   StencilAttrib.SO_keep,
+                                                   0, 0xff, 0xff,
+                                                   StencilAttrib.SCF_always,
+                                                   StencilAttrib.SO_keep,
+                                                   StencilAttrib.SO_increment_wrap,
+                                                   StencilAttrib.SO_keep), 1)
+        # each light gets its own slot in the fixed bin: stencil pass, light
+        # slots of removed lights are used again, pooled lights keep theirs
+        if self.stencil_free_slots:
+            sort = self.stencil_free_slots.pop()
+        else:
+            sort = self.stencil_light_count * 2
+            self.stencil_light_count += 1
+        mark.set_bin('fixed', sort, 1)
+        model.set_bin('fixed', sort+1)
+        light = {'model': model,
+                 'mark': mark,
+                 'sort': sort,
+                 'inside': False}
+        self._set_stencil_pass_active(light, True)
+        self.stencil_lights.append(light)
+
+    def _set_stencil_pass_active(self, light, active):
+        """
+        Switches a light volume between the two pass stencil mode
+        and a single pass mode that draws the back faces behind the scene,
+        the later is used when the camera is inside the volume
+        """
+        model = light['model']
+        if active:
+            light['mark'].show()
+            model.set_attrib(DepthTestAttrib.make(RenderAttrib.MNone))
+            model.set_attrib(StencilAttrib.make(True,
+                                                StencilAttrib.SCF_not_equal,
+                                                StencilAttrib.SO_keep,
+                                                StencilAttrib.SO_zero,
+                                                StencilAttrib.SO_zero,
+                                                0, 0xff, 0xff))
+        else:
+            light['mark'].hide()
+            model.set_attrib(DepthTestAttrib.make(RenderAttrib.MGreaterEqual))
+            model.clear_attrib(StencilAttrib.get_class_type())
+        light['inside'] = not active
+
+    def _update_stencil_lights(self):
+        """
+        Falls back to the single pass for light volumes that contain the
+        camera (or get cut by the near plane)
+        """
+        near = base.cam.node().get_lens().get_near()
+        for light in self.stencil_lights[:]:
+            model = light['model']
+            if model.is_empty():
+                self.stencil_free_slots.append(light['sort'])
+                self.stencil_lights.remove(light)
+                continue
+            if not model.has_parent():
+                # on the free list of the light pool
+                continue
+            # the near plane corners are further away than 'near',
+            # pad the camera position a bit more to be safe
+            scale = model.get_scale(render)
+            pad = 1.5 * near / max(min(abs(scale[0]), abs(scale[1]), abs(scale[2])), 0.0001)
+            cam_pos = model.get_relative_point(base.cam, Point3(0, 0, 0))
+            inside = model.get_bounds().contains(BoundingSphere(cam_pos, pad)) != BoundingVolume.IF_no_intersection
+            if inside != light['inside']:
+                self._set_stencil_pass_active(light, not inside)
+
+    def add_actor(self, actor):
+        """
+        Sets up an Actor to be skinned on the gpu, the joint matrices are
+        read from a buffer texture shared by all actors, so there is no limit
+        on the number of joints. The actor should be parented to deferred_render.
+        Returns a list of NodePaths with the geometry that is rendered
+        """
+        return self.add_actor_crowd([actor])
+
+    def add_actor_crowd(self, actors):
+        """
+        Like add_actor(), but for a list of actors loaded from the same model.
+        Only the geometry of the first actor is rendered, instanced once for
+        each actor - each instance uses the transform and the joints of its
+        actor, so they can all play different animations
+        """
+        if self.joint_table is None:
+            self.joint_table = JointTable()
+        nodes, joint_names = make_skinned_geometry(actors[0])
+        transforms = [get_joint_transforms(actor, joint_names) for actor in actors]
+        offset = self.joint_table.add(actors, transforms)
+        shader = loader.load_shader_GLSL(self.v.format('actor_buffer'),
+                                         self.f.format('geometry'), self.shading_setup)
+        for node in nodes:
+            node.set_shader(shader)
+            try:
+                node.set_shader_inputs(joint_table=self.joint_table.tex,
+                                       joint_offset=offset,
+                                       joint_stride=len(joint_names)+1)
+            except AttributeError:
+                node.set_shader_input('joint_table', self.joint_table.tex)
+                node.set_shader_input('joint_offset', offset)
+                node.set_shader_input('joint_stride', len(joint_names)+1)
+            if len(actors) > 1:
+                node.set_instance_count(len(actors))
+                # the instances can be anywhere
+                node.node().set_bounds(OmniBoundingVolume())
+                node.node().set_final(True)
+        for actor in actors[1:]:
+            actor.hide()
+        return nodes
+
+    def remove_actor(self, actor):
+        """
+        Stops updating the joints of an actor (or crowd) added with add_actor()
+        """
+        if self.joint_table is not None:
+            self.joint_table.remove(actor)
+
+    def _make_FBO(self, name, auxrgba=0, multisample=0, srgb=False, depth_bits=32, aux_float=True, stencil_bits=0):
         """
         This routine creates an offscreen buffer.  All the complicated
         parameters are basically demanding capabilities from the offscreen
         buffer - we demand that it be able to render to texture on every
         bitplane, that it can support aux bitplanes, that it track
-        the size of the host window, that it can render to texture
-        cumulatively, and so forth.
+        the size of the render size (see _get_render_size()), that it
+        can render to texture cumulatively, and so forth.
         """
         winprops = WindowProperties()
+        winprops.set_size(*self.render_size)
         props = FrameBufferProperties()
         props.set_rgb_color(True)
         props.set_rgba_bits(8,8,8,8)
         props.set_depth_bits(depth_bits)
-        props.set_aux_hrgba(auxrgba)
-        #props.set_aux_rgba(auxrgba)
+        props.set_stencil_bits(stencil_bits)
+        if aux_float:
+            props.set_aux_hrgba(auxrgba)
+        else:
+            props.set_aux_rgba(auxrgba)
         props.set_srgb_color(srgb)
         if multisample>0:
             props.set_multisamples(multisample)
         return base.graphicsEngine.make_output(
             base.pipe, name, 2,
             props, winprops,
-            GraphicsPipe.BFSizeTrackHost | GraphicsPipe.BFCanBindEvery |
+            GraphicsPipe.BF_resizeable | GraphicsPipe.BFCanBindEvery |
             GraphicsPipe.BFRttCumulative | GraphicsPipe.BFRefuseWindow,
             base.win.get_gsg(), base.win)
 
@@ -873,8 +2725,19 @@ class DeferredRenderer(DirectObject):
         """
         Update task
         """
+        self.last_input_stats = self.input_stats
+        self.input_stats = {'applied': 0, 'skipped': 0}
+        if self.buffer_removal:
+            self._remove_buffers()
+        if self.filter_schedule and not self.idle:
+            self._update_filter_schedule()
         self.plain_cam.set_pos_hpr(base.cam.get_pos(render), base.cam.get_hpr(render))
 
+        if self.stencil_lights:
+            self._update_stencil_lights()
+        if self.joint_table is not None:
+            self.joint_table_changed = self.joint_table.update()
+
         for node, light, offset in self.attached_lights.values():
             if not node.is_empty():
                 light.set_pos(render.get_relative_point(node, offset))
@@ -0,0 +1,233 @@
+import os
+import sys
+import hashlib
+import multiprocessing
+from panda3d.core import Texture, SamplerState, PTALVecBase3f, Vec3, ConfigVariableString
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['get_ibl', 'prefilter_cubemap', 'cube_to_array', 'make_cube_texture']
+
+# change it when the math changes, old cache files are then not used
+_VERSION = 1
+# output texels done in one go, limits the memory used by the prefilter
+_CHUNK = 64
+
+
+def _can_fork():
+    """
+    True if the worker processes can be forked from this process
+    """
+    # the pool needs the main script to be importable without side effects
+    # on platforms that spawn processes, so only use it where python forks
+    if not sys.platform.startswith('linux'):
+        return False
+    # forking a process with running threads is not safe, with the threaded
+    # render pipeline the cull and draw threads can run at any time
+    return not ConfigVariableString('threading-model', '').get_value()
+
+
+def _default_processes():
+    if _can_fork():
+        return multiprocessing.cpu_count()
+    return 1
+
+
+def _face_directions(size):
+    """
+    Returns the direction of each texel of a cube map (6, size, size, 3)
+    in the opengl cube map layout and the solid angle of each texel (6, size, size)
+    """
+    st = (numpy.arange(size, dtype=numpy.float32)+0.5)/size*2.0-1.0
+    t, s = numpy.meshgrid(st, st, indexing='ij')
+    one = numpy.ones_like(s)
+    faces = ((one, -t, -s), (-one, -t, s), (s, one, t),
+             (s, -one, -t), (s, -t, one), (-s, -t, -one))
+    dirs = numpy.stack([numpy.stack(face, axis=-1) for face in faces])
+    length_sq = 1.0+s*s+t*t
+    dirs /= numpy.sqrt(length_sq)[..., None]
+    solid_angle = (2.0/size)**2/length_sq**1.5
+    return dirs, numpy.stack([solid_angle]*6)
+
+
+def _resize(faces, size):
+    """
+    Returns the cube map faces resized to size,
+    box filtered when the size is divided evenly, else nearest
+    """
+    old_size = faces.shape[1]
+    if old_size == size:
+        return faces
+    if old_size > size and old_size % size == 0:
+        step = old_size//size
+        return faces.reshape(6, size, step, size, step, 3).mean(axis=(2, 4))
+    index = ((numpy.arange(size)+0.5)*old_size/size).astype(numpy.int32)
+    return faces[:, index][:, :, index]
+
+
+def _prefilter_face(task):
+    """
+    Convolves a cube map with the GGX lobe of a roughness for one face
+    of the output (with N=V=R, like the split sum approximation).
+    task is (source faces, output size, roughness, face)
+    """
+    source, size, roughness, face = task
+    src_dirs, src_solid_angle = _face_directions(source.shape[1])
+    light_dir = src_dirs.reshape(-1, 3)
+    colors = source.reshape(-1, 3)
+    solid_angle = src_solid_angle.reshape(-1)
+    normals = _face_directions(size)[0][face].reshape(-1, 3)
+    alpha = max(roughness*roughness, 0.0001)
+    alpha_sq = alpha*alpha
+    result = numpy.empty((normals.shape[0], 3), dtype=numpy.float32)
+    for start in range(0, normals.shape[0], _CHUNK):
+        n_dot_l = numpy.dot(normals[start:start+_CHUNK], light_dir.T)
+        # H is normalize(N+L), so NdotH^2 is (1+NdotL)/2
+        n_dot_h_sq = numpy.clip((1.0+n_dot_l)*0.5, 0.0, 1.0)
+        ggx = alpha_sq/(numpy.pi*(n_dot_h_sq*(alpha_sq-1.0)+1.0)**2)
+        weight = ggx*numpy.maximum(n_dot_l, 0.0)*solid_angle
+        total = numpy.maximum(weight.sum(axis=1), 1e-8)
+        result[start:start+_CHUNK] = numpy.dot(weight, colors)/total[:, None]
+    return result.reshape(size, size, 3)
+
+
+def _irradiance_sh(source):
+    """
+    Returns 9 spherical harmonics coefficients (rgb) of the irradiance
+    of a cube map, already divided by pi - the diffuse light for a normal
+    is the sum of coefficient*basis(normal)
+    """
+    faces = _resize(source, min(source.shape[1], 32))
+    dirs, solid_angle = _face_directions(faces.shape[1])
+    x, y, z = dirs[..., 0], dirs[..., 1], dirs[..., 2]
+    basis = (0.282095*numpy.ones_like(x),
+             0.488603*y, 0.488603*z, 0.488603*x,
+             1.092548*x*y, 1.092548*y*z, 0.315392*(3.0*z*z-1.0),
+             1.092548*x*z, 0.546274*(x*x-y*y))
+    # cosine lobe convolution (Ramamoorthi and Hanrahan 2001)
+    band = (1.0, 2.0/3.0, 2.0/3.0, 2.0/3.0, 0.25, 0.25, 0.25, 0.25, 0.25)
+    return numpy.array([(faces*(b*solid_angle)[..., None]).sum(axis=(0, 1, 2))*band[i]
+                        for i, b in enumerate(basis)], dtype=numpy.float32)
+
+
+def prefilter_cubemap(source, size=128, levels=6, processes=None):
+    """
+    Prefilters a cube map for image based lighting,
+    source - linear rgb faces (6, n, n, 3)
+    size - size of the first mip level
+    levels - mip levels with a roughness from 0 to 1, the smaller
+             mip levels after them all have a roughness of 1
+    processes - worker processes, None for one per cpu (on linux without
+                threading-model), 0 or 1 to do it all in this process
+    Returns a list of mip levels (6, size, size, 3) and the irradiance
+    spherical harmonics (9, 3)
+    """
+    if processes is None:
+        processes = _default_processes()
+    elif processes > 1 and not _can_fork():
+        print('Prefiltering the cube map in this process, it can not be forked')
+        processes = 1
+    tasks = []
+    level_sizes = []
+    level_size = size//2
+    level = 1
+    while level_size >= 1:
+        roughness = min(float(level)/(levels-1), 1.0)
+        level_source = _resize(source, min(source.shape[1], max(level_size, 16)))
+        for face in range(6):
+            tasks.append((level_source, level_size, roughness, face))
+        level_sizes.append(level_size)
+        level_size //= 2
+        level += 1
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_prefilter_face, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_prefilter_face(task) for task in tasks]
+    mips = [_resize(source, size).astype(numpy.float32)]
+    for i in range(len(level_sizes)):
+        mips.append(numpy.stack(results[i*6:i*6+6]))
+    return mips, _irradiance_sh(source)
+
+
+def cube_to_array(cube_tex):
+    """
+    Returns the faces of a cube map texture as linear rgb floats (6, n, n, 3)
+    and the raw image data
+    """
+    size = cube_tex.get_x_size()
+    raw = memoryview(cube_tex.get_ram_image_as('RGB')).tobytes()
+    width = cube_tex.get_component_width()
+    if width == 4:
+        faces = numpy.frombuffer(raw, dtype=numpy.float32).copy()
+    elif width == 2:
+        faces = numpy.frombuffer(raw, dtype=numpy.uint16)/65535.0
+    else:
+        faces = numpy.frombuffer(raw, dtype=numpy.uint8)/255.0
+    faces = faces.reshape(6, size, size, 3).astype(numpy.float32)
+    if width != 4:
+        # the skyboxes are srgb
+        faces = numpy.where(faces <= 0.04045, faces/12.92, ((faces+0.055)/1.055)**2.4)
+    return faces, raw
+
+
+def make_cube_texture(mips, name='ibl_cube'):
+    """
+    Returns a float cube map texture with the given mip levels
+    """
+    tex = Texture(name)
+    tex.setup_cube_map(mips[0].shape[1], Texture.T_float, Texture.F_rgb16)
+    for level, mip in enumerate(mips):
+        # panda keeps the colors as bgr
+        data = numpy.ascontiguousarray(mip[..., ::-1], dtype=numpy.float32).tobytes()
+        if level == 0:
+            tex.set_ram_image(data)
+        else:
+            tex.set_ram_mipmap_image(level, data)
+    tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+    tex.set_magfilter(SamplerState.FT_linear)
+    return tex
+
+
+def get_ibl(cube_tex, cache_dir='cache/ibl', size=128, levels=6, processes=None):
+    """
+    Returns a prefiltered cube map texture, the irradiance spherical
+    harmonics (PTALVecBase3f) and the mip level with a roughness of 1
+    for a cube map texture. The results are cached in cache_dir, by the
+    content of the cube map, a cube map is only prefiltered once.
+    """
+    if numpy is None:
+        raise RuntimeError('Prefiltering cube maps needs numpy')
+    source, raw = cube_to_array(cube_tex)
+    key = hashlib.sha1(raw)
+    key.update(repr((source.shape, size, levels, _VERSION)).encode())
+    path = os.path.join(cache_dir, key.hexdigest()+'.npz')
+    mips = None
+    if os.path.exists(path):
+        try:
+            data = numpy.load(path)
+            count = int(data['count'])
+            mips = [data['mip_{0}'.format(i)] for i in range(count)]
+            sh = data['sh']
+        except (IOError, KeyError, ValueError) as err:
+            print('IBL cache file broken, prefiltering again', path, err)
+            mips = None
+    if mips is None:
+        mips, sh = prefilter_cubemap(source, size, levels, processes)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            arrays = {'mip_{0}'.format(i): mip for i, mip in enumerate(mips)}
+            numpy.savez(path, count=len(mips), sh=sh, **arrays)
+        except (IOError, OSError) as err:
+            print('Could not write the IBL cache', path, err)
+    sh_pta = PTALVecBase3f()
+    for coef in sh:
+        sh_pta.push_back(Vec3(*coef))
+    return make_cube_texture(mips), sh_pta, levels-1
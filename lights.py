@@ -1,11 +1,17 @@
-import math, sys
+import math, sys, weakref
 if sys.version_info >= (3, 0):
     import builtins
 else:
     import __builtin__ as builtins
 
-from panda3d.core import Vec3, PTALVecBase3f, Point3, BitMask32, Vec4, deg2Rad, DepthTestAttrib, RenderAttrib, \
-    CullFaceAttrib, ColorBlendAttrib, DepthWriteAttrib
+from panda3d.core import Vec3, PTALVecBase3f, Point3, Vec4, deg2Rad, NodePath
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# all the SphereLights and ConeLights, for LightLOD
+_lod_lights = weakref.WeakSet()
 
 
 class SceneLight(object):
@@ -151,9 +157,11 @@ class SphereLight(object):
     l.pos=Point3(...)
     l.color=(r,g,b)
     l.radius= 13
+
+    shadow_filter can be None (PCF), 'esm' or 'vsm', see DeferredRenderer.set_shadow_filter()
     """
 
-    def __init__(self, color, pos, radius, shadow_size=None, shadow_bias=None):
+    def __init__(self, color, pos, radius, shadow_size=None, shadow_bias=None, shadow_filter=None):
         if not hasattr(builtins, 'deferred_renderer'):
             raise RuntimeError('You need a DeferredRenderer')
         self.__radius = radius
@@ -167,6 +175,13 @@ class SphereLight(object):
                                                                       radius=radius,
                                                                       shadow_size=shadow_size)
         self.set_shadow_bias(shadow_bias)
+        self.shader_name = 'point_light'
+        self.has_shadow = bool(shadow_size)
+        self.shadow_filter = None
+        if self.has_shadow:
+            self.set_shadow_filter(shadow_filter)
+        self.lod_level = LightLOD.SHADOWED if self.has_shadow else LightLOD.UNSHADOWED
+        _lod_lights.add(self)
 
     def attach_to(self, node, offset=(0,0,0)):
         self.light_id=len(deferred_renderer.attached_lights)
@@ -177,43 +192,46 @@ class SphereLight(object):
             del deferred_renderer.attached_lights[self.light_id]
 
     def set_shadow_size(self, size):
+        if self.geom.has_python_tag('light_pool_key'):
+            self.geom.set_python_tag('light_pool_key', ('point_light', 'models/sphere', max(size, 0)))
         if size >0:
-            self.p3d_light.node().set_shadow_caster(True, size, size)
-            self.p3d_light.node().set_camera_mask(BitMask32.bit(13))
-            for i in range(6):
-                self.p3d_light.node().get_lens(i).set_near_far(0.1, self.__radius)
-                self.p3d_light.node().get_lens(i).make_bounds()
-
-            shader=loader.load_shader_GLSL(deferred_renderer.v.format('point_light_shadow'),
-                                           deferred_renderer.f.format('point_light_shadow'),
-                                           deferred_renderer.shading_setup)
-            self.geom.set_shader(shader)
+            deferred_renderer.restore_light_shadow(self.p3d_light)
+            deferred_renderer.set_point_light_shadow(self.geom, self.p3d_light, size, self.__radius)
             self.geom.set_shader_input('shadowcaster', self.p3d_light)
             self.set_shadow_bias(self.shadow_bias)
+            self.has_shadow = True
+            # also sets the shader, the shadow map might be a new one
+            self.set_shadow_filter(self.shadow_filter)
+            self.lod_level = LightLOD.SHADOWED
         else:
-            self.p3d_light.node().set_shadow_caster(False)
+            self.has_shadow = False
+            self.lod_level = LightLOD.UNSHADOWED
             shader=loader.load_shader_GLSL(deferred_renderer.v.format('point_light'),
                                            deferred_renderer.f.format('point_light'),
                                            deferred_renderer.shading_setup)
             self.geom.set_shader(shader)
-            try:
-                buff = self.p3d_light.node().get_shadow_buffer(base.win.get_gsg())
-                buff.clear_render_textures()
-                base.win.get_gsg().get_engine().remove_window(buff)
-            except:
-                pass
+            # the buffer might still be used by the cull/draw threads
+            deferred_renderer.remove_light_shadow(self.p3d_light)
 
     def set_shadow_bias(self, bias):
         self.shadow_bias=bias
         if bias is not None:
-            self.geom.set_shader_input("bias", bias)
+            deferred_renderer.set_node_input(self.geom, "bias", bias)
+
+    def set_shadow_filter(self, shadow_filter):
+        """
+        Sets the shadow filter, None (PCF), 'esm' or 'vsm'
+        """
+        self.shadow_filter = shadow_filter
+        if self.has_shadow:
+            deferred_renderer.set_shadow_filter(self.geom, self.p3d_light, shadow_filter)
 
 
     def set_color(self, color):
         """
         Sets light color
         """
-        self.geom.set_shader_input("light", Vec4(
+        deferred_renderer.set_node_input(self.geom, "light", Vec4(
             color, self.__radius * self.__radius))
         self.__color = color
 
@@ -221,14 +239,10 @@ class SphereLight(object):
         """
         Sets light radius
         """
-        self.geom.set_shader_input("light", Vec4(self.__color, radius * radius))
+        deferred_renderer.set_node_input(self.geom, "light", Vec4(self.__color, radius * radius))
         self.geom.set_scale(radius)
         self.__radius = radius
-        try:
-            for i in range(6):
-                self.p3d_light.node().get_lens(i).set_near_far(0.1, radius)
-        except:
-            pass
+        deferred_renderer.set_point_shadow_radius(self.p3d_light, radius)
 
     def set_pos(self, *args):
         """
@@ -255,17 +269,14 @@ class SphereLight(object):
         self.p3d_light.set_pos(render, pos)
 
     def remove(self):
-        self.geom.remove_node()
-        try:
-            buff = self.p3d_light.node().get_shadow_buffer(base.win.get_gsg())
-            buff.clear_render_textures()
-            base.win.get_gsg().get_engine().remove_window(buff)
-            self.p3d_light.node().set_shadow_caster(False)
-        except:
-            pass
+        """
+        Removes the light, the light volume goes back to the light pool
+        """
+        deferred_renderer.release_light(self.geom, self.p3d_light)
+        self.geom = NodePath()
+        self.p3d_light = NodePath()
         if self.light_id and self.light_id in deferred_renderer.attached_lights:
             del deferred_renderer.attached_lights[self.light_id]
-        self.p3d_light.remove_node()
 
     def __del__(self):
         try:
@@ -298,6 +309,14 @@ class SphereLight(object):
     def radius(self, r):
         self.set_radius(float(r))
 
+    @property
+    def shadow_faces(self):
+        """
+        Shadow map faces rendered and skipped for this light,
+        see DeferredRenderer.get_shadow_face_stats()
+        """
+        return deferred_renderer.get_shadow_face_stats(self.p3d_light)
+
 
 class ConeLight(object):
     """
@@ -316,10 +335,12 @@ class ConeLight(object):
     l.fov=45.0
     l.hpr=Point3(...)
     the lookAt() function can also be used to set a hpr in a different way
+
+    shadow_filter can be None (PCF), 'esm' or 'vsm', see DeferredRenderer.set_shadow_filter()
     """
 
     def __init__(self, color, pos, radius, fov, hpr=None,
-                look_at=None, exponent=40, shadow_size=0, bias=0.0005):
+                look_at=None, exponent=40, shadow_size=0, bias=0.0005, shadow_filter=None):
         if not hasattr(builtins, 'deferred_renderer'):
             raise RuntimeError('You need a DeferredRenderer')
         self.__radius = radius
@@ -344,6 +365,13 @@ class ConeLight(object):
                                                                      fov=fov,
                                                                      shadow_size=shadow_size,
                                                                      bias=bias)
+        self.shader_name = 'spot_light'
+        self.has_shadow = shadow_size > 0
+        self.shadow_filter = None
+        if self.has_shadow:
+            self.set_shadow_filter(shadow_filter)
+        self.lod_level = LightLOD.SHADOWED if self.has_shadow else LightLOD.UNSHADOWED
+        _lod_lights.add(self)
     def set_exponent(self, exponent):
         self.p3d_light.node().set_exponent(exponent)
 
@@ -356,47 +384,22 @@ class ConeLight(object):
         if fov > 179.0:
             fov = 179.0
         self.p3d_light.node().get_lens().set_fov(fov)
-        # we might as well start from square 1...
-        self.geom.remove_node()
-        xy_scale = math.tan(deg2Rad(fov * 0.5))
-        self.geom = loader.load_model("models/cone")
-        self.geom.reparent_to(deferred_renderer.light_root)
-        self.geom.set_scale(xy_scale, 1.0, xy_scale)
-        self.geom.flatten_strong()
-        self.geom.set_scale(self.__radius)
-        self.geom.set_pos(self.__pos)
-        self.geom.set_hpr(self.__hpr)
-        self.geom.set_attrib(DepthTestAttrib.make(RenderAttrib.MLess))
-        self.geom.set_attrib(CullFaceAttrib.make(
-            set_attrib.MCullCounterClockwise))
-        self.geom.setAttrib(ColorBlendAttrib.make(
-            set_attrib.MAdd, ColorBlendAttrib.OOne, ColorBlendAttrib.OOne))
-        self.geom.set_attrib(DepthWriteAttrib.make(DepthWriteAttrib.MOff))
-        self.geom.set_shader(loader.loadShaderGLSL(deferred_renderer.v.format(
-            'spot_light'), deferred_renderer.f.format('spot_light'), deferred_renderer.shading_setup))
-        try:
-            self.geom.set_shader_inputs(light_radius= float(self.__radius),
-                                    light_pos= Vec4(self.__pos, 1.0),
-                                    light_fov= deg2Rad(fov),
-                                    spot= self.p3d_light)
-        except AttributeError:
-            self.geom.set_shader_input('light_radius', float(self.__radius))
-            self.geom.set_shader_input('light_pos', Vec4(self.__pos, 1.0))
-            self.geom.set_shader_input('light_fov', deg2Rad(fov))
-            self.geom.set_shader_input('spot', self.p3d_light)
+        deferred_renderer.set_cone_light_shape(self.geom, self.__radius, fov)
+        deferred_renderer.set_node_input(self.geom, 'light_fov', deg2Rad(fov))
         self.__fov = fov
 
     def set_radius(self, radius):
         """
         Sets the radius (range) of the light
         """
-        self.geom.set_shader_input("light_radius", float(radius))
-        self.geom.set_scale(radius)
+        deferred_renderer.set_node_input(self.geom, "light_radius", float(radius))
+        deferred_renderer.set_cone_light_shape(self.geom, radius, self.__fov)
         self.__radius = radius
         try:
             self.p3d_light.node().get_lens().set_near_far(0.1, radius)
         except:
             pass
+        deferred_renderer.update_shadow_prefilter_range(self.p3d_light)
 
     def setHpr(self, hpr):
         """
@@ -445,22 +448,28 @@ class ConeLight(object):
     def set_shadow_bias(self, bias):
         self.__shadow_bias=bias
         if bias is not None:
-            self.geom.set_shader_input("bias", bias)
+            deferred_renderer.set_node_input(self.geom, "bias", bias)
+
+    def set_shadow_filter(self, shadow_filter):
+        """
+        Sets the shadow filter, None (PCF), 'esm' or 'vsm'
+        """
+        self.shadow_filter = shadow_filter
+        if self.has_shadow:
+            deferred_renderer.set_shadow_filter(self.geom, self.p3d_light, shadow_filter)
 
     def remove(self):
-        self.geom.removeNode()
-        try:
-            buff = self.p3d_light.node().get_shadow_buffer(base.win.get_gsg())
-            buff.clear_render_textures()
-            base.win.get_gsg().get_engine().remove_window(buff)
-            self.p3d_light.node().set_shadow_caster(False)
-        except:
-            pass
-        self.p3d_light.remove_node()
+        """
+        Removes the light, the light volume goes back to the light pool
+        """
+        deferred_renderer.release_light(self.geom, self.p3d_light)
+        self.geom = NodePath()
+        self.p3d_light = NodePath()
 
     def __del__(self):
         try:
-            self.remove()
+            if not self.geom.is_empty():
+                self.remove()
         except:
             pass
 
@@ -502,4 +511,193 @@ class ConeLight(object):
 
     @radius.setter
     def radius(self, r):
-        self.set_radius(float(r))
\ No newline at end of file
+        self.set_radius(float(r))
+
+
+class LightLOD(object):
+    """
+    Level of detail for SphereLights and ConeLights.
+    Each frame the size of each light on screen is measured (radius over
+    distance, as a fraction of the screen height) and the light gets:
+        SHADOWED - the full shader with shadows (if the light has shadows)
+        UNSHADOWED - the shader without shadows, above unshadowed_size
+        SIMPLE - no specular, simple falloff (SIMPLE_FALLOFF), above simple_size
+        HIDDEN - not drawn at all, below simple_size
+    Shadow buffers of lights that are not SHADOWED are deactivated, not removed,
+    so switching back is cheap. Use get_counts() to see how many lights are
+    on each level. Only one LightLOD should be used.
+    """
+    SHADOWED = 0
+    UNSHADOWED = 1
+    SIMPLE = 2
+    HIDDEN = 3
+    LEVEL_NAMES = ('shadowed', 'unshadowed', 'simple', 'hidden')
+
+    def __init__(self, shadow_size=0.4, unshadowed_size=0.15, simple_size=0.02, hysteresis=0.1):
+        if not hasattr(builtins, 'deferred_renderer'):
+            raise RuntimeError('You need a DeferredRenderer')
+        self.thresholds = [shadow_size, unshadowed_size, simple_size]
+        self.hysteresis = hysteresis
+        self.counts = {name: 0 for name in self.LEVEL_NAMES}
+        taskMgr.add(self._update, 'light_lod_tsk', sort=-160)
+
+    def set_thresholds(self, shadow_size=None, unshadowed_size=None, simple_size=None):
+        """
+        Sets the screen sizes (fraction of the screen height) below
+        which lights drop to the next level, None keeps the current value
+        """
+        for i, size in enumerate((shadow_size, unshadowed_size, simple_size)):
+            if size is not None:
+                self.thresholds[i] = size
+
+    def get_counts(self):
+        """
+        Returns a dict with the number of lights on each level in the last frame
+        """
+        return dict(self.counts)
+
+    def get_screen_size(self, light):
+        """
+        Returns the size of a light on screen, as a fraction of the screen height
+        """
+        distance = light.geom.get_distance(base.cam)
+        if distance <= light.radius:
+            return float('inf')
+        fov = base.cam.node().get_lens().get_fov()[1]
+        return light.radius / (distance * math.tan(deg2Rad(fov * 0.5)))
+
+    def get_level(self, light):
+        """
+        Returns the level a light should have now
+        """
+        size = self.get_screen_size(light)
+        level = self.HIDDEN
+        for i, threshold in enumerate(self.thresholds):
+            # harder to go up a level than to stay there
+            if i < light.lod_level:
+                threshold *= 1.0 + self.hysteresis
+            if size > threshold:
+                level = i
+                break
+        if level == self.SHADOWED and not light.has_shadow:
+            level = self.UNSHADOWED
+        return level
+
+    def set_level(self, light, level):
+        """
+        Switches a light to a level
+        """
+        if level == light.lod_level:
+            return
+        if level == self.HIDDEN:
+            light.geom.hide()
+        else:
+            light.geom.show()
+            define = deferred_renderer.shading_setup
+            name = light.shader_name
+            if level == self.SHADOWED:
+                name += '_shadow'
+                define = deferred_renderer.get_shadow_filter_define(light.shadow_filter)
+            elif level == self.SIMPLE:
+                define = dict(define, SIMPLE_FALLOFF=1)
+            light.geom.set_shader(loader.load_shader_GLSL(deferred_renderer.v.format(name),
+                                                          deferred_renderer.f.format(name),
+                                                          define))
+        if light.has_shadow:
+            deferred_renderer.set_shadow_buffer_active(light.p3d_light, level == self.SHADOWED)
+        light.lod_level = level
+
+    def _update(self, task):
+        counts = {name: 0 for name in self.LEVEL_NAMES}
+        for light in list(_lod_lights):
+            if light.geom.is_empty():
+                continue
+            level = self.get_level(light)
+            self.set_level(light, level)
+            counts[self.LEVEL_NAMES[level]] += 1
+        self.counts = counts
+        return task.again
+
+    def remove(self):
+        """
+        Stops the LOD, all lights go back to their full level
+        """
+        taskMgr.remove('light_lod_tsk')
+        for light in list(_lod_lights):
+            if not light.geom.is_empty():
+                if light.has_shadow:
+                    self.set_level(light, self.SHADOWED)
+                else:
+                    self.set_level(light, self.UNSHADOWED)
+
+
+class LightArray(object):
+    """
+    Many point lights (without shadows) driven by numpy arrays.
+    All the lights are drawn as one instanced light volume,
+    there are no per light nodes or shader inputs.
+
+    The pos (N x 3), color (N x 3) and radius (N) arrays can be written
+    to directly eg.
+    torches=LightArray(positions, colors, radii)
+    torches.radius[:]=base_radii*numpy.random.uniform(0.9, 1.1, len(torches))
+    torches.pos[10]=(1, 2, 3)
+    Positions are relative to render, a light with a radius of 0 is not drawn.
+    The arrays are written to the light buffer once per frame if they
+    changed (after tasks with sort < 45) or when flush() is called.
+    Requires numpy.
+    """
+
+    def __init__(self, positions, colors, radii):
+        if not hasattr(builtins, 'deferred_renderer'):
+            raise RuntimeError('You need a DeferredRenderer')
+        if numpy is None:
+            raise RuntimeError('LightArray needs numpy')
+        self.pos = numpy.array(positions, dtype=numpy.float32).reshape(-1, 3)
+        count = len(self.pos)
+        self.color = numpy.array(colors, dtype=numpy.float32).reshape(count, 3)
+        self.radius = numpy.array(radii, dtype=numpy.float32).reshape(count)
+        self._data = numpy.zeros((count, 2, 4), dtype=numpy.float32)
+        self._last_data = None
+        self.geom, self.tex = deferred_renderer.add_light_array(count)
+        self.flush()
+        self._task_name = 'light_array_flush_{0}'.format(id(self))
+        # the task only has a weak reference, so the array can be
+        # garbage collected without calling remove()
+        taskMgr.add(_flush_light_array, self._task_name, sort=45,
+                    extraArgs=[weakref.ref(self)], appendTask=True)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def flush(self):
+        """
+        Writes the arrays to the light buffer
+        """
+        self._data[:, 0, :3] = self.pos
+        self._data[:, 0, 3] = self.radius
+        self._data[:, 1, :3] = self.color
+        if self._last_data is not None and numpy.array_equal(self._data, self._last_data):
+            return
+        memoryview(self.tex.modify_ram_image())[:] = self._data.tobytes()
+        self._last_data = self._data.copy()
+        deferred_renderer.mark_changed()
+
+    def remove(self):
+        taskMgr.remove(self._task_name)
+        self.geom.remove_node()
+
+    def __del__(self):
+        try:
+            if not self.geom.is_empty():
+                self.remove()
+        except:
+            pass
+
+
+def _flush_light_array(light_array_ref, task):
+    light_array = light_array_ref()
+    if light_array is None:
+        return task.done
+    light_array.flush()
+    return task.again
@@ -37,10 +37,11 @@ config_full={'shadows': 1024,
                             'name': 'base_bloom',
                             'shader': 'bloom'},
                             {'translate_tex_name': {'base_bloom': 'input_tex'},
-                            'inputs': {'blur': 3.0},
+                            'inputs': {'blur': 1.0},
                             'size': 0.5,
+                            'levels': 6,
                             'name': 'bloom',
-                            'shader': 'blur'},
+                            'shader': 'pyramid'},
                             {'shader': 'ssr',
                             'name': 'base_ssr',
                             'define': {'maxDelta': 0.044, 'rayLength': 0.034, 'stepsCount': 16, 'fade': 0.3}},
@@ -97,6 +98,8 @@ class Demo(DirectObject):
                                            zoom_speed=2.0,
                                            limits=(2.0, 30.0, -40, 40.0))
         self.cam_controler.bind_keys()
+        #don't let RENDER_ON_DEMAND go idle while the camera is moving
+        deferred_renderer.add_idle_check(self.cam_controler.is_idle)
         #attach light_1 to the camera node
         self.light_1.attach_to(self.cam_controler.node, Point3(0,0,3))
 
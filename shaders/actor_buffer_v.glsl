@@ -0,0 +1,73 @@
+//GLSL
+#version 140
+in vec2 p3d_MultiTexCoord0;
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+in vec3 p3d_Tangent;
+in vec3 p3d_Binormal;
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat4 p3d_ModelMatrix;
+uniform mat3 p3d_NormalMatrix;
+
+//hw animation, matrices are read from a buffer texture
+in vec4 joint_weight;
+in uvec4 joint_index;
+uniform samplerBuffer joint_table;
+// first matrix of this actor in the table
+uniform int joint_offset;
+// number of matrices for each instance (root + joints)
+uniform int joint_stride;
+
+out vec2 UV;
+out vec3 T;
+out vec3 B;
+out vec3 N;
+out vec3 TS_V;
+// distance to the camera, for the parallax fade
+out float view_distance;
+
+mat4 get_joint(int id)
+    {
+    int texel = id*4;
+    return mat4(texelFetch(joint_table, texel),
+                texelFetch(joint_table, texel+1),
+                texelFetch(joint_table, texel+2),
+                texelFetch(joint_table, texel+3));
+    }
+
+void main()
+    {
+    // the first matrix of each instance places the instance,
+    // the joint matrices follow it
+    int first = joint_offset + gl_InstanceID * joint_stride;
+    mat4 root = get_joint(first);
+    first += 1;
+    //hardware skinning
+    mat4 matrix = get_joint(first+int(joint_index.x)) * joint_weight.x
+              + get_joint(first+int(joint_index.y)) * joint_weight.y
+              + get_joint(first+int(joint_index.z)) * joint_weight.z
+              + get_joint(first+int(joint_index.w)) * joint_weight.w;
+    matrix = root * matrix;
+
+    vec4 vert=matrix * p3d_Vertex;
+    mat3 matrix3=mat3(matrix);
+
+    vec3 normal=matrix3*p3d_Normal;
+    vec3 tangent=matrix3*p3d_Tangent;
+    vec3 binormal =matrix3*p3d_Binormal;
+
+    gl_Position = p3d_ModelViewProjectionMatrix * vert;
+
+    T=mat3(p3d_ModelViewMatrix) * tangent;
+    B=mat3(p3d_ModelViewMatrix) * binormal;
+    N=p3d_NormalMatrix * normal;
+
+    mat3 TBN = transpose(mat3(T,B,N));
+    vec4 V=p3d_ModelViewMatrix * vert;
+    TS_V = TBN * V.xyz;
+    view_distance = length(V.xyz);
+
+    UV = p3d_MultiTexCoord0;
+    }
@@ -8,25 +8,13 @@ uniform float sample_rad;
 uniform float strength;
 uniform float falloff;
 uniform float amount;
+#ifdef HIZ_LEVELS
+uniform sampler2D hiz_tex;
+#endif
 
 out vec4 p3d_FragData;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#pragma include "inc_gbuffer.glsl"
 
 
 void main()
@@ -36,8 +24,11 @@ void main()
     vec2 win_size=textureSize(depth_tex, 0).xy;
     vec2 uv=gl_FragCoord.xy/win_size;
 
+    //the occlusion is measured in hardware depth (strength and falloff are
+    //tuned for it), no view position is needed, so this shader does not
+    //read view_pos_tex with VIEW_POS_PREPASS
     float pixel_depth = texture(depth_tex, uv).r;
-    vec3 pixel_normal = unpack_normal_octahedron(texture(normal_tex,uv).xy);
+    vec3 pixel_normal = unpack_normal_octahedron(read_gbuffer_normal(normal_tex, uv).xy);
     vec3 random_vector = normalize((texture(random_tex, uv * 18.0 + pixel_depth + pixel_normal.xy).xyz * 2.0) - vec3(1.0)).xyz;
 
     float occlusion = 0.0;
@@ -50,8 +41,17 @@ void main()
         {
         ray = radius * reflect(sphere[i], random_vector);
 
-        sample_normal = unpack_normal_octahedron(texture(normal_tex, uv+ ray.xy).xy);
+        sample_normal = unpack_normal_octahedron(read_gbuffer_normal(normal_tex, uv+ ray.xy).xy);
+        #ifdef HIZ_LEVELS
+        //samples far from the pixel read the half resolution min depth
+        if (length(sphere[i]) > 0.5)
+            depth_difference =  (pixel_depth - texture(hiz_tex, uv + ray.xy).r);
+        else
+            depth_difference =  (pixel_depth - texture(depth_tex, uv + ray.xy).r);
+        #endif
+        #ifndef HIZ_LEVELS
         depth_difference =  (pixel_depth - texture(depth_tex, uv + ray.xy).r);
+        #endif
         occlusion += step(-strength, depth_difference) * (1.0 - dot(sample_normal.xyz, pixel_normal)) * (1.0 - smoothstep(-strength, falloff, depth_difference));
         }
   //occlusion *= 0.125;// 1/num_samples
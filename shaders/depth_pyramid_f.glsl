@@ -0,0 +1,41 @@
+//GLSL
+#version 140
+uniform sampler2D input_tex;
+
+out vec4 p3d_FragData;
+
+// size of the area of the source read for one output pixel
+#ifndef FOOTPRINT
+#define FOOTPRINT 2
+#endif
+
+//min depth in red, max depth in green
+vec2 read_depth(ivec2 pos)
+    {
+    #ifdef FROM_DEPTH
+    return vec2(texelFetch(input_tex, pos, 0).r);
+    #endif
+    #ifndef FROM_DEPTH
+    return texelFetch(input_tex, pos, 0).rg;
+    #endif
+    }
+
+void main()
+    {
+    ivec2 src_size=textureSize(input_tex, 0).xy;
+    ivec2 src_pos=ivec2(gl_FragCoord.xy)*FOOTPRINT;
+    //sources not divisible by the footprint need one more row/column on the edge
+    ivec2 extent=ivec2(FOOTPRINT)+ivec2(notEqual(src_size % FOOTPRINT, ivec2(0)));
+
+    vec2 min_max=vec2(1.0, 0.0);
+    for (int x=0; x<extent.x; ++x)
+        {
+        for (int y=0; y<extent.y; ++y)
+            {
+            vec2 depth=read_depth(min(src_pos+ivec2(x, y), src_size-ivec2(1)));
+            min_max.x=min(min_max.x, depth.x);
+            min_max.y=max(min_max.y, depth.y);
+            }
+        }
+    p3d_FragData=vec4(min_max, 0.0, 0.0);
+    }
@@ -1,11 +1,20 @@
 //GLSL
 #version 140
 uniform sampler2D depth_tex;
+#ifdef VIEW_POS_PREPASS
+uniform sampler2D view_pos_tex;
+#endif
 uniform sampler2D normal_tex;
 uniform sampler2D albedo_tex;
 uniform sampler2D lit_tex;
 uniform mat4 p3d_ProjectionMatrixInverse;
 uniform vec3 ambient;
+#ifdef IBL_PREFILTERED
+//irradiance of the environment cube map as spherical harmonics
+uniform vec3 ibl_sh[9];
+uniform float ibl_diffuse;
+uniform mat4 trans_apiview_of_camera_to_world;
+#endif
 #ifndef NUM_LIGHTS
 uniform vec3 light_color;
 uniform vec3 direction;
@@ -22,34 +31,35 @@ in vec4 light_direction[NUM_LIGHTS];
 
 out vec4 p3d_FragData;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    if (packed_nrm==vec2(0.0))
-        {
-            return vec3(0.0);
-        }
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#pragma include "inc_gbuffer.glsl"
 
 vec3 getPosition(vec2 uv, float depth)
     {
+    #ifdef VIEW_POS_PREPASS
+    return texture(view_pos_tex, uv).xyz;
+    #endif
+    #ifndef VIEW_POS_PREPASS
     vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     view_pos.xyz /= view_pos.w;
     return view_pos.xyz;
+    #endif
     }
 
+#ifdef IBL_PREFILTERED
+vec3 sh_irradiance(vec3 n)
+    {
+    return ibl_sh[0]*0.282095
+           +ibl_sh[1]*0.488603*n.y
+           +ibl_sh[2]*0.488603*n.z
+           +ibl_sh[3]*0.488603*n.x
+           +ibl_sh[4]*1.092548*n.x*n.y
+           +ibl_sh[5]*1.092548*n.y*n.z
+           +ibl_sh[6]*0.315392*(3.0*n.z*n.z-1.0)
+           +ibl_sh[7]*1.092548*n.x*n.z
+           +ibl_sh[8]*0.546274*(n.x*n.x-n.y*n.y);
+    }
+#endif
+
 vec3 do_specular(float roughness, vec3 tint,
                  float metallic, float NdotH,
                  float gloss, float base_roughness)
@@ -65,8 +75,11 @@ void main()
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
-    vec4 normal_roughness_metallic=texture(normal_tex,uv);
-    vec3 N=unpack_normal_octahedron(normal_roughness_metallic.xy);
+    vec4 normal_roughness_metallic=read_gbuffer_normal(normal_tex, uv);
+    //pixels without geometry get no light
+    vec3 N=vec3(0.0);
+    if (normal_roughness_metallic.xy != vec2(0.0))
+        N=unpack_normal_octahedron(normal_roughness_metallic.xy);
     float roughness =pow(normal_roughness_metallic.b, 0.5);
     float base_roughness =normal_roughness_metallic.b;
     float metallic=normal_roughness_metallic.a;
@@ -79,6 +92,11 @@ void main()
     vec3 view_pos =getPosition(uv, depth);
 
     vec3 color=ambient;
+    #ifdef IBL_PREFILTERED
+    //diffuse light from the environment
+    if (normal_roughness_metallic.xy != vec2(0.0))
+        color+=max(sh_irradiance(normalize(vec3(trans_apiview_of_camera_to_world*vec4(N, 0.0)))), vec3(0.0))*ibl_diffuse;
+    #endif
     vec3 spec=vec3(0.0);
     vec3 L;
     vec3 V=normalize(-view_pos.xyz);
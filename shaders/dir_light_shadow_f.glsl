@@ -1,6 +1,9 @@
 //GLSL
 #version 140
 uniform sampler2D depth_tex;
+#ifdef VIEW_POS_PREPASS
+uniform sampler2D view_pos_tex;
+#endif
 uniform sampler2D normal_tex;
 uniform sampler2D albedo_tex;
 uniform sampler2D lit_tex;
@@ -22,32 +25,18 @@ in vec4 light_direction[NUM_LIGHTS];
 
 out vec4 p3d_FragData;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    if (packed_nrm==vec2(0.0))
-        {
-            return vec3(0.0);
-        }
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#pragma include "inc_gbuffer.glsl"
 
 vec3 getPosition(vec2 uv, float depth)
     {
+    #ifdef VIEW_POS_PREPASS
+    return texture(view_pos_tex, uv).xyz;
+    #endif
+    #ifndef VIEW_POS_PREPASS
     vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     view_pos.xyz /= view_pos.w;
     return view_pos.xyz;
+    #endif
     }
 
 vec3 do_specular(float roughness, vec3 tint,
@@ -65,8 +54,11 @@ void main()
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
-    vec4 normal_roughness_metallic=texture(normal_tex,uv);
-    vec3 N=unpack_normal_octahedron(normal_roughness_metallic.xy);
+    vec4 normal_roughness_metallic=read_gbuffer_normal(normal_tex, uv);
+    //pixels without geometry get no light
+    vec3 N=vec3(0.0);
+    if (normal_roughness_metallic.xy != vec2(0.0))
+        N=unpack_normal_octahedron(normal_roughness_metallic.xy);
     float roughness =pow(normal_roughness_metallic.b, 0.5);
     float base_roughness =normal_roughness_metallic.b;
     float metallic=normal_roughness_metallic.a;
@@ -2,6 +2,9 @@
 #version 140
 uniform mat4 trans_apiclip_of_camera_to_apiview_of_camera;
 uniform sampler2D depth_tex;
+#ifdef VIEW_POS_PREPASS
+uniform sampler2D view_pos_tex;
+#endif
 uniform sampler2D input_tex;
 uniform vec3 fog_color;
 uniform float fog_start;
@@ -21,9 +24,14 @@ void main()
     {
     vec4 color=texture(input_tex,uv);
 
+    #ifdef VIEW_POS_PREPASS
+    vec4 view_pos = texture(view_pos_tex, uv);
+    #endif
+    #ifndef VIEW_POS_PREPASS
     float depth=texture(depth_tex,uv).r * 2.0 - 1.0;
     vec4 view_pos = trans_apiclip_of_camera_to_apiview_of_camera * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     view_pos.xyz /= view_pos.w;
+    #endif
 
     float dof=pow(min(max(view_pos.z+dof_far_max,0.0)/(dof_far_max-dof_far_start), 1.0), 2.0);
     dof+=pow(min(-view_pos.z/dof_near, 1.0), 2.0)-1.0;
@@ -5,17 +5,39 @@ in vec3 N;
 uniform sampler2D p3d_Texture0; //rgba color texture
 uniform sampler2D depth_tex;
 
+#ifdef FORWARD_OIT
+in float view_z;
+out vec4 p3d_FragData[2];
+#endif
+#ifndef FORWARD_OIT
 out vec4 p3d_FragData;
+#endif
 
 void main()
     {
     vec2 win_size=textureSize(depth_tex, 0).xy;
     vec4 color_map=texture(p3d_Texture0, UV);
     vec2 screen_uv=gl_FragCoord.xy/win_size;
+    #ifdef FORWARD_UPSAMPLE
+    //depth_tex is downsampled to the size of this buffer, max depth in green
+    float depth=texture(depth_tex, screen_uv).g;
+    #endif
+    #ifndef FORWARD_UPSAMPLE
     float depth=texture(depth_tex, screen_uv).r;
+    #endif
     vec3 n=normalize(N);
     if (depth <  gl_FragCoord.z)
         discard;
+    #ifdef FORWARD_OIT
+    // weighted blended OIT, weight function from McGuire and Bavoil 2013 (eq. 10)
+    float alpha=color_map.a;
+    float weight=alpha*clamp(0.03/(1e-5+pow(view_z/200.0, 4.0)), 1e-2, 3e3);
+    // color blend is one/one, alpha blend is zero/one_minus_src_alpha
+    p3d_FragData[0]=vec4(color_map.rgb*alpha*weight, alpha);
+    p3d_FragData[1]=vec4(alpha*weight, 0.0, 0.0, 0.0);
+    #endif
+    #ifndef FORWARD_OIT
     p3d_FragData=color_map;
     p3d_FragData[1]=vec4(n, 0.0);
+    #endif
     }
@@ -0,0 +1,17 @@
+//GLSL
+#version 140
+uniform sampler2D accum_tex;
+uniform sampler2D reveal_tex;
+
+out vec4 p3d_FragData;
+
+void main()
+    {
+    ivec2 pos=ivec2(gl_FragCoord.xy);
+    // rgb - sum of color*alpha*weight, a - product of (1-alpha)
+    vec4 accum=texelFetch(accum_tex, pos, 0);
+    // sum of alpha*weight
+    float weight=texelFetch(reveal_tex, pos, 0).r;
+    vec3 color=accum.rgb/max(weight, 1e-5);
+    p3d_FragData=vec4(color, 1.0-accum.a);
+    }
@@ -6,6 +6,10 @@ in vec3 p3d_Normal;
 
 uniform mat4 p3d_ModelViewProjectionMatrix;
 uniform mat3 p3d_NormalMatrix;
+#ifdef FORWARD_OIT
+uniform mat4 p3d_ModelViewMatrix;
+out float view_z;
+#endif
 
 out vec2 UV;
 out vec3 N;
@@ -15,4 +19,7 @@ void main()
     gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
     UV = p3d_MultiTexCoord0;
     N=p3d_NormalMatrix * p3d_Normal;
+    #ifdef FORWARD_OIT
+    view_z=-(p3d_ModelViewMatrix * p3d_Vertex).z;
+    #endif
     }
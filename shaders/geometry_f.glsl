@@ -5,42 +5,36 @@ in vec3 T;
 in vec3 B;
 in vec3 N;
 in vec3 TS_V;
+in float view_distance;
 //in vec4 V;
 
-out vec4 p3d_FragData;
+out vec4 p3d_FragData[2];
 
 uniform sampler2D tex_diffuse; //rgba color texture
 #ifndef DISABLE_NORMALMAP
 uniform sampler2D tex_normal; //rgba normal+gloss texture
 #endif
 uniform sampler2D tex_material; //rgma
+// rgma rows of the materials from set_material(), 0 = use tex_material
+uniform sampler2D material_table;
+uniform int material_index;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-// Packs a 3-component normal to 2 channels using octahedron normals
-vec2 pack_normal_octahedron(vec3 v)
-    {
-    // Faster version using newer GLSL capatibilities
-    v.xy /= dot(abs(v), vec3(1.0));
-    // Branch-Less version
-    return mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0.0));
-    }
-
+#pragma include "inc_gbuffer.glsl"
 
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+// parallax occlusion mapping step budget
+#ifndef POM_MAX_SAMPLES
+#define POM_MAX_SAMPLES 30
+#endif
+#ifndef POM_MIN_SAMPLES
+#define POM_MIN_SAMPLES 10
+#endif
+// with POM_FADE_END set, the parallax fades out (and the number of steps
+// goes down) between POM_FADE_START and POM_FADE_END units from the camera
+#ifdef POM_FADE_END
+#ifndef POM_FADE_START
+#define POM_FADE_START 0.0
+#endif
+#endif
 
 
 
@@ -48,12 +42,14 @@ vec3 unpack_normal_octahedron(vec2 packed_nrm)
 
 
 
-vec2 occlusionPallaxMapping(vec3 v, vec2 t)
+vec2 occlusionPallaxMapping(vec3 v, vec2 t, float fade)
 {
-    int     nMaxSamples         = 30;
-    int     nMinSamples         = 10;
-    float   fHeightMapScale     = 0.06;
-    int nNumSamples = int(mix(nMaxSamples, nMinSamples, abs(dot(vec3(0.0,0.0,1.0), v))));
+    int     nMaxSamples         = POM_MAX_SAMPLES;
+    int     nMinSamples         = POM_MIN_SAMPLES;
+    float   fHeightMapScale     = 0.06 * fade;
+    // more steps at grazing angles, less steps far away
+    int nNumSamples = int(mix(float(nMaxSamples), float(nMinSamples), abs(dot(vec3(0.0,0.0,1.0), v))));
+    nNumSamples = max(int(float(nNumSamples) * fade), 1);
     // height of each layer
     float fStepSize = 1.0 / float(nNumSamples);
     // Calculate the parallax offset vector max length.
@@ -121,13 +117,25 @@ void main()
     vec3 ts_v = normalize(TS_V);
     vec3 n=normalize(N);
     #ifndef DISABLE_POM
-        vec2 final_uv=occlusionPallaxMapping(ts_v, UV);
+        #ifdef POM_FADE_END
+        // TS_V is scaled by the model matrix, the view space distance is not
+        float pom_fade=1.0-smoothstep(float(POM_FADE_START), float(POM_FADE_END), view_distance);
+        // at fade 0.0 the loop runs just one step
+        vec2 final_uv=occlusionPallaxMapping(ts_v, UV, pom_fade);
+        #endif
+        #ifndef POM_FADE_END
+        vec2 final_uv=occlusionPallaxMapping(ts_v, UV, 1.0);
+        #endif
     #endif
     #ifdef DISABLE_POM
         vec2 final_uv=UV;
     #endif
 
-    vec4 rgma_map=texture(tex_material,final_uv);
+    vec4 rgma_map;
+    if (material_index > 0)
+        rgma_map=texelFetch(material_table, ivec2(material_index, 0), 0);
+    else
+        rgma_map=texture(tex_material,final_uv);
     if (rgma_map.a <0.5)
         discard;
 
@@ -148,7 +156,7 @@ void main()
     float glow=rgma_map.g;
     float metallic=rgma_map.b;
 
-    p3d_FragData=vec4(color_map.rgb, glow);
+    p3d_FragData[0]=vec4(color_map.rgb, glow);
     //p3d_FragData=vec4(1.0, 1.0, 1.0, 1.0);
-    //p3d_FragData[1]=vec4(pack_normal_octahedron(n.xyz), roughness, metallic);
+    p3d_FragData[1]=pack_gbuffer_normal(n.xyz, roughness, metallic);
     }
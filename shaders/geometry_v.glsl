@@ -16,6 +16,8 @@ out vec3 T;
 out vec3 B;
 out vec3 N;
 out vec3 TS_V;
+// distance to the camera, for the parallax fade
+out float view_distance;
 //out vec4 V;
 
 void main()
@@ -28,5 +30,6 @@ void main()
     mat3 TBN = transpose(mat3(T,B,N));
     vec4 V=p3d_ModelViewMatrix * p3d_Vertex;
     TS_V = TBN * V.xyz;
+    view_distance = length(V.xyz);
     UV = p3d_MultiTexCoord0;
     }
@@ -0,0 +1,58 @@
+//GLSL
+// Geometry buffer encoding and decoding shared by all the shaders,
+// use it with: #pragma include "inc_gbuffer.glsl"
+// The normal buffer holds the octahedron packed view space normal,
+// roughness and metallic. By default it's a 16 bit float target,
+// with COMPACT_GBUFFER it's a 32 bit unorm target (RGB10A2 or RGBA8)
+// and the packed normal is stored in the 0-1 range.
+// Pixels without geometry are cleared to 0.0
+
+// For each component of v, returns -1 if the component is < 0, else 1
+vec2 sign_not_zero(vec2 v)
+    {
+    // Version with branches (for GLSL < 4.00)
+    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
+    }
+
+// Packs a 3-component normal to 2 channels using octahedron normals
+vec2 pack_normal_octahedron(vec3 v)
+    {
+    // Faster version using newer GLSL capatibilities
+    v.xy /= dot(abs(v), vec3(1.0));
+    // Branch-Less version
+    return mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0.0));
+    }
+
+// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
+vec3 unpack_normal_octahedron(vec2 packed_nrm)
+    {
+    // Version using newer GLSL capatibilities
+    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
+    // Branch-Less version
+    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
+    return normalize(v);
+    }
+
+// Returns the value to write to the normal buffer
+vec4 pack_gbuffer_normal(vec3 normal, float roughness, float metallic)
+    {
+    vec2 packed_nrm=pack_normal_octahedron(normal);
+    #ifdef COMPACT_GBUFFER
+    packed_nrm=packed_nrm*0.5+0.5;
+    // 0.0 is reserved for pixels without geometry
+    packed_nrm.x=max(packed_nrm.x, 1.0/255.0);
+    #endif
+    return vec4(packed_nrm, roughness, metallic);
+    }
+
+// Reads the normal buffer, returns the packed normal in xy (-1...1),
+// roughness in z and metallic in w, pixels without geometry are all 0.0
+vec4 read_gbuffer_normal(sampler2D normal_tex, vec2 uv)
+    {
+    vec4 normal_roughness_metallic=texture(normal_tex, uv);
+    #ifdef COMPACT_GBUFFER
+    if (normal_roughness_metallic.xy != vec2(0.0))
+        normal_roughness_metallic.xy=normal_roughness_metallic.xy*2.0-1.0;
+    #endif
+    return normal_roughness_metallic;
+    }
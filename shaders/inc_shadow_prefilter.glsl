@@ -0,0 +1,40 @@
+//GLSL
+// Exponential (PREFILTER_ESM) and variance (PREFILTER_VSM) shadow maps,
+// shared by shadow_prefilter_f.glsl and the shadowed light shaders,
+// use it with: #pragma include "inc_shadow_prefilter.glsl"
+// The depth is linear, distance from the light divided by its range.
+#ifndef ESM_EXPONENT
+#define ESM_EXPONENT 40.0
+#endif
+// VSM light bleeding reduction, shadows below this value become black
+#ifndef VSM_BLEED
+#define VSM_BLEED 0.2
+#endif
+
+// What the prefilter stores for a depth, the average of this is blurred
+vec2 encode_shadow_depth(float depth)
+    {
+    #ifdef PREFILTER_ESM
+    return vec2(exp(ESM_EXPONENT*depth), 0.0);
+    #endif
+    #ifndef PREFILTER_ESM
+    return vec2(depth, depth*depth);
+    #endif
+    }
+
+// Light visibility (0-1) for a (bilinear filtered) prefiltered texel
+// and the depth of the shaded pixel
+float prefiltered_visibility(vec2 moments, float depth)
+    {
+    #ifdef PREFILTER_ESM
+    return clamp(moments.x*exp(-ESM_EXPONENT*depth), 0.0, 1.0);
+    #endif
+    #ifndef PREFILTER_ESM
+    if (depth <= moments.x)
+        return 1.0;
+    float variance=max(moments.y-moments.x*moments.x, 0.00002);
+    float d=depth-moments.x;
+    float p=variance/(variance+d*d);
+    return clamp((p-VSM_BLEED)/(1.0-VSM_BLEED), 0.0, 1.0);
+    #endif
+    }
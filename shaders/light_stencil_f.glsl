@@ -0,0 +1,10 @@
+//GLSL
+#version 140
+// used for the stencil pass of the light volumes,
+// color writes are off so the output is never written
+out vec4 p3d_FragData;
+
+void main()
+    {
+    p3d_FragData=vec4(0.0);
+    }
@@ -23,6 +23,11 @@ uniform sampler2D noise_tex;
 
 uniform sampler2D forward_aux_tex;
 //uniform vec2 win_size;
+#ifdef FORWARD_UPSAMPLE
+uniform sampler2D depth_tex;
+uniform sampler2D forward_depth_tex;
+uniform mat4 trans_apiclip_of_camera_to_apiview_of_camera;
+#endif
 
 out vec4 p3d_FragData;
 
@@ -48,11 +53,59 @@ vec3 srgbEncode(vec3 color){
    return vec3(r, g, b);
 }
 
+#ifdef FORWARD_UPSAMPLE
+float linear_depth(float depth)
+    {
+    vec4 view_pos = trans_apiclip_of_camera_to_apiview_of_camera * vec4(0.0, 0.0, depth * 2.0 - 1.0, 1.0);
+    return -view_pos.z/view_pos.w;
+    }
+
+// depth aware upsampling of the reduced size forward buffer:
+// if all 4 texels around the pixel are at the same depth as the pixel
+// use bilinear filtering, else use the texel closest in depth
+vec4 upsample_forward(vec2 uv)
+    {
+    vec2 low_size = vec2(textureSize(forward_tex, 0).xy);
+    ivec2 low_max = ivec2(low_size) - ivec2(1);
+    ivec2 low_pos = ivec2(floor(uv * low_size - 0.5));
+    float depth = linear_depth(texture(depth_tex, uv).r);
+
+    float max_delta = 0.0;
+    float best_delta = 1e20;
+    ivec2 best_pos = low_pos;
+    for (int i=0; i<4; ++i)
+        {
+        ivec2 pos = clamp(low_pos + ivec2(i & 1, i >> 1), ivec2(0), low_max);
+        float delta = abs(linear_depth(texelFetch(forward_depth_tex, pos, 0).g) - depth);
+        max_delta = max(max_delta, delta);
+        if (delta < best_delta)
+            {
+            best_delta = delta;
+            best_pos = pos;
+            }
+        }
+    if (max_delta < 0.1 * depth)
+        return texture(forward_tex, uv);
+    return texelFetch(forward_tex, best_pos, 0);
+    }
+#endif
+
 void main()
     {
+    #ifdef FORWARD_OIT
+    //the aux target of the forward pass holds the OIT weights, not distortion
+    vec2 final_uv=uv;
+    #endif
+    #ifndef FORWARD_OIT
     vec2 final_uv=uv+ (texture(forward_aux_tex, uv).rg);
+    #endif
     vec4 color=texture(final_color,final_uv);
+    #ifdef FORWARD_UPSAMPLE
+    vec4 color_forward=upsample_forward(uv);
+    #endif
+    #ifndef FORWARD_UPSAMPLE
     vec4 color_forward=texture(forward_tex,uv);
+    #endif
     vec2 win_size=textureSize(final_color, 0).xy;
     vec3 final_color=color.rgb;
 
@@ -0,0 +1,11 @@
+//GLSL
+#version 140
+
+in float front;
+
+void main()
+    {
+    //the other paraboloid has this part
+    if (front < 0.0)
+        discard;
+    }
@@ -0,0 +1,18 @@
+//GLSL
+#version 140
+in vec4 p3d_Vertex;
+
+uniform mat4 p3d_ModelViewMatrix;
+uniform vec2 near_far;
+
+out float front;
+
+void main()
+    {
+    vec4 view_pos = p3d_ModelViewMatrix * p3d_Vertex;
+    float dist = length(view_pos.xyz);
+    vec3 dir = view_pos.xyz/dist;
+    //the camera looks down -z, the paraboloid covers that half of the space
+    front = -dir.z;
+    gl_Position = vec4(dir.xy/(1.0-dir.z), ((dist-near_far.x)/(near_far.y-near_far.x))*2.0-1.0, 1.0);
+    }
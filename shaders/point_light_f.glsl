@@ -1,11 +1,24 @@
 //GLSL
 #version 140
+#ifdef LIGHT_ARRAY
+//lights of a LightArray, from the vertex shader
+flat in vec4 array_light;
+flat in vec3 array_light_pos;
+#define LIGHT_POS array_light_pos
+#define LIGHT array_light
+#endif
+#ifndef LIGHT_ARRAY
 struct p3d_LightSourceParameters
     {
     vec4 position;
     //samplerCube shadowMap;
     };
 uniform p3d_LightSourceParameters shadowcaster;
+uniform mat4 trans_render_to_shadowcaster;
+uniform vec4 light;
+#define LIGHT_POS shadowcaster.position.xyz
+#define LIGHT light
+#endif
 uniform mat4 p3d_ProjectionMatrixInverse;
 uniform mat4 p3d_ViewProjectionMatrixInverse;
 uniform mat4 p3d_ViewMatrix;
@@ -13,10 +26,9 @@ uniform mat4 p3d_ModelViewMatrix;
 uniform sampler2D albedo_tex;
 uniform sampler2D normal_tex;
 uniform sampler2D depth_tex;
-
-uniform mat4 trans_render_to_shadowcaster;
-
-uniform vec4 light;
+#ifdef VIEW_POS_PREPASS
+uniform sampler2D view_pos_tex;
+#endif
 
 uniform float near;
 uniform float bias;
@@ -26,28 +38,18 @@ in vec3 V;
 
 out vec4 p3d_FragData;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#pragma include "inc_gbuffer.glsl"
 
 vec3 getPosition(vec2 uv, float depth)
     {
+    #ifdef VIEW_POS_PREPASS
+    return texture(view_pos_tex, uv).xyz;
+    #endif
+    #ifndef VIEW_POS_PREPASS
     vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     view_pos.xyz /= view_pos.w;
     return view_pos.xyz;
+    #endif
     }
 
 vec3 do_specular(float roughness, vec3 tint,
@@ -64,7 +66,7 @@ void main()
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
-    vec4 normal_roughness_metallic=texture(normal_tex,uv);
+    vec4 normal_roughness_metallic=read_gbuffer_normal(normal_tex, uv);
     vec3 N=unpack_normal_octahedron(normal_roughness_metallic.xy);
     float roughness =pow(normal_roughness_metallic.b, 0.5);
     float base_roughness =normal_roughness_metallic.b;
@@ -79,20 +81,27 @@ void main()
 
     vec3 color=vec3(0.0);
     vec3 spec=vec3(0.0);
-    vec3 L=normalize(shadowcaster.position.xyz-view_pos.xyz);;
+    vec3 L=normalize(LIGHT_POS-view_pos.xyz);;
     vec3 V=normalize(-view_pos.xyz);
     vec3 H = normalize(V+L);
     float NdotH= max(0.0,dot( N, H));
     float NdotL=max(0.0,dot( N, L));
 
-    vec3 light_color=light.rgb;
-    float light_radius=light.w;
-    float attenuation=1.0-(pow(distance(view_pos.xyz, shadowcaster.position.xyz), 2.0)/light_radius);
+    vec3 light_color=LIGHT.rgb;
+    float light_radius=LIGHT.w;
+    float attenuation=1.0-(pow(distance(view_pos.xyz, LIGHT_POS), 2.0)/light_radius);
+    #ifdef SIMPLE_FALLOFF
+    //distant lights (see LightLOD), linear falloff, no specular
+    attenuation=max(0.0, attenuation);
+    color+=light_color*NdotL*attenuation;
+    #endif
+    #ifndef SIMPLE_FALLOFF
     attenuation=pow(max(0.0, attenuation), 3.0);
     //diffuse
     color+=light_color*NdotL*attenuation;
     //specular
     spec=do_specular(roughness, color_tex.rgb, metallic, NdotH, gloss, base_roughness)*light_color*attenuation;
+    #endif
 
     float bloom = dot(spec, vec3(1.0))*0.33*0.5;
     vec4 final=vec4((color*albedo)+spec, bloom);
@@ -1,11 +1,29 @@
 //GLSL
 #version 140
+#ifdef PARABOLOID_SHADOW
+struct p3d_LightSourceParameters
+    {
+    vec4 position;
+    };
+//two paraboloids, front (light +Y) on the left, back on the right
+uniform sampler2D paraboloid_map;
+#endif
+#ifndef PARABOLOID_SHADOW
 struct p3d_LightSourceParameters
     {
     vec4 position;
     samplerCube shadowMap;
     };
+#endif
 uniform p3d_LightSourceParameters shadowcaster;
+#if defined(PREFILTER_ESM) || defined(PREFILTER_VSM)
+#ifdef PARABOLOID_SHADOW
+uniform sampler2D prefiltered_shadow;
+#endif
+#ifndef PARABOLOID_SHADOW
+uniform samplerCube prefiltered_shadow;
+#endif
+#endif
 uniform mat4 p3d_ProjectionMatrixInverse;
 uniform mat4 p3d_ViewProjectionMatrixInverse;
 uniform mat4 p3d_ViewMatrix;
@@ -13,6 +31,9 @@ uniform mat4 p3d_ModelViewMatrix;
 uniform sampler2D albedo_tex;
 uniform sampler2D normal_tex;
 uniform sampler2D depth_tex;
+#ifdef VIEW_POS_PREPASS
+uniform sampler2D view_pos_tex;
+#endif
 
 uniform mat4 trans_render_to_shadowcaster;
 
@@ -26,28 +47,19 @@ in vec3 V;
 
 out vec4 p3d_FragData;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#pragma include "inc_gbuffer.glsl"
+#pragma include "inc_shadow_prefilter.glsl"
 
 vec3 getPosition(vec2 uv, float depth)
     {
+    #ifdef VIEW_POS_PREPASS
+    return texture(view_pos_tex, uv).xyz;
+    #endif
+    #ifndef VIEW_POS_PREPASS
     vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     view_pos.xyz /= view_pos.w;
     return view_pos.xyz;
+    #endif
     }
 
 float soft_shadow_cube(samplerCube tex, vec3 uvw, float z, float bias, float blur)
@@ -63,6 +75,32 @@ float soft_shadow_cube(samplerCube tex, vec3 uvw, float z, float bias, float blu
     return result/6.0;
     }
 
+#ifdef PARABOLOID_SHADOW
+vec2 paraboloid_uv(vec3 light_pos)
+    {
+    //same projection as in paraboloid_shadow_v.glsl, in the space of the light
+    vec3 dir=normalize(light_pos);
+    if (dir.y >= 0.0)
+        return vec2(dir.x/(1.0+dir.y)*0.25+0.25, dir.z/(1.0+dir.y)*0.5+0.5);
+    return vec2(-dir.x/(1.0-dir.y)*0.25+0.75, dir.z/(1.0-dir.y)*0.5+0.5);
+    }
+
+float soft_shadow_paraboloid(sampler2D tex, vec3 light_pos, float z, float bias, float blur)
+    {
+    vec2 uv=paraboloid_uv(light_pos);
+    vec2 pixel=blur/textureSize(tex, 0).xy;
+    //don't blur over the edge of the paraboloid
+    float left=step(0.5, uv.x)*0.5;
+    vec2 lo=vec2(left, 0.0)+pixel;
+    vec2 hi=vec2(left+0.5, 1.0)-pixel;
+    float result=float(texture(tex, clamp(uv+vec2(1.0, 0.0)*pixel, lo, hi)).r+bias >= z);
+    result+=float(texture(tex, clamp(uv+vec2(-1.0, 0.0)*pixel, lo, hi)).r+bias >= z);
+    result+=float(texture(tex, clamp(uv+vec2(0.0, 1.0)*pixel, lo, hi)).r+bias >= z);
+    result+=float(texture(tex, clamp(uv+vec2(0.0, -1.0)*pixel, lo, hi)).r+bias >= z);
+    return result/4.0;
+    }
+#endif
+
 vec3 do_specular(float roughness, vec3 tint,
                  float metallic, float NdotH,
                  float gloss, float base_roughness)
@@ -77,7 +115,7 @@ void main()
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
-    vec4 normal_roughness_metallic=texture(normal_tex,uv);
+    vec4 normal_roughness_metallic=read_gbuffer_normal(normal_tex, uv);
     vec3 N=unpack_normal_octahedron(normal_roughness_metallic.xy);
     float roughness=pow(normal_roughness_metallic.b, 0.5);
     float base_roughness =normal_roughness_metallic.b;
@@ -114,6 +152,30 @@ void main()
     vec4 world_pos = p3d_ViewProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     vec4 shadow_uv=trans_render_to_shadowcaster*world_pos;
     shadow_uv.xyz=shadow_uv.xyz/shadow_uv.w;
+    #if defined(PREFILTER_ESM) || defined(PREFILTER_VSM)
+    //one fetch, the prefilter did the blur
+    #ifdef PARABOLOID_SHADOW
+    float shadow_depth=(length(shadow_uv.xyz)-near)/(sqrt(light_radius)-near);
+    float shadow=prefiltered_visibility(texture(prefiltered_shadow, paraboloid_uv(shadow_uv.xyz)).rg, shadow_depth-bias);
+    #endif
+    #ifndef PARABOLOID_SHADOW
+    //the cube map depth is the distance along the major axis
+    float shadow_depth=max(abs(shadow_uv.x), max(abs(shadow_uv.y), abs(shadow_uv.z)))/sqrt(light_radius);
+    float shadow=prefiltered_visibility(texture(prefiltered_shadow, shadow_uv.xyz).rg, shadow_depth-bias);
+    #endif
+    #endif
+    #if !defined(PREFILTER_ESM) && !defined(PREFILTER_VSM)
+    #ifdef PARABOLOID_SHADOW
+    //linear depth, light_radius is the radius squared
+    float pdist=(length(shadow_uv.xyz)-near)/(sqrt(light_radius)-near);
+    #ifdef DISABLE_SOFTSHADOW
+        float shadow=float(texture(paraboloid_map, paraboloid_uv(shadow_uv.xyz)).r+bias >= pdist);
+    #endif
+    #ifndef DISABLE_SOFTSHADOW
+        float shadow=soft_shadow_paraboloid(paraboloid_map, shadow_uv.xyz, pdist, bias, 4.0*(1.0-attenuation));
+    #endif
+    #endif
+    #ifndef PARABOLOID_SHADOW
     float ldist = max(abs(shadow_uv.x), max(abs(shadow_uv.y), abs(shadow_uv.z)));
     ldist = ((light_radius+near)/(light_radius-near))+((-2.0*light_radius*near)/(ldist * (light_radius-near)));
     #ifdef DISABLE_SOFTSHADOW
@@ -122,6 +184,8 @@ void main()
     #ifndef DISABLE_SOFTSHADOW
         float shadow=soft_shadow_cube( shadowcaster.shadowMap,  shadow_uv.xyz,  ldist,  bias,  70.0*(1.0-attenuation));
     #endif
+    #endif
+    #endif
     final*=shadow;
 
     p3d_FragData=final;
@@ -6,14 +6,39 @@ in vec3 p3d_Normal;
 uniform mat4 p3d_ModelViewProjectionMatrix;
 uniform mat3 p3d_NormalMatrix;
 uniform mat4 p3d_ModelViewMatrix;
+#ifdef LIGHT_ARRAY
+// the positions are relative to render, the transform of the
+// light_array node (and light_root) is not used
+uniform mat4 p3d_ViewMatrix;
+uniform mat4 p3d_ProjectionMatrix;
+// 2 texels for each light: position, radius - color, unused
+uniform samplerBuffer light_array;
+flat out vec4 array_light;
+flat out vec3 array_light_pos;
+#endif
+#ifndef LIGHT_ARRAY
 uniform mat4 trans_model_to_shadowcaster;
+#endif
 
 out vec3 N;
 out vec3 V;
 
 void main()
     {
-    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+    #ifdef LIGHT_ARRAY
+    vec4 pos_radius=texelFetch(light_array, gl_InstanceID*2);
+    vec4 color=texelFetch(light_array, gl_InstanceID*2+1);
+    vec4 vertex=vec4(p3d_Vertex.xyz*pos_radius.w*1.1+pos_radius.xyz, 1.0);
+    array_light=vec4(color.rgb, pos_radius.w*pos_radius.w);
+    array_light_pos=vec4(p3d_ViewMatrix * vec4(pos_radius.xyz, 1.0)).xyz;
+    V=vec4(p3d_ViewMatrix * vertex).xyz;
+    gl_Position = p3d_ProjectionMatrix * vec4(V, 1.0);
+    N=mat3(p3d_ViewMatrix) * p3d_Normal;
+    #endif
+    #ifndef LIGHT_ARRAY
+    vec4 vertex=p3d_Vertex;
+    gl_Position = p3d_ModelViewProjectionMatrix * vertex;
     N=p3d_NormalMatrix * p3d_Normal;
-    V=vec4(p3d_ModelViewMatrix * p3d_Vertex).xyz;
+    V=vec4(p3d_ModelViewMatrix * vertex).xyz;
+    #endif
     }
@@ -0,0 +1,57 @@
+//GLSL
+#version 140
+uniform sampler2D input_tex;
+#ifdef UPSAMPLE
+uniform sampler2D base_tex;
+uniform float level_scale;
+uniform float blur;
+#endif
+
+in vec2 uv;
+
+out vec4 p3d_FragData;
+
+void main()
+    {
+    vec2 pixel = vec2(1.0, 1.0)/textureSize(input_tex, 0).xy;
+
+    #ifndef UPSAMPLE
+    //13 tap downsample, 4 overlapping 2x2 boxes + center
+    vec4 a = texture(input_tex, uv+vec2(-2.0, 2.0)*pixel);
+    vec4 b = texture(input_tex, uv+vec2( 0.0, 2.0)*pixel);
+    vec4 c = texture(input_tex, uv+vec2( 2.0, 2.0)*pixel);
+    vec4 d = texture(input_tex, uv+vec2(-2.0, 0.0)*pixel);
+    vec4 e = texture(input_tex, uv);
+    vec4 f = texture(input_tex, uv+vec2( 2.0, 0.0)*pixel);
+    vec4 g = texture(input_tex, uv+vec2(-2.0,-2.0)*pixel);
+    vec4 h = texture(input_tex, uv+vec2( 0.0,-2.0)*pixel);
+    vec4 i = texture(input_tex, uv+vec2( 2.0,-2.0)*pixel);
+    vec4 j = texture(input_tex, uv+vec2(-1.0, 1.0)*pixel);
+    vec4 k = texture(input_tex, uv+vec2( 1.0, 1.0)*pixel);
+    vec4 l = texture(input_tex, uv+vec2(-1.0,-1.0)*pixel);
+    vec4 m = texture(input_tex, uv+vec2( 1.0,-1.0)*pixel);
+
+    vec4 out_tex = e*0.125;
+    out_tex += (a+c+g+i)*0.03125;
+    out_tex += (b+d+f+h)*0.0625;
+    out_tex += (j+k+l+m)*0.125;
+    #endif
+
+    #ifdef UPSAMPLE
+    //3x3 tent upsample of the smaller level added to this level
+    vec2 sharp=pixel*blur;
+    vec4 out_tex = texture(input_tex, uv)*4.0;
+    out_tex += texture(input_tex, uv+vec2(-1.0, 0.0)*sharp)*2.0;
+    out_tex += texture(input_tex, uv+vec2( 1.0, 0.0)*sharp)*2.0;
+    out_tex += texture(input_tex, uv+vec2( 0.0,-1.0)*sharp)*2.0;
+    out_tex += texture(input_tex, uv+vec2( 0.0, 1.0)*sharp)*2.0;
+    out_tex += texture(input_tex, uv+vec2(-1.0,-1.0)*sharp);
+    out_tex += texture(input_tex, uv+vec2( 1.0,-1.0)*sharp);
+    out_tex += texture(input_tex, uv+vec2(-1.0, 1.0)*sharp);
+    out_tex += texture(input_tex, uv+vec2( 1.0, 1.0)*sharp);
+    out_tex/=16.0;
+    out_tex=(out_tex+texture(base_tex, uv))*level_scale;
+    #endif
+
+    p3d_FragData = out_tex;
+    }
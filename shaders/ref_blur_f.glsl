@@ -10,11 +10,13 @@ in vec2 uv;
 
 out vec4 p3d_FragData;
 
+#pragma include "inc_gbuffer.glsl"
+
 void main()
     {
     vec2 win_size=textureSize(base_ssr, 0).xy;
 
-    vec4 normal_roughness_metallic=texture(normal_tex,uv);
+    vec4 normal_roughness_metallic=read_gbuffer_normal(normal_tex, uv);
     float roughness =pow(normal_roughness_metallic.b, 1.5);
     float metallic=normal_roughness_metallic.a;
 
@@ -0,0 +1,108 @@
+//GLSL
+#version 140
+//Turns a shadow map into an exponential (PREFILTER_ESM) or variance
+//(PREFILTER_VSM) shadow map blurred with a box filter,
+//SHADOW_CUBE - cube map of a point light, one face per pass (face input)
+//SHADOW_PARABOLOID - dual paraboloid map of a point light (linear depth)
+//else - 2d shadow map of a spot light
+#ifndef PREFILTER_RADIUS
+#define PREFILTER_RADIUS 2
+#endif
+
+#ifdef SHADOW_PARABOLOID
+uniform sampler2D shadow_map;
+#endif
+#ifndef SHADOW_PARABOLOID
+struct p3d_LightSourceParameters
+    {
+    #ifdef SHADOW_CUBE
+    samplerCube shadowMap;
+    #endif
+    #ifndef SHADOW_CUBE
+    sampler2D shadowMap;
+    #endif
+    };
+uniform p3d_LightSourceParameters shadowcaster;
+#endif
+
+uniform int face;
+uniform vec2 near_far;
+
+out vec4 p3d_FragData;
+
+#pragma include "inc_shadow_prefilter.glsl"
+
+#ifdef SHADOW_CUBE
+//direction of a texel of a cube map face, uv in the 0-1 range
+//outside of the 0-1 range it points at the next face
+vec3 face_dir(vec2 uv)
+    {
+    vec2 st=uv*2.0-1.0;
+    if (face == 0)
+        return vec3(1.0, -st.y, -st.x);
+    if (face == 1)
+        return vec3(-1.0, -st.y, st.x);
+    if (face == 2)
+        return vec3(st.x, 1.0, st.y);
+    if (face == 3)
+        return vec3(st.x, -1.0, -st.y);
+    if (face == 4)
+        return vec3(st.x, -st.y, 1.0);
+    return vec3(-st.x, -st.y, -1.0);
+    }
+#endif
+
+//linear depth in the 0-1 range (distance/far)
+float get_depth(vec2 uv)
+    {
+    #ifdef SHADOW_PARABOLOID
+    return texture(shadow_map, uv).r;
+    #endif
+    #ifndef SHADOW_PARABOLOID
+    #ifdef SHADOW_CUBE
+    float depth=texture(shadowcaster.shadowMap, face_dir(uv)).r;
+    #endif
+    #ifndef SHADOW_CUBE
+    float depth=texture(shadowcaster.shadowMap, uv).r;
+    #endif
+    return near_far.x/(near_far.y-depth*(near_far.y-near_far.x));
+    #endif
+    }
+
+void main()
+    {
+    #ifdef SHADOW_PARABOLOID
+    vec2 size=textureSize(shadow_map, 0).xy;
+    #endif
+    #ifndef SHADOW_PARABOLOID
+    vec2 size=textureSize(shadowcaster.shadowMap, 0).xy;
+    #endif
+    vec2 pixel=1.0/size;
+    vec2 uv=gl_FragCoord.xy*pixel;
+    vec2 lo=vec2(0.0);
+    vec2 hi=vec2(1.0);
+    #ifdef SHADOW_PARABOLOID
+    //don't blur over the edge of the paraboloid
+    lo.x=step(0.5, uv.x)*0.5;
+    hi.x=lo.x+0.5;
+    #endif
+    #ifndef SHADOW_CUBE
+    lo+=pixel*0.5;
+    hi-=pixel*0.5;
+    #endif
+
+    vec2 moments=vec2(0.0);
+    for (int x=-PREFILTER_RADIUS; x<=PREFILTER_RADIUS; ++x)
+        {
+        for (int y=-PREFILTER_RADIUS; y<=PREFILTER_RADIUS; ++y)
+            {
+            vec2 sample_uv=uv+vec2(x, y)*pixel;
+            #ifndef SHADOW_CUBE
+            sample_uv=clamp(sample_uv, lo, hi);
+            #endif
+            moments+=encode_shadow_depth(get_depth(sample_uv));
+            }
+        }
+    float taps=float((PREFILTER_RADIUS*2+1)*(PREFILTER_RADIUS*2+1));
+    p3d_FragData=vec4(moments/taps, 0.0, 1.0);
+    }
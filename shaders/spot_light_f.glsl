@@ -15,6 +15,9 @@ uniform mat4 p3d_ProjectionMatrixInverse;
 uniform sampler2D albedo_tex;
 uniform sampler2D normal_tex;
 uniform sampler2D depth_tex;
+#ifdef VIEW_POS_PREPASS
+uniform sampler2D view_pos_tex;
+#endif
 
 //uniform mat4 trans_render_to_clip_of_spot;
 //uniform mat4 p3d_ViewProjectionMatrixInverse;
@@ -32,22 +35,7 @@ in vec3 V;
 
 out vec4 p3d_FragData;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#pragma include "inc_gbuffer.glsl"
 
 vec4 blur_tex(sampler2D tex, vec2 uv, float blur)
     {
@@ -70,9 +58,14 @@ vec4 blur_tex(sampler2D tex, vec2 uv, float blur)
 
 vec3 getPosition(vec2 uv, float depth)
     {
+    #ifdef VIEW_POS_PREPASS
+    return texture(view_pos_tex, uv).xyz;
+    #endif
+    #ifndef VIEW_POS_PREPASS
     vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     view_pos.xyz /= view_pos.w;
     return view_pos.xyz;
+    #endif
     }
 
 vec3 do_specular(float roughness, vec3 tint,
@@ -89,7 +82,7 @@ void main()
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
-    vec4 normal_roughness_metallic=texture(normal_tex,uv);
+    vec4 normal_roughness_metallic=read_gbuffer_normal(normal_tex, uv);
     vec3 N=unpack_normal_octahedron(normal_roughness_metallic.xy);
     float roughness =pow(normal_roughness_metallic.b, 0.5);
     float base_roughness =normal_roughness_metallic.b;
@@ -112,6 +105,12 @@ void main()
     vec3 light_color=spot.color.rgb;
     float attenuation=1.0-(pow(distance(view_pos.xyz, spot.position.xyz)/light_radius*1.1, 4.0));
     float spotEffect = dot(normalize(spot.spotDirection), -L);
+    #ifdef SIMPLE_FALLOFF
+    //distant lights (see LightLOD), hard cone edge, no specular
+    attenuation*=float(spotEffect > spot.spotCosCutoff);
+    color+=light_color*NdotL*max(0.0, attenuation);
+    #endif
+    #ifndef SIMPLE_FALLOFF
     float falloff=0.0;
     if (spotEffect > spot.spotCosCutoff)
       falloff = pow(spotEffect,spot.spotExponent);
@@ -121,6 +120,7 @@ void main()
     color+=light_color*NdotL*attenuation;
     //specular
     spec=do_specular(roughness, color_tex.rgb, metallic, NdotH, gloss, base_roughness)*light_color*attenuation;
+    #endif
 
     float bloom = dot(spec, vec3(1.0))*0.33*0.5;
     vec4 final=vec4((color*albedo)+spec, bloom);
@@ -11,10 +11,16 @@ struct p3d_LightSourceParameters
     sampler2D shadowMap;
     };
 uniform p3d_LightSourceParameters spot;
+#if defined(PREFILTER_ESM) || defined(PREFILTER_VSM)
+uniform sampler2D prefiltered_shadow;
+#endif
 uniform mat4 p3d_ProjectionMatrixInverse;
 uniform sampler2D albedo_tex;
 uniform sampler2D normal_tex;
 uniform sampler2D depth_tex;
+#ifdef VIEW_POS_PREPASS
+uniform sampler2D view_pos_tex;
+#endif
 
 uniform mat4 trans_render_to_clip_of_spot;
 uniform mat4 p3d_ViewProjectionMatrixInverse;
@@ -30,22 +36,8 @@ in vec3 V;
 out vec4 p3d_FragData;
 
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#pragma include "inc_gbuffer.glsl"
+#pragma include "inc_shadow_prefilter.glsl"
 
 float soft_shadow(sampler2D tex, vec2 uv, float z, float bias, float blur)
     {
@@ -66,9 +58,14 @@ float soft_shadow(sampler2D tex, vec2 uv, float z, float bias, float blur)
 
 vec3 getPosition(vec2 uv, float depth)
     {
+    #ifdef VIEW_POS_PREPASS
+    return texture(view_pos_tex, uv).xyz;
+    #endif
+    #ifndef VIEW_POS_PREPASS
     vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     view_pos.xyz /= view_pos.w;
     return view_pos.xyz;
+    #endif
     }
 
 vec3 do_specular(float roughness, vec3 tint,
@@ -85,7 +82,7 @@ void main()
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
-    vec4 normal_roughness_metallic=texture(normal_tex,uv);
+    vec4 normal_roughness_metallic=read_gbuffer_normal(normal_tex, uv);
     vec3 N=unpack_normal_octahedron(normal_roughness_metallic.xy);
     float roughness =pow(normal_roughness_metallic.b, 0.5);
     float base_roughness =normal_roughness_metallic.b;
@@ -124,13 +121,20 @@ void main()
     //shadows
     vec4 pos = p3d_ViewProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     vec4 shadow_uv=trans_render_to_clip_of_spot*pos;
+    //clip w is the distance along the light direction, the lens far is the radius
+    float shadow_depth=shadow_uv.w/light_radius;
     shadow_uv.xyz=shadow_uv.xyz/shadow_uv.w*0.5+0.5;
+    #if defined(PREFILTER_ESM) || defined(PREFILTER_VSM)
+        float shadow=prefiltered_visibility(texture(prefiltered_shadow, shadow_uv.xy).rg, shadow_depth-bias);
+    #endif
+    #if !defined(PREFILTER_ESM) && !defined(PREFILTER_VSM)
     #ifdef DISABLE_SOFTSHADOW
         float shadow= float(texture(spot.shadowMap, shadow_uv.xy).r >= shadow_uv.z+bias);
     #endif
     #ifndef DISABLE_SOFTSHADOW
         float shadow= soft_shadow(spot.shadowMap, shadow_uv.xy+vec2(0.0, 0.005), shadow_uv.z, bias, 0.008*attenuation);
     #endif
+    #endif
     final*=shadow;
 
 
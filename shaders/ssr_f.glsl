@@ -15,11 +15,42 @@ in vec2 uv;
 
 uniform sampler2D normal_tex;
 uniform sampler2D depth_tex;
+#ifdef VIEW_POS_PREPASS
+uniform sampler2D view_pos_tex;
+#endif
 uniform sampler2D final_light;
 uniform samplerCube cube_tex;
+#ifdef IBL_PREFILTERED
+//mip level of the prefiltered cube_tex for a roughness of 1
+uniform float ibl_max_lod;
+#endif
 uniform mat4 trans_apiclip_of_camera_to_apiview_of_camera;
 uniform mat4 trans_apiview_of_camera_to_apiclip_of_camera;
 uniform mat4 trans_apiview_of_camera_to_world;
+#ifdef HIZ_LEVELS
+uniform sampler2D hiz_tex;
+// the trace uses up to 6 levels of the pyramid (hiz_0 is hiz_tex)
+#if HIZ_LEVELS > 6
+#define HIZ_MAX_LEVEL 5
+#else
+#define HIZ_MAX_LEVEL (HIZ_LEVELS-1)
+#endif
+#if HIZ_MAX_LEVEL >= 1
+uniform sampler2D hiz_1;
+#endif
+#if HIZ_MAX_LEVEL >= 2
+uniform sampler2D hiz_2;
+#endif
+#if HIZ_MAX_LEVEL >= 3
+uniform sampler2D hiz_3;
+#endif
+#if HIZ_MAX_LEVEL >= 4
+uniform sampler2D hiz_4;
+#endif
+#if HIZ_MAX_LEVEL >= 5
+uniform sampler2D hiz_5;
+#endif
+#endif
 
 out vec4 p3d_FragData;
 
@@ -27,29 +58,68 @@ out vec4 p3d_FragData;
 //uniform float rayLength;
 
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
+#pragma include "inc_gbuffer.glsl"
+
+float linearizeDepth(float depth)
     {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
+    return (2.0 * zNear) / (zFar + zNear - depth * (zFar - zNear));
     }
 
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
+#ifdef HIZ_LEVELS
+//samplers can't be indexed with a variable in glsl 1.40
+vec2 hiz_size(int level)
     {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
+    #if HIZ_MAX_LEVEL >= 1
+    if (level == 1) return vec2(textureSize(hiz_1, 0));
+    #endif
+    #if HIZ_MAX_LEVEL >= 2
+    if (level == 2) return vec2(textureSize(hiz_2, 0));
+    #endif
+    #if HIZ_MAX_LEVEL >= 3
+    if (level == 3) return vec2(textureSize(hiz_3, 0));
+    #endif
+    #if HIZ_MAX_LEVEL >= 4
+    if (level == 4) return vec2(textureSize(hiz_4, 0));
+    #endif
+    #if HIZ_MAX_LEVEL >= 5
+    if (level == 5) return vec2(textureSize(hiz_5, 0));
+    #endif
+    return vec2(textureSize(hiz_tex, 0));
     }
 
-float linearizeDepth(float depth)
+float hiz_fetch(int level, ivec2 pos)
     {
-    return (2.0 * zNear) / (zFar + zNear - depth * (zFar - zNear));
+    #if HIZ_MAX_LEVEL >= 1
+    if (level == 1) return texelFetch(hiz_1, pos, 0).r;
+    #endif
+    #if HIZ_MAX_LEVEL >= 2
+    if (level == 2) return texelFetch(hiz_2, pos, 0).r;
+    #endif
+    #if HIZ_MAX_LEVEL >= 3
+    if (level == 3) return texelFetch(hiz_3, pos, 0).r;
+    #endif
+    #if HIZ_MAX_LEVEL >= 4
+    if (level == 4) return texelFetch(hiz_4, pos, 0).r;
+    #endif
+    #if HIZ_MAX_LEVEL >= 5
+    if (level == 5) return texelFetch(hiz_5, pos, 0).r;
+    #endif
+    return texelFetch(hiz_tex, pos, 0).r;
     }
 
+//min depth of a level under a piece of the ray from a to b,
+//the piece is at most one texel long so it's inside a 2x2 block of texels
+float hiz_segment_min(int level, vec2 a, vec2 b)
+    {
+    vec2 size=hiz_size(level);
+    ivec2 pos_a=ivec2(clamp(floor(a*size), vec2(0.0), size-1.0));
+    ivec2 pos_b=ivec2(clamp(floor(b*size), vec2(0.0), size-1.0));
+    ivec2 lo=min(pos_a, pos_b);
+    ivec2 hi=max(pos_a, pos_b);
+    return min(min(hiz_fetch(level, lo), hiz_fetch(level, hi)),
+               min(hiz_fetch(level, ivec2(lo.x, hi.y)), hiz_fetch(level, ivec2(hi.x, lo.y))));
+    }
+#endif
 
 vec4 raytrace(vec3 startPos,
               vec3 endPos,
@@ -76,6 +146,54 @@ vec4 raytrace(vec3 startPos,
     float currentDepth = 0.0;       // current depth calculated with reflection vector
     float deltaD = 0.0;
     vec4 color = vec4(0.0, 0.0, 0.0, 1.0);
+    #ifdef HIZ_LEVELS
+    // Hierarchical trace over the min depth pyramid. The steps that fit in
+    // one texel of the current level are skipped if the ray is in front of
+    // the nearest surface in the texels under them, then the next (coarser)
+    // level is tried. Where the ray can be behind a surface the level goes
+    // down, at level 0 the steps are tested at full resolution.
+    // The hits are the same as with the plain march, with less steps.
+    int level = 0;
+    int i = 1;
+    // every level down follows a level up, so this is enough
+    for (int iter = 0; iter < stepsCount*2 && i < stepsCount; iter++)
+        {
+        vec2 steps_per_texel = (1.0/hiz_size(level)) / max(abs(vectorSS.xy), vec2(0.000001));
+        int last = min(i + int(min(min(steps_per_texel.x, steps_per_texel.y), float(stepsCount))), stepsCount-1);
+        // depth is linear along the ray in screen space, so the far end is the furthest
+        float ray_max = max(startPosSS.z + vectorSS.z*i, startPosSS.z + vectorSS.z*last);
+        float scene_min = hiz_segment_min(level, startPosSS.xy + vectorSS.xy*i,
+                                          startPosSS.xy + vectorSS.xy*last);
+        if (linearizeDepth(ray_max) < linearizeDepth(scene_min))
+            {
+            i = last+1;
+            level = min(level+1, HIZ_MAX_LEVEL);
+            }
+        else if (level > 0)
+            {
+            level--;
+            }
+        else
+            {
+            for (; i <= last; i++)
+                {
+                samplePos = (startPosSS.xy + vectorSS.xy*i);
+                currentDepthSS = startPosSS.z + vectorSS.z*i;
+                currentDepth = linearizeDepth(currentDepthSS);
+                sampleDepth = linearizeDepth( texture(depth, samplePos).r);
+                deltaD = currentDepth - sampleDepth;
+                if ( deltaD > 0 && deltaD < maxDelta * currentDepthSS)
+                    {
+                    color = texture(albedo, samplePos);
+                    float f=fade * (1.0 - float(i) / float(stepsCount));
+                    color.a=1.0-f;
+                    return color;
+                    }
+                }
+            }
+        }
+    #endif
+    #ifndef HIZ_LEVELS
     for (int i = 1; i < stepsCount; i++)
         {
         samplePos = (startPosSS.xy + vectorSS.xy*i);
@@ -93,15 +211,21 @@ vec4 raytrace(vec3 startPos,
             break;
             }
         }
+    #endif
     return color;
     }
 
 vec3 getPosition(vec2 uv)
     {
+    #ifdef VIEW_POS_PREPASS
+    return texture(view_pos_tex, uv).xyz;
+    #endif
+    #ifndef VIEW_POS_PREPASS
     float depth=texture(depth_tex,uv).r * 2.0 - 1.0;
     vec4 view_pos = trans_apiclip_of_camera_to_apiview_of_camera * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     view_pos.xyz /= view_pos.w;
     return view_pos.xyz;
+    #endif
     }
 
 void main()
@@ -109,7 +233,7 @@ void main()
     //float gloss = texture(color_tex, uv).a;
     //view space normal, it's a floating point tex,
     //normalized before writing, ready to use
-    vec4 normal_roughness_metallic=texture(normal_tex,uv);
+    vec4 normal_roughness_metallic=read_gbuffer_normal(normal_tex, uv);
     if (normal_roughness_metallic.rb == vec2(0.0))
         p3d_FragData =vec4(0.0, 0.0, 0.0, 1.0);
     else
@@ -144,7 +268,13 @@ void main()
             //reflection vector in the world space. We negate wcEyeDir as the reflect function expect incident vector pointing towards the surface
             vec3 reflectionWorld = reflect(-wcEyeDir, normalize(wcNormal));
 
+            #ifdef IBL_PREFILTERED
+            //rougher surfaces read blurrier (GGX prefiltered) mip levels
+            vec4 cube_reflection=textureLod(cube_tex, reflectionWorld, pow(normal_roughness_metallic.b, 0.5)*ibl_max_lod);
+            #endif
+            #ifndef IBL_PREFILTERED
             vec4 cube_reflection=texture(cube_tex, reflectionWorld);
+            #endif
             vec3 final=mix(traced.rgb, cube_reflection.rgb, traced.a);
 
             p3d_FragData =vec4(final, 1.0);
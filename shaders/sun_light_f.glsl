@@ -28,32 +28,7 @@ in vec4 light_direction;
 
 out vec4 p3d_FragData;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-// Packs a 3-component normal to 2 channels using octahedron normals
-vec2 pack_normal_octahedron(vec3 v)
-    {
-    // Faster version using newer GLSL capatibilities
-    v.xy /= dot(abs(v), vec3(1.0));
-    // Branch-Less version
-    return mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0.0));
-    }
-
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#pragma include "inc_gbuffer.glsl"
 
 float soft_shadow(sampler2D tex, vec2 uv, float z, float bias, float blur)
     {
@@ -80,7 +55,7 @@ void main()
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
-    vec4 normal_glow_gloss=texture(normal_tex,uv);
+    vec4 normal_glow_gloss=read_gbuffer_normal(normal_tex, uv);
     vec3 normal=unpack_normal_octahedron(normal_glow_gloss.xy);
     float gloss=normal_glow_gloss.a;
     float glow=normal_glow_gloss.b;
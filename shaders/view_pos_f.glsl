@@ -0,0 +1,18 @@
+//GLSL
+#version 140
+uniform sampler2D depth_tex;
+uniform mat4 trans_apiclip_of_camera_to_apiview_of_camera;
+
+out vec4 p3d_FragData;
+
+void main()
+    {
+    vec2 win_size=textureSize(depth_tex, 0).xy;
+    vec2 uv=gl_FragCoord.xy/win_size;
+
+    float depth=texelFetch(depth_tex, ivec2(gl_FragCoord.xy), 0).r * 2.0 - 1.0;
+    vec4 view_pos = trans_apiclip_of_camera_to_apiview_of_camera * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
+    view_pos.xyz /= view_pos.w;
+
+    p3d_FragData=vec4(view_pos.xyz, 1.0);
+    }
@@ -0,0 +1,184 @@
+import re
+
+__all__ = ['FusionError', 'fuse_fragment_shaders', 'same_shader_text']
+
+
+class FusionError(Exception):
+    """
+    Raised when filter stages can't be fused into one shader,
+    the message is the reason
+    """
+    pass
+
+
+def _strip_comments(txt):
+    txt = re.sub(r'/\*.*?\*/', '', txt, flags=re.DOTALL)
+    return re.sub(r'//[^\n]*', '', txt)
+
+
+def _resolve_preprocessor(txt, define):
+    """
+    Resolves #ifdef/#ifndef/#else/#endif blocks using the given defines,
+    other directives (#define, #extension...) are kept, #version is removed
+    """
+    define = define or {}
+    lines = []
+    # stack of (is_active, parent_active)
+    stack = []
+    active = True
+    for line in txt.split('\n'):
+        stripped = line.strip()
+        if stripped.startswith('#'):
+            directive = stripped[1:].strip().split()
+            keyword = directive[0] if directive else ''
+            if keyword in ('ifdef', 'ifndef'):
+                is_defined = directive[1] in define
+                stack.append(active)
+                active = active and (is_defined if keyword == 'ifdef' else not is_defined)
+                continue
+            elif keyword == 'else':
+                if not stack:
+                    raise FusionError('unbalanced #else')
+                active = stack[-1] and not active
+                continue
+            elif keyword == 'endif':
+                if not stack:
+                    raise FusionError('unbalanced #endif')
+                active = stack.pop()
+                continue
+            elif keyword in ('if', 'elif'):
+                raise FusionError('#if expressions are not supported')
+            elif keyword == 'version':
+                continue
+        if active:
+            lines.append(line)
+    if stack:
+        raise FusionError('missing #endif')
+    return '\n'.join(lines)
+
+
+def _split_chunks(txt):
+    """
+    Splits shader text into top level chunks:
+    declarations (ending with ;), functions (ending with }),
+    and preprocessor lines.
+    Returns a list of (names, kind, text)
+    """
+    chunks = []
+    current = ''
+    depth = 0
+    lines = txt.split('\n')
+    for line in lines:
+        if depth == 0 and not current.strip() and line.strip().startswith('#'):
+            directive = line.strip()[1:].split()
+            name = '#'+' '.join(directive[:2])
+            chunks.append(([name], 'directive', line.strip()))
+            continue
+        for char in line+'\n':
+            current += char
+            if char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0 and ')' in current.split('{', 1)[0]:
+                    chunks.append(_make_chunk(current))
+                    current = ''
+            elif char == ';' and depth == 0:
+                chunks.append(_make_chunk(current))
+                current = ''
+    if current.strip():
+        raise FusionError('could not parse the shader')
+    return chunks
+
+
+def _make_chunk(txt):
+    txt = txt.strip()
+    head = txt.split('{', 1)[0]
+    if '(' in head and txt.endswith('}'):
+        name = re.findall(r'(\w+)\s*\(', head)[0]
+        return ([name], 'function', txt)
+    if txt.startswith('struct'):
+        return ([txt.split()[1].split('{')[0]], 'declaration', txt)
+    body = txt.rstrip(';')
+    if '{' in body:
+        body = body.rsplit('}', 1)[1]
+    names = []
+    for part in body.split(','):
+        part = part.split('=', 1)[0]
+        part = re.sub(r'\[.*?\]', '', part)
+        identifiers = re.findall(r'\w+', part)
+        if identifiers:
+            names.append(identifiers[-1])
+    return (names, 'declaration', txt)
+
+
+def _normalize(txt):
+    return ' '.join(txt.split())
+
+
+def same_shader_text(txt_a, txt_b):
+    """
+    True if the two shader texts differ only in comments and whitespace
+    """
+    return _normalize(_strip_comments(txt_a)) == _normalize(_strip_comments(txt_b))
+
+
+def fuse_fragment_shaders(stages, define=None, version='#version 140'):
+    """
+    Concatenates the fragment shaders of consecutive per-pixel filter stages
+    into one shader.
+    stages - list of (name, shader_txt, link) where link is the name of the
+             sampler used to read the previous stage (None for the first stage),
+             the sampler may only be read with texture(link, uv)
+    define - the defines the shader will be compiled with
+    Raises FusionError if the stages can't be fused.
+    """
+    declared = {}
+    body = []
+    last = len(stages)-1
+    for index, (name, shader_txt, link) in enumerate(stages):
+        txt = _resolve_preprocessor(_strip_comments(shader_txt), define)
+        chunks = _split_chunks(txt)
+        outputs = [c for c in chunks if c[1] == 'declaration' and c[2].startswith('out ')]
+        if index < last:
+            if len(outputs) != 1 or _normalize(outputs[0][2]) != 'out vec4 p3d_FragData;':
+                raise FusionError(name+' writes more than one output')
+        for names, kind, chunk_txt in chunks:
+            if link is not None:
+                chunk_txt = re.sub(r'texture\s*\(\s*'+link+r'\s*,\s*uv\s*\)',
+                                   'fused_{0}'.format(index-1), chunk_txt)
+                if link in names:
+                    if not chunk_txt.startswith('uniform sampler2D'):
+                        raise FusionError(name+' reads '+link+' but it is not a sampler')
+                    continue
+                if re.search(r'\b'+link+r'\b', chunk_txt):
+                    raise FusionError(name+' samples '+link+' away from the current pixel')
+            if index < last:
+                if kind == 'declaration' and chunk_txt.startswith('out '):
+                    continue
+                chunk_txt = re.sub(r'\bp3d_FragData\b', 'fused_{0}'.format(index), chunk_txt)
+            if kind == 'function' and names[0] == 'main':
+                chunk_txt = re.sub(r'\bvoid\s+main\s*\(', 'void fused_main_{0}('.format(index), chunk_txt)
+                body.append(chunk_txt)
+                continue
+            duplicate = False
+            for chunk_name in names:
+                if chunk_name in declared:
+                    if _normalize(declared[chunk_name]) != _normalize(chunk_txt):
+                        raise FusionError(name+' redefines '+chunk_name)
+                    duplicate = True
+                else:
+                    declared[chunk_name] = chunk_txt
+            if not duplicate:
+                body.append(chunk_txt)
+    header = [version]
+    for index in range(last):
+        header.append('vec4 fused_{0};'.format(index))
+    main = ['void main()', '    {']
+    for index in range(last+1):
+        main.append('    fused_main_{0}();'.format(index))
+        if index < last:
+            # the fused stages used to write to a 8 bit buffer
+            main.append('    fused_{0}=clamp(fused_{0}, 0.0, 1.0);'.format(index))
+    main.append('    }')
+    return '\n'.join(header+body+main)+'\n'
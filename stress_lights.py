@@ -0,0 +1,86 @@
+'''
+Stress test for the threaded render pipeline (threading-model Cull/Draw).
+Every frame lights are created and removed, shadows are turned on and off
+and from time to time all the filters are rebuilt, so buffers get
+created and removed while the cull and draw threads are working.
+Frames are run by the task manager, so the renderer tasks remove the
+queued buffers like they would in a game.
+Prints the frame rate and the number of lights and buffers at the end,
+a crash, a hang or buffers that never got removed is a failure.
+
+usage: python stress_lights.py [frames] [threading model]
+'''
+import sys
+import time
+import random
+
+
+def run(frames, threading_model):
+    from panda3d.core import loadPrcFileData
+    if threading_model:
+        loadPrcFileData('', 'threading-model '+threading_model)
+    loadPrcFileData('', 'sync-video 0')
+    loadPrcFileData('', 'win-size 1280 720')
+    loadPrcFileData('', 'framebuffer-srgb 0')
+    loadPrcFileData('', 'textures-power-2 None')
+    from direct.showbase import ShowBase
+    from deferred_render import DeferredRenderer
+    from lights import SphereLight, ConeLight
+    from options import Options
+
+    base = ShowBase.ShowBase()
+    base.disableMouse()
+    options = Options('presets/medium.ini').get()
+    DeferredRenderer(**options)
+    deferred_renderer.set_near_far(1.0, 200.0)
+    tile = loader.load_model('sample_assets/plane.egg')
+    tile.set_scale(0.1)
+    tile.reparent_to(deferred_render)
+    base.cam.set_pos(0, -20, 8)
+    base.cam.look_at(0, 0, 0)
+
+    random.seed(1)
+    lights = []
+    created = 0
+    start = time.time()
+    for frame in range(frames):
+        for i in range(random.randint(0, 4)):
+            pos = (random.uniform(-8, 8), random.uniform(-8, 8), random.uniform(0.5, 4))
+            shadow_size = random.choice((0, 0, 0, 128, 256))
+            if random.random() < 0.5:
+                light = SphereLight(color=(random.random(), random.random(), random.random()),
+                                    pos=pos, radius=random.uniform(2, 6), shadow_size=shadow_size)
+            else:
+                light = ConeLight(color=(random.random(), random.random(), random.random()),
+                                  pos=pos, look_at=(0, 0, 0), radius=random.uniform(4, 10),
+                                  fov=random.uniform(30, 80), shadow_size=shadow_size)
+            lights.append(light)
+            created += 1
+        while len(lights) > 40 or (lights and random.random() < 0.3):
+            lights.pop(random.randrange(len(lights))).remove()
+        for light in lights:
+            if isinstance(light, SphereLight) and random.random() < 0.02:
+                light.set_shadow_size(random.choice((0, 128)))
+        if frame % 200 == 199:
+            deferred_renderer.reset_filters(options['filter_setup'])
+        base.taskMgr.step()
+    elapsed = time.time() - start
+    # let the removal queue run out
+    for frame in range(5):
+        base.taskMgr.step()
+    base.graphicsEngine.sync_frame()
+    print('threading model: {0}'.format(threading_model or 'single thread'))
+    print('{0} frames, {1:.1f} fps, {2} lights created, {3} alive'.format(
+        frames, frames/elapsed, created, len(lights)))
+    print('{0} windows and buffers, {1} waiting for removal'.format(
+        base.graphicsEngine.get_num_windows(), len(deferred_renderer.buffer_removal)))
+    if deferred_renderer.buffer_removal:
+        print('FAILED: buffers were not removed')
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    if not run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+               sys.argv[2] if len(sys.argv) > 2 else 'Cull/Draw'):
+        sys.exit(1)
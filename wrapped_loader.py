@@ -1,4 +1,29 @@
-from panda3d.core import ConfigVariableBool, TextureStage, Texture, TransparencyAttrib, VBase4, getModelPath, Shader
+import os
+import json
+from panda3d.core import ConfigVariableBool, ConfigVariableString, TextureStage, Texture, TransparencyAttrib, VBase4, getModelPath, Shader
+from panda3d.core import Filename, PandaSystem
+
+baked_asset_manifest = ConfigVariableString('baked-asset-manifest', 'baked/manifest.json',
+                                            'Manifest written by bake_assets.py, models listed in it '
+                                            'are loaded from the baked bam files')
+
+
+def default_texture_shader_inputs(load_texture):
+    """
+    Returns the texture shader inputs of the geometry shader,
+    for WrappedLoader.texture_shader_inputs
+    """
+    return [{'input_name': 'tex_diffuse',
+             'stage_modes': (TextureStage.M_modulate, TextureStage.M_modulate_glow, TextureStage.M_modulate_gloss),
+             'default_texture': load_texture('tex/def_diffuse.png')},
+            {'input_name': 'tex_normal',
+             'stage_modes': (TextureStage.M_normal, TextureStage.M_normal_height, TextureStage.M_normal_gloss),
+             'default_texture': load_texture('tex/def_normal.png')},
+            {'input_name': 'tex_material',  # Shine Height Alpha Glow
+             # something different
+             'stage_modes': (TextureStage.M_selector,),
+             'default_texture': load_texture('tex/def_material.png')}]
+
 
 class WrappedLoader(object):
 
@@ -7,6 +32,66 @@ class WrappedLoader(object):
         self.texture_shader_inputs = []
         self.use_srgb = ConfigVariableBool('framebuffer-srgb').getValue()
         self.shader_cache = {}
+        # baked models by source path (without extension), see bake_assets.py
+        self.baked_models = {}
+        self.baked_root = ''
+        self.loadBakedManifest(baked_asset_manifest.getValue())
+
+    def loadBakedManifest(self, manifest_path):
+        """
+        Reads the manifest written by bake_assets.py. The baked models are
+        only used if they were baked with the same Panda3D version and
+        sRGB setting, and the source file did not change since
+        """
+        self.baked_models = {}
+        if not manifest_path or not os.path.isfile(manifest_path):
+            return
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError) as err:
+            print('Error reading baked asset manifest', manifest_path, err)
+            return
+        if manifest.get('panda_version') != PandaSystem.get_version_string():
+            print('Baked assets are for Panda3D', manifest.get('panda_version'), 'run bake_assets.py again')
+            return
+        if manifest.get('srgb') != self.use_srgb:
+            return
+        self.baked_root = os.path.dirname(manifest_path)
+        self.baked_models = manifest.get('models', {})
+
+    def getBakedPath(self, modelPath):
+        """
+        Returns the path of the baked bam file for a model, or None if the
+        model is not baked or the source changed after baking
+        """
+        if not self.baked_models or not isinstance(modelPath, (str, Filename)):
+            return None
+        key = str(modelPath).replace('\\', '/')
+        for extension in ('.egg.pz', '.egg', '.bam'):
+            if key.endswith(extension):
+                key = key[:-len(extension)]
+                break
+        entry = self.baked_models.get(key)
+        if entry is None:
+            return None
+        source = os.path.join(self.baked_root, entry['source'])
+        try:
+            if os.path.getmtime(source) != entry['source_mtime']:
+                return None
+        except OSError:
+            pass
+        return os.path.join(self.baked_root, entry['bam'])
+
+    def applyFixups(self, model):
+        """
+        Sets up a loaded model for the deferred renderer: sRGB textures,
+        texture shader inputs and transparency
+        """
+        if self.use_srgb:
+            self.fixSrgbTextures(model)
+        self.setTextureInputs(model)
+        self.fix_transparency(model)
 
     def _from_snake_case(self, attr):
         camel_case=''
@@ -113,13 +198,16 @@ class WrappedLoader(object):
     def loadModel(self, modelPath, loaderOptions=None, noCache=None,
                   allowInstance=False, okMissing=None,
                   callback=None, extraArgs=[], priority=None):
+        if callback is None:
+            baked_path = self.getBakedPath(modelPath)
+            if baked_path is not None:
+                # the fixups are already in the bam file
+                return self.original_loader.loadModel(
+                    Filename.from_os_specific(baked_path), loaderOptions, noCache, allowInstance, okMissing)
         model = self.original_loader.loadModel(
             modelPath, loaderOptions, noCache, allowInstance, okMissing, callback, extraArgs, priority)
 
-        if self.use_srgb:
-            self.fixSrgbTextures(model)
-        self.setTextureInputs(model)
-        self.fix_transparency(model)
+        self.applyFixups(model)
         return model
 
     def cancelRequest(self, cb):
@@ -208,14 +296,43 @@ class WrappedLoader(object):
 
     def loadShaderGLSL(self, v_shader, f_shader, define=None, version='#version 140'):
         # check if we already have a shader like that
-        # note: this may fail depending on the dict implementation
-        if (v_shader, f_shader, str(define)) in self.shader_cache:
-            return self.shader_cache[(v_shader, f_shader, str(define))]
+        cache_key = (v_shader, f_shader, self.getDefineKey(define))
+        if cache_key in self.shader_cache:
+            return self.shader_cache[cache_key]
         # load the shader text
-        with open(getModelPath().findFile(v_shader).toOsSpecific()) as f:
-            v_shader_txt = f.read()
-        with open(getModelPath().findFile(f_shader).toOsSpecific()) as f:
-            f_shader_txt = f.read()
+        v_shader_txt = self.readShaderText(v_shader)
+        f_shader_txt = self.readShaderText(f_shader)
+        shader = self.makeShaderGLSL(v_shader_txt, f_shader_txt, define, version,
+                                     cache_key=cache_key)
+        try:
+            shader.set_filename(Shader.ST_vertex, v_shader)
+            shader.set_filename(Shader.ST_fragment, f_shader)
+        except:
+            print('Shader filenames will not be available, consider using a dev version of Panda3D')
+        return shader
+
+    def getDefineKey(self, define):
+        """
+        Returns a key for the shader cache that doesn't depend on the order of the defines
+        """
+        if not define:
+            return None
+        return str(sorted(define.items()))
+
+    def readShaderText(self, shader_path):
+        """
+        Returns the text of a shader file, with includes expanded
+        """
+        with open(getModelPath().findFile(shader_path).toOsSpecific()) as f:
+            return self._expand_includes(f.read(), shader_path)
+
+    def makeShaderGLSL(self, v_shader_txt, f_shader_txt, define=None, version='#version 140', cache_key=None):
+        """
+        Makes a shader from GLSL source text, the defines are put after the version line.
+        If cache_key is given the shader is stored in the shader cache under that key
+        """
+        if cache_key is not None and cache_key in self.shader_cache:
+            return self.shader_cache[cache_key]
         # make the header
         if define:
             header = version + '\n'
@@ -227,14 +344,30 @@ class WrappedLoader(object):
         # make the shader
         shader = Shader.make(Shader.SL_GLSL, v_shader_txt, f_shader_txt)
         # store it
-        self.shader_cache[(v_shader, f_shader, str(define))] = shader
-        try:
-            shader.set_filename(Shader.ST_vertex, v_shader)
-            shader.set_filename(Shader.ST_fragment, f_shader)
-        except:
-            print('Shader filenames will not be available, consider using a dev version of Panda3D')
+        if cache_key is not None:
+            self.shader_cache[cache_key] = shader
         return shader
 
+    def _expand_includes(self, shader_txt, shader_path):
+        """
+        Replaces '#pragma include "file"' lines with the text of the file,
+        the file path is relative to the directory of the including shader
+        """
+        if '#pragma include' not in shader_txt:
+            return shader_txt
+        shader_dir = ''
+        if '/' in shader_path:
+            shader_dir = shader_path.rsplit('/', 1)[0]+'/'
+        lines = []
+        for line in shader_txt.split('\n'):
+            if line.strip().startswith('#pragma include'):
+                include_path = shader_dir+line.split('include', 1)[1].strip().strip('"<>')
+                with open(getModelPath().findFile(include_path).toOsSpecific()) as f:
+                    lines.append(self._expand_includes(f.read(), include_path))
+            else:
+                lines.append(line)
+        return '\n'.join(lines)
+
     def loadShader(self, shaderPath, okMissing=False):
         return self.original_loader.loadShader(shaderPath, okMissing)
 